@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of sync_planner.plan_sync on big snapshots (1M entries by default).
+
+Usage: python benchmark_sync_planner.py [<entries>]
+
+The server snapshot has 1% of the files changed on server (new, modified, moved and copied) and the client one
+1% changed on client: the planner time must grow linearly with the entries.
+"""
+import sys
+import time
+import hashlib
+
+from sync_planner import plan_sync
+
+DEFAULT_ENTRIES = 10 ** 6
+
+
+def make_snapshots(entries):
+    """
+    Return the (client snapshot, server snapshot) with <entries> files each.
+    """
+    client = {}
+    for n in xrange(entries):
+        client['folder{}/file{}.txt'.format(n % 1000, n)] = [1, hashlib.md5(str(n)).hexdigest()]
+    server = dict(client)
+    changed = entries // 100
+    paths = sorted(client)
+    for n, path in enumerate(paths[:changed]):
+        kind = n % 4
+        if kind == 0:
+            server['new/file{}.txt'.format(n)] = [5, hashlib.md5('new{}'.format(n)).hexdigest()]
+        elif kind == 1:
+            server[path] = [5, hashlib.md5('modified{}'.format(n)).hexdigest()]
+        elif kind == 2:
+            server['moved/file{}.txt'.format(n)] = server.pop(path)
+        else:
+            server['copy/file{}.txt'.format(n)] = server[path]
+    for n, path in enumerate(paths[-changed:]):
+        client[path] = [4, hashlib.md5('client{}'.format(n)).hexdigest()]
+    return client, server
+
+
+def benchmark(entries=DEFAULT_ENTRIES):
+    start = time.time()
+    client, server = make_snapshots(entries)
+    print 'Snapshots of {:,} entries built in {:.1f} s'.format(entries, time.time() - start)
+    for directory_modified in (False, True):
+        start = time.time()
+        plan = plan_sync(client, server, 10, 3, directory_modified)
+        elapsed = time.time() - start
+        print 'directory_modified={}: planned in {:.2f} s ({:.2f} us per entry)'.format(
+            directory_modified, elapsed, elapsed * 10 ** 6 / entries)
+        print '    ' + ', '.join('{} {:,}'.format(field, len(getattr(plan, field))) for field in plan.FIELDS)
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ENTRIES)
@@ -91,6 +91,28 @@ def _getpass():
         return False
 
 
+def format_plan(plan):
+    """
+    Return the synchronization plan sent by the daemon (see SyncPlan.to_dict in sync_planner) as text,
+    one operation per line, in the order they would be made.
+    :param plan: dict
+    :return: str
+    """
+    lines = []
+    lines.extend('copy           {} -> {}'.format(src, dst) for src, dst in plan['copies'])
+    lines.extend('conflict       {} (local version kept in {})'.format(path, conflicted_path)
+                 for path, conflicted_path in plan['conflicts'])
+    lines.extend('move           {} -> {}'.format(src, dst) for src, dst in plan['moves'])
+    lines.extend('delete local   {}'.format(path) for path in plan['client_deletes'])
+    lines.extend('delete server  {}'.format(path) for path in plan['server_deletes'])
+    lines.extend('download       {}'.format(path) for path in plan['downloads'])
+    lines.extend('modify         {}'.format(path) for path in plan['modifies'])
+    lines.extend('upload         {}'.format(path) for path in plan['uploads'])
+    if not lines:
+        return 'Already synchronized: nothing to do.'
+    return '\n'.join(lines)
+
+
 class CommandParser(cmd.Cmd):
     """
     Command line interpreter
@@ -175,6 +197,20 @@ class CommandParser(cmd.Cmd):
         message = {'shutdown': ()}
         self._send_to_daemon(message)
 
+    def do_plan(self, line):
+        """
+        Show what the synchronization with the server would do, without doing it
+        Usage: plan
+        """
+        message = {'plan': ()}
+        response = self._send_to_daemon(message)
+        if response is None:
+            print 'Error: impossible to get the server snapshot.'
+            return False
+        print format_plan(response)
+        # for testing purpose
+        return response
+
     def do_register(self, line):
         """
         Create new user:
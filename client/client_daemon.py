@@ -10,9 +10,12 @@ import hashlib
 import re
 import time
 import argparse
+import threading
 
 from sys import exit as exit
 from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import groupby
 from shutil import copy2, move
 
 # we import PollingObserver instead of Observer because the deleted event
@@ -20,6 +23,10 @@ from shutil import copy2, move
 from watchdog.observers.polling import PollingObserver as Observer
 from watchdog.events import RegexMatchingEventHandler
 from connection_manager import ConnectionManager
+from file_index import FileIndex, Entry, stat_key
+from client_snapshot import ClientSnapshot, legacy_digest
+from sync_planner import plan_sync, merge_changes
+from transfer_pool import TransferPool
 
 
 class SkipObserver(Observer):
@@ -74,6 +81,7 @@ class Daemon(RegexMatchingEventHandler):
     IGNORED_REGEX = ['.*\.[a-zA-z]+?#',  # Libreoffice suite temporary file ignored
                      '.*\.[a-zA-Z]+?~',  # gedit issue solved ignoring this pattern:
                      # gedit first delete file, create, and move to dest_path *.txt~
+                     '.*\.pybox\.part$',  # partially downloaded file (see connection_manager.PARTIAL_DOWNLOAD_SUFFIX)
     ]
 
     # Calculate int size in the machine architecture
@@ -82,6 +90,29 @@ class Daemon(RegexMatchingEventHandler):
     # Allowed operation before user is activated
     ALLOWED_OPERATION = {'register', 'activate'}
 
+    # Max number of actions sent to the server in a batch (see _delete_on_server)
+    BATCH_SIZE = 1000
+
+    # Default number of the transfers made concurrently (see _make_sync_commands), the 'transfer_workers' of the
+    # configuration
+    TRANSFER_WORKERS = 4
+
+    # Database of the file index (see the file_index module), in the directory of local_dir_state unless the
+    # 'file_index_path' is configured
+    FILE_INDEX_FILENAME = 'file_index.db'
+
+    # Version of the local_dir_state format: the old one, without version, has the legacy global md5
+    # (see load_local_dir_state)
+    LOCAL_DIR_STATE_VERSION = 2
+
+    # Seconds between the synchronizations with the server: the daemon syncs as soon as the server notifies a
+    # change (see _listen_server_events), so it polls just for safety, unless the notifications are not available.
+    SAFETY_POLLING_INTERVAL = 60
+    POLLING_INTERVAL = 3
+    # Max seconds a long-poll of the server events waits, and seconds before retrying a failed one
+    EVENTS_TIMEOUT = 30
+    EVENTS_RETRY_DELAY = 5
+
     def __init__(self, cfg_path=None, sharing_path=None):
         RegexMatchingEventHandler.__init__(self, ignore_regexes=Daemon.IGNORED_REGEX, ignore_directories=True)
 
@@ -89,14 +120,40 @@ class Daemon(RegexMatchingEventHandler):
         self.daemon_state = 'down'  # TODO implement the daemon state (disconnected, connected, syncronizing, ready...)
         self.running = 0
         self.client_snapshot = {}  # EXAMPLE {'<filepath1>: ['<timestamp>', '<md5>', '<filepath2>: ...}
-        self.local_dir_state = {}  # EXAMPLE {'last_timestamp': '<timestamp>', 'global_md5': '<md5>'}
+        # EXAMPLE {'last_timestamp': '<timestamp>', 'global_md5': '<md5>', 'version': LOCAL_DIR_STATE_VERSION}
+        self.local_dir_state = {}
+        # While True, local_dir_state is updated in memory only (see _deferred_local_dir_state_save)
+        self._local_dir_state_save_deferred = False
+        self._local_dir_state_unsaved = False
+        # md5 of the files by their stat, kept in memory until _initialize_observing opens its database
+        self.file_index = FileIndex()
+        # Cursor of the last server change applied (see sync_with_server). It's not saved, so the first sync
+        # after the start always compares the whole snapshots, finding the changes made while the daemon was down.
+        self.server_cursor = None
         self.listener_socket = None
         self.observer = None
+        # The events listener thread writes in this pipe to wake the main loop when the server changes,
+        # then waits for the synchronization (see _listen_server_events)
+        self.events_pipe = None
+        self.events_available = False
+        self.server_synced = threading.Event()
         self.cfg = self._load_cfg(cfg_path, sharing_path)
         self._init_sharing_path(sharing_path)
 
         self.conn_mng = ConnectionManager(self.cfg)
 
+    @property
+    def client_snapshot(self):
+        """
+        The snapshot of the sharing folder (see the client_snapshot module).
+        :return: ClientSnapshot
+        """
+        return self._client_snapshot
+
+    @client_snapshot.setter
+    def client_snapshot(self, files):
+        self._client_snapshot = files if isinstance(files, ClientSnapshot) else ClientSnapshot(files)
+
     def _build_directory(self, path):
         """
         Create a given directory if not existent
@@ -193,6 +250,13 @@ class Daemon(RegexMatchingEventHandler):
                          'Check sharing_path value contained in cfg file:\n{}\n'
                       .format(self.cfg['sharing_path'], Daemon.CONFIG_FILEPATH))
 
+    def open_file_index(self):
+        """
+        Open the database of the file index (see the file_index module).
+        """
+        default_path = os.path.join(os.path.dirname(self.cfg['local_dir_state_path']), self.FILE_INDEX_FILENAME)
+        self.file_index.connect(self.cfg.get('file_index_path', default_path))
+
     def build_client_snapshot(self):
         """
         Build a snapshot of the sharing folder with the following structure
@@ -201,8 +265,12 @@ class Daemon(RegexMatchingEventHandler):
         {
             "<file_path>":('<timestamp>', '<md5>')
         }
+        The md5 and the server timestamp of the files not changed since they have been indexed are taken from
+        the file index: only the other ones are hashed (and indexed).
         """
         self.client_snapshot = {}
+        indexed = self.file_index.entries()
+        hashed = {}
         for dirpath, dirs, files in os.walk(self.cfg['sharing_path']):
             for filename in files:
                 filepath = os.path.join(dirpath, filename)
@@ -214,7 +282,46 @@ class Daemon(RegexMatchingEventHandler):
                         break
                 if not unwanted_file:
                     relative_path = self.relativize_path(filepath)
-                    self.client_snapshot[relative_path] = ['', self.hash_file(filepath)]
+                    try:
+                        st = os.stat(filepath)
+                    except OSError as e:
+                        print e
+                        continue
+                    entry = indexed.pop(relative_path, None)
+                    if entry is None or not entry.matches(st):
+                        md5 = self._file_md5(filepath)
+                        if md5 is None:
+                            continue
+                        entry = Entry(*(stat_key(st) + (md5, None)))
+                        if self._is_unchanged(filepath, st):
+                            hashed[relative_path] = entry
+                    timestamp = entry.timestamp if entry.timestamp is not None else ''
+                    self.client_snapshot[relative_path] = [timestamp, entry.md5]
+        # The files left in <indexed> don't exist anymore.
+        self.file_index.update(hashed, removed=indexed.keys())
+        print '{} files in the sharing folder, {} hashed'.format(len(self.client_snapshot), len(hashed))
+
+    def _index_file(self, path, md5, timestamp=None):
+        """
+        Index the file <path> with its known <md5> and server <timestamp>, e.g. after writing it.
+        """
+        try:
+            st = os.stat(self.absolutize_path(path))
+        except OSError:
+            return
+        if not isinstance(timestamp, (int, long)):
+            timestamp = None
+        self.file_index.set(path, st, md5, timestamp)
+
+    def _is_unchanged(self, filepath, st):
+        """
+        Return True if the file <filepath> still has the stat result <st> (e.g. taken before hashing it).
+        :return: bool
+        """
+        try:
+            return stat_key(os.stat(filepath)) == stat_key(st)
+        except OSError:
+            return False
 
     def _is_directory_modified(self):
         """
@@ -232,11 +339,8 @@ class Daemon(RegexMatchingEventHandler):
         """
         Receive as parameter the md5 of a file and return the first knowed path with the same md5
         """
-        for path, tupla in self.client_snapshot.iteritems():
-            if searched_md5 in tupla[1]:
-                return path
-        else:
-            return None
+        paths = self.client_snapshot.paths_by_md5(searched_md5)
+        return paths[0] if paths else None
 
     def _make_copy_on_client(self, src, dst, server_timestamp):
         """
@@ -262,6 +366,7 @@ class Daemon(RegexMatchingEventHandler):
             return False
 
         self.client_snapshot[dst] = self.client_snapshot[src]
+        self._index_file(dst, self.client_snapshot[dst][1], server_timestamp)
         self.update_local_dir_state(server_timestamp)
         return True
 
@@ -290,235 +395,314 @@ class Daemon(RegexMatchingEventHandler):
 
         self.client_snapshot[dst] = self.client_snapshot[src]
         self.client_snapshot.pop(src)
+        self.file_index.move(src, dst)
         self.update_local_dir_state(server_timestamp)
         return True
 
     def _sync_process(self, server_timestamp, server_dir_tree):
-        # Makes the synchronization logic and return a list of commands to launch
-        # for server synchronization
-
-        def _filter_tree_difference(server_dir_tree):
-            # process local dir_tree and server dir_tree
-            # and makes a diffs classification
-            # return a dict representing that classification
-            # E.g. { 'new_on_server'     : <[<filepath>, ...]>,  # files in server, but not in client
-            # 'modified'          : <[<filepath>, ...]>,  # files in server and client, but different
-            # 'new_on_client'     : <[<filepath>, ...]>,  # files not in server, but in client
-            # }
-            client_files = set(self.client_snapshot.keys())
-            server_files = set(server_dir_tree.keys())
-
-            new_on_server = list(server_files.difference(client_files))
-            new_on_client = list(client_files.difference(server_files))
-            modified = []
-
-            for filepath in server_files.intersection(client_files):
-                # check files md5
-
-                if server_dir_tree[filepath][1] != self.client_snapshot[filepath][1]:
-                    modified.append(filepath)
-
-            return {'new_on_server': new_on_server, 'modified': modified, 'new_on_client': new_on_client}
-
-        def _check_md5(dir_tree, md5):
-            result = []
-            for k, v in dir_tree.iteritems():
-                if md5 == v[1]:
-                    result.append(k)
-            return result
-
-        local_timestamp = self.local_dir_state['last_timestamp']
-        tree_diff = _filter_tree_difference(server_dir_tree)
-        sync_commands = []
-
-        if self._is_directory_modified():
-            if local_timestamp == server_timestamp:
-                print "local_timestamp == server_timestamp and directory IS modified"
-                # simple case: the client has the command
-                # it sends all folder modifications to server
-
-                # files in server but not in client: remove them from server
-                for filepath in tree_diff['new_on_server']:
-                    sync_commands.append(('delete', filepath))
-                    # self.conn_mng.dispatch_request('delete', {'filepath': filepath})
-
-                # files modified in client: send modified files to server
-                for filepath in tree_diff['modified']:
-                    sync_commands.append(('modify', filepath))
-
-                # files in client but not in server: upload them to server
-                for filepath in tree_diff['new_on_client']:
-                    sync_commands.append(('upload', filepath))
-                    # self.conn_mng.dispatch_request('upload', {'filepath': filepath})
-
-            else:  # local_timestamp < server_timestamp
-                print "local_timestamp < server_timestamp and directory IS modified"
-                assert local_timestamp <= server_timestamp, 'e\' successo qualcosa di brutto nella sync, ' \
-                                                            'local_timestamp > di server_timestamp '
-                # the server has the command
-                for filepath in tree_diff['new_on_server']:
-                    file_timestamp, md5 = server_dir_tree[filepath]
-                    existed_filepaths_on_client = _check_md5(self.client_snapshot, md5)
-                    # If i found at least one path in client_snapshot with the same md5 of filepath this mean that in the past
-                    # client_snapshot have stored one or more files with the same md5 but different paths.
-
-                    if existed_filepaths_on_client:
-                        # it's a copy or a move
-                        for path in existed_filepaths_on_client:
-                            if path in tree_diff['new_on_client']:
-                                if self._make_move_on_client(path, filepath, server_timestamp):
-                                    tree_diff['new_on_client'].remove(path)
-                                    break
-                                else:
-                                    self.stop(0, "move failed on in SYNC: src_path: {}, dest_path: {}".format(path,
-                                                                                                              filepath))
-                        # we haven't found files deleted on server so it's a copy
-                        else:
-                            if not self._make_copy_on_client(path, filepath, server_timestamp):
-                                self.stop(0,
-                                          "copy failed on in SYNC: src_path: {}, dest_path: {}".format(path, filepath))
-
-                    # the daemon don't know filepath, i will search if the file_timestamp is more recent then local_timestamp
-                    else:
-                        if file_timestamp > local_timestamp:
-                            # the files in server is more updated
-                            sync_commands.append(('download', filepath))
-                            # self.conn_mng.dispatch_request('download', {'filepath': filepath})
-                        else:
-                            # the client has deleted the file, so delete it on server
-                            sync_commands.append(('delete', filepath))
-                            # self.conn_mng.dispatch_request('delete', {'filepath': filepath})
-
-                for filepath in tree_diff['modified']:
-                    file_timestamp, md5 = server_dir_tree[filepath]
-
-                    if file_timestamp < local_timestamp:
-                        # the client has modified the file, so update it on server
-                        sync_commands.append(('modify', filepath))
-                        # self.conn_mng.dispatch_request('modify', {'filepath': filepath})
-                    else:
-                        # it's the worst case:
-                        # we have a conflict with server,
-                        # someone has modified files while daemon was down and someone else has modified
-                        # the same file on server
-                        conflicted_path = ''.join([filepath, '.conflicted'])
-                        self._make_copy_on_client(filepath, conflicted_path, server_timestamp)
-                        sync_commands.append(('upload', conflicted_path))
-                        # self.conn_mng.dispatch_request('upload', {'filepath': conflicted_path})
-
-                for filepath in tree_diff['new_on_client']:
-                    sync_commands.append(('upload', filepath))
-                    # self.conn_mng.dispatch_request('upload', {'filepath': filepath})
-
-        else:  # directory not modified
-            if local_timestamp == server_timestamp:
-                print "local_timestamp == server_timestamp and directory IS NOT modified"
-                # it's the best case. Client and server are already synchronized
-                return []
-            else:  # local_timestamp < server_timestamp
-                print "local_timestamp < server_timestamp and directory IS NOT modified"
-                assert local_timestamp <= server_timestamp, 'e\' successo qualcosa di brutto nella sync, ' \
-                                                            'local_timestamp > di server_timestamp '
-                # the server has the command
-                for filepath in tree_diff['new_on_server']:
-                    timestamp, md5 = server_dir_tree[filepath]
-                    existed_filepaths_on_client = _check_md5(self.client_snapshot, md5)
-                    # If i found at least one path in client_snapshot with the same md5 of filepath this mean that
-                    # in the past client_snapshot have stored one or more files with the same md5 but different paths.
-
-                    if existed_filepaths_on_client:
-                        # it's a copy or a move
-                        for path in existed_filepaths_on_client:
-                            if path in tree_diff['new_on_client']:
-                                if self._make_move_on_client(path, filepath, server_timestamp):
-                                    tree_diff['new_on_client'].remove(path)
-                                    break
-                                else:
-                                    self.stop(0, "move failed on in SYNC: src_path: {}, dest_path: {}".format(path,
-                                                                                                              filepath))
-                        # we haven't found files deleted on server so it's a copy
-                        else:
-                            if not self._make_copy_on_client(path, filepath, server_timestamp):
-                                self.stop(0,
-                                          "copy failed on in SYNC: src_path: {}, dest_path: {}".format(path, filepath))
-                    else:
-                        # it's a new file
-                        sync_commands.append(('download', filepath))
-                        # self.conn_mng.dispatch_request('download', {'filepath': filepath})
-
-                for filepath in tree_diff['modified']:
-                    sync_commands.append(('download', filepath))
-                    # self.conn_mng.dispatch_request('download', {'filepath': filepath})
-
-                for filepath in tree_diff['new_on_client']:
-                    # files that have been deleted on server, so have to delete them
-                    abs_filepath = self.absolutize_path(filepath)
-                    self.observer.skip(abs_filepath)
-                    try:
-                        os.remove(abs_filepath)
-                    except OSError as e:
-                        print "Delete EXEPTION INTO SYNC : {}".format(e)
+        """
+        Plan the synchronization with the server snapshot <server_dir_tree> (see sync_planner.plan_sync), make its
+        local operations and return the commands to send to the server, as a list of (<command>, <path>).
+        """
+        return self._execute_sync_plan(self._plan_sync(server_timestamp, server_dir_tree), server_timestamp)
 
-                    self.client_snapshot.pop(filepath)
-                    self.update_local_dir_state(server_timestamp)
+    def _plan_sync(self, server_timestamp, server_dir_tree):
+        """
+        Return the SyncPlan to synchronize the client with the server snapshot <server_dir_tree>.
+        """
+        return plan_sync(self.client_snapshot, server_dir_tree, server_timestamp,
+                         self.local_dir_state['last_timestamp'], self._is_directory_modified())
 
-        return sync_commands
+    def _execute_sync_plan(self, plan, server_timestamp):
+        """
+        Make the local operations of the SyncPlan <plan> (copies first, since their source can be moved or deleted
+        afterwards) and return its commands to send to the server. local_dir_state is saved once at the end.
+        """
+        with self._deferred_local_dir_state_save():
+            for src, dst in plan.copies:
+                if not self._make_copy_on_client(src, dst, server_timestamp):
+                    self.stop(0, "copy failed on in SYNC: src_path: {}, dest_path: {}".format(src, dst))
+            for path, conflicted_path in plan.conflicts:
+                if not self._make_copy_on_client(path, conflicted_path, server_timestamp):
+                    self.stop(0, "copy failed on in SYNC: src_path: {}, dest_path: {}".format(path, conflicted_path))
+            for src, dst in plan.moves:
+                if not self._make_move_on_client(src, dst, server_timestamp):
+                    self.stop(0, "move failed on in SYNC: src_path: {}, dest_path: {}".format(src, dst))
+            for path in plan.client_deletes:
+                self._make_delete_on_client(path)
+            if plan.client_deletes:
+                self.update_local_dir_state(server_timestamp)
+        return plan.sync_commands()
+
+    def sync_plan(self):
+        """
+        Return the plan to synchronize the client with the server, without executing it (see SyncPlan.to_dict),
+        or None if the server snapshot is not available.
+        :return: dict
+        """
+        response = self.conn_mng.dispatch_request('get_server_snapshot', '')
+        if response is None:
+            return None
+        return self._plan_sync(response['server_timestamp'], response['files']).to_dict()
+
+    def _make_delete_on_client(self, path):
+        """
+        Delete the file <path> deleted on server, if it exists
+        :param path: the relative path of the file to delete
+        """
+        if path not in self.client_snapshot:
+            return
+        abs_path = self.absolutize_path(path)
+        self.observer.skip(abs_path)
+        try:
+            os.remove(abs_path)
+        except OSError as e:
+            print "Delete EXEPTION INTO SYNC : {}".format(e)
+        self.client_snapshot.pop(path)
+
+    def _apply_server_change(self, change):
+        """
+        Apply to the sharing folder a change of the server snapshot (an item of the change feed, see
+        ConnectionManager.do_get_server_changes). The changes already applied (e.g. the ones made by this
+        client) change nothing, and a content already in the client is copied or moved instead of downloaded.
+        """
+        op, path, md5, src = change['op'], change['path'], change['md5'], change['src']
+        if op == 'delete':
+            self._make_delete_on_client(path)
+            return
+
+        if self.client_snapshot.get(path, [None, None])[1] != md5:
+            timestamp = change['timestamp']
+            src_is_local = src in self.client_snapshot and self.client_snapshot[src][1] == md5
+            if op == 'move' and src_is_local:
+                done = self._make_move_on_client(src, path, timestamp)
+            else:
+                local_path = src if src_is_local else self.search_md5(md5)
+                done = local_path is not None and self._make_copy_on_client(local_path, path, timestamp)
+            if not done:
+                self.observer.skip(self.absolutize_path(path))
+                if self.conn_mng.dispatch_request('download', {'filepath': path, 'md5': md5}):
+                    print 'Downloaded file with path "{}" INTO SYNC'.format(path)
+                    self.client_snapshot[path] = [timestamp, md5]
+                    self._index_file(path, md5, timestamp)
+                else:
+                    self.stop(1, 'Error during connection with the server. '
+                                 'Client fail to "download" this file: {}'.format(path))
+        if op == 'move':
+            self._make_delete_on_client(src)
+
+    def _sync_changes_with_server(self):
+        """
+        Apply the server changes after self.server_cursor, instead of comparing the whole snapshots.
+        All the pages of changes are got first, and merged (see sync_planner.merge_changes), so that only the last
+        state of every path is applied: e.g. a file created and then deleted is not downloaded at all.
+        Return False if the changes are not available, so the whole snapshots must be compared.
+        :return: bool
+        """
+        changes = []
+        cursor = self.server_cursor
+        while True:
+            response = self.conn_mng.dispatch_request('get_server_changes', {'since': cursor})
+            if not response or response.get('resync'):
+                return False
+            changes.extend(response['changes'])
+            cursor = response['cursor']
+            if not response['has_more']:
+                break
+        for change in merge_changes(changes):
+            self._apply_server_change(change)
+        self.server_cursor = cursor
+        if changes or response['server_timestamp'] != self.local_dir_state['last_timestamp']:
+            self.update_local_dir_state(response['server_timestamp'])
+        return True
 
     def sync_with_server(self):
         """
-        Makes the synchronization with server
+        Makes the synchronization with server.
+        After the first synchronization, only the server changes after the last one applied are got and applied
+        (the local changes are sent by the observer), unless the server can't tell them.
         """
+        if self.server_cursor is not None and self._sync_changes_with_server():
+            return
+
         response = self.conn_mng.dispatch_request('get_server_snapshot', '')
         if response is None:
             self.stop(1, '\nReceived None snapshot. Server down?\n')
 
         server_timestamp = response['server_timestamp']
         files = response['files']
+        # The changes made by the sync commands are after this cursor: they will be found already applied.
+        self.server_cursor = response.get('cursor')
 
         sync_commands = self._sync_process(server_timestamp, files)
 
-        # Initialize the variable where we put the timestamp of the last operation we did
+        # Initialize the variable where we put the timestamp of the last operation we did: the greatest server
+        # timestamp received, since the concurrent transfers end in any order (see _make_sync_commands)
         last_operation_timestamp = server_timestamp
 
-        # makes all synchronization commands
-        for command, path in sync_commands:
-            if command == 'delete':
-                event_timestamp = self.conn_mng.dispatch_request(command, {'filepath': path})
-                if event_timestamp:
-
-                    last_operation_timestamp = event_timestamp['server_timestamp']
-                    # If i can't find path inside client_snapshot there is inconsistent problem in client_snapshot!
-                    if self.client_snapshot.pop(path, 'ERROR') == 'ERROR':
-                        print 'Error during delete event INTO SYNC! Impossible to find "{}" inside client_snapshot'\
-                            .format(path)
-                else:
-                    self.stop(1,
-                              'Error during connection with the server. Server fail to "delete" this file: {}'.format(
-                                  path))
+        # makes all synchronization commands, the consecutive deletes, uploads of small files and downloads
+        # of new files at once
+        for group, commands in groupby(sync_commands, key=self._sync_command_group):
+            if group == 'delete':
+                last_operation_timestamp = max(last_operation_timestamp,
+                                               self._delete_on_server([path for command, path in commands]))
+            elif group == 'bundle':
+                last_operation_timestamp = self._upload_bundle_on_server(commands, files, last_operation_timestamp)
+            elif group == 'download_bundle':
+                last_operation_timestamp = self._download_bundle_from_server(
+                    [path for command, path in commands], files, last_operation_timestamp)
+            else:
+                last_operation_timestamp = self._make_sync_commands(commands, files, last_operation_timestamp)
 
-            elif command == 'modify' or command == 'upload':
+        self.update_local_dir_state(last_operation_timestamp)
 
-                new_md5 = self.hash_file(self.absolutize_path(path))
-                event_timestamp = self.conn_mng.dispatch_request(command, {'filepath': path, 'md5': new_md5})
-                if event_timestamp:
-                    last_operation_timestamp = event_timestamp['server_timestamp']
-                else:
-                    self.stop(1, 'Error during connection with the server. Server fail to "{}" this file: {}'.format(
-                        command, path))
+    def _sync_command_group(self, sync_command):
+        """
+        Return the group of the synchronization command, made at once with the consecutive ones of the same
+        group: 'delete', 'bundle' (for the uploads of files smaller than the bundle threshold), 'download_bundle'
+        (for the downloads of new files: the existing ones are updated one by one, with a delta if convenient)
+        or None.
+        """
+        command, path = sync_command
+        if command == 'delete':
+            return 'delete'
+        if command == 'download' and not os.path.exists(self.absolutize_path(path)):
+            return 'download_bundle'
+        if command in ('upload', 'modify'):
+            try:
+                if os.path.getsize(self.absolutize_path(path)) < self.conn_mng.bundle_threshold:
+                    return 'bundle'
+            except OSError:
+                pass
+        return None
 
-            else:  # command == 'download'
-                print 'skip di download'
-                self.observer.skip(self.absolutize_path(path))
-                connection_result = self.conn_mng.dispatch_request(command, {'filepath': path})
-                if connection_result:
+    def _upload_bundle_on_server(self, commands, files, last_operation_timestamp):
+        """
+        Upload (create or modify) the files of the <commands> on the server, in bundles (see
+        ConnectionManager.do_upload_bundle), then the ones left out of the bundles one by one.
+        Return the server timestamp of the last operation.
+        """
+        paths = [path for command, path in commands]
+        response = self.conn_mng.dispatch_request('upload_bundle', [
+            {'filepath': path, 'md5': self.hash_file(self.absolutize_path(path))} for path in paths])
+        if not response:
+            self.stop(1, 'Error during connection with the server. Server fail to "upload" {} files'.format(len(paths)))
+        results = response['results']
+        for path in paths:
+            if path in results and results[path] not in (200, 201):
+                self.stop(1, 'Error during connection with the server. Server fail to "upload" this file: {}'
+                          .format(path))
+        last_operation_timestamp = max(last_operation_timestamp,
+                                       response.get('server_timestamp', last_operation_timestamp))
+        # The files left out were not readable: the removed ones are skipped, since their deletion is synchronized
+        # as usual.
+        return self._make_sync_commands([(command, path) for command, path in commands
+                                         if path not in results and os.path.isfile(self.absolutize_path(path))],
+                                        files, last_operation_timestamp)
+
+    def _download_bundle_from_server(self, paths, files, last_operation_timestamp):
+        """
+        Download the new files <paths> from the server in a bundle (see ConnectionManager.do_download_bundle),
+        then the ones not in the bundle one by one. Return the server timestamp of the last operation.
+        """
+        for path in paths:
+            self.observer.skip(self.absolutize_path(path))
+        downloaded = self.conn_mng.dispatch_request('download_bundle', [{'filepath': path, 'md5': files[path][1]}
+                                                                        for path in paths]) or []
+        print 'Downloaded {} files INTO SYNC'.format(len(downloaded))
+        for path in downloaded:
+            self.client_snapshot[path] = files[path]
+            self._index_file(path, files[path][1], files[path][0])
+        downloaded = set(downloaded)
+        # The observer already skips the remaining paths
+        return self._make_sync_commands([('download', path) for path in paths if path not in downloaded], files,
+                                        last_operation_timestamp, skip=False)
+
+    def _delete_on_server(self, paths):
+        """
+        Delete the files <paths> on the server, in batches of BATCH_SIZE actions, and return the server timestamp
+        of the last one.
+        """
+        for start in range(0, len(paths), self.BATCH_SIZE):
+            batch = paths[start:start + self.BATCH_SIZE]
+            response = self.conn_mng.dispatch_request('batch_actions', [{'cmd': 'delete', 'filepath': path}
+                                                                        for path in batch])
+            if not response:
+                self.stop(1, 'Error during connection with the server. Server fail to "delete" {} files'.format(
+                    len(batch)))
+            for path, result in zip(batch, response['results']):
+                if result != 200:
+                    self.stop(1, 'Error during connection with the server. Server fail to "delete" this file: {}'
+                              .format(path))
+                # If i can't find path inside client_snapshot there is inconsistent problem in client_snapshot!
+                if self.client_snapshot.pop(path, 'ERROR') == 'ERROR':
+                    print 'Error during delete event INTO SYNC! Impossible to find "{}" inside client_snapshot'\
+                        .format(path)
+        return response['server_timestamp']
+
+    def _make_sync_commands(self, sync_commands, files, last_operation_timestamp, skip=True):
+        """
+        Make the synchronization commands (but delete) concurrently, in a pool of transfer_workers threads (see the
+        transfer_pool module), and return the server timestamp of the last one. The results are applied here, one
+        at a time, as they arrive. The downloaded paths are added to the observer skip list, if <skip>.
+        """
+        stored = self._stored_on_server([path for command, path in sync_commands if command != 'download'])
+        with TransferPool(self.cfg.get('transfer_workers', self.TRANSFER_WORKERS)) as pool:
+            for command, path in sync_commands:
+                if command == 'download':
+                    if skip:
+                        print 'skip di download'
+                        self.observer.skip(self.absolutize_path(path))
+                    pool.submit(path, self._transfer, command, path, files[path][1])
+                else:  # command == 'modify' or command == 'upload'
+                    pool.submit(path, self._transfer, command, path, stored.get(path), path in stored)
+
+            for path, (command, response) in pool.results():
+                if not response:
+                    self.stop(1, 'Error during connection with the server. {} fail to "{}" this file: {}'.format(
+                        'Client' if command == 'download' else 'Server', command, path))
+                if command == 'download':
                     print 'Downloaded file with path "{}" INTO SYNC'.format(path)
                     self.client_snapshot[path] = files[path]
+                    self._index_file(path, files[path][1], files[path][0])
                 else:
-                    self.stop(1,
-                              'Error during connection with the server. Client fail to "download" this file: {}'.format(
-                                  path))
+                    # The results arrive in any order
+                    last_operation_timestamp = max(last_operation_timestamp, response['server_timestamp'])
+        return last_operation_timestamp
 
-        self.update_local_dir_state(last_operation_timestamp)
+    def _stored_on_server(self, paths):
+        """
+        Return the md5 of the files to upload <paths> whose content is already stored on the server, so they can be
+        uploaded by reference (see ConnectionManager._upload_by_reference): {<path>: <md5>}.
+        Only the files big enough to be uploaded by reference are checked, all of them in one request.
+        :return: dict
+        """
+        md5s = {}
+        for path in paths:
+            try:
+                if os.path.getsize(self.absolutize_path(path)) < self.conn_mng.upload_by_reference_threshold:
+                    continue
+            except OSError:
+                continue
+            md5s[path] = self.hash_file(self.absolutize_path(path))
+        if not md5s:
+            return {}
+        existing = set(self.conn_mng.dispatch_request('blobs_exist', {'md5': sorted(set(md5s.values()))}) or [])
+        return {path: md5 for path, md5 in md5s.iteritems() if md5 in existing}
+
+    def _transfer(self, command, path, md5=None, stored=False):
+        """
+        Make the transfer <command> ('download', 'upload' or 'modify') of the file <path> with the server, and
+        return (<command>, <response>). It runs in a transfer pool thread, so it must not change the daemon state:
+        the md5 of an uploaded file is taken from the file index, or computed, here, since that's thread safe.
+        <stored>: the content of the file to upload is already stored on the server (see _stored_on_server).
+        """
+        if md5 is None:
+            md5 = self.hash_file(self.absolutize_path(path))
+        data = {'filepath': path, 'md5': md5}
+        if stored:
+            data['stored'] = True
+        return command, self.conn_mng.dispatch_request(command, data)
 
     def relativize_path(self, abs_path):
         """
@@ -700,6 +884,7 @@ class Daemon(RegexMatchingEventHandler):
         Intial operation for observing.
         We create the client_snapshot, load the information stored inside local_dir_state and create observer.
         """
+        self.open_file_index()
         self.build_client_snapshot()
         self.load_local_dir_state()
         self.create_observer()
@@ -733,6 +918,37 @@ class Daemon(RegexMatchingEventHandler):
                     self._initialize_observing()
             self._set_cmdmanager_response(s, response)
 
+    def _listen_server_events(self):
+        """
+        Events listener thread: long-poll the server for changes after the last cursor applied, and wake the main
+        loop when there is one, writing in the events pipe.
+        """
+        while self.running:
+            since = self.server_cursor
+            if not self.cfg.get('activate', False) or since is None:
+                # Not synchronized yet
+                time.sleep(self.EVENTS_RETRY_DELAY)
+                continue
+            response = self.conn_mng.dispatch_request('wait_server_events',
+                                                      {'since': since, 'timeout': Daemon.EVENTS_TIMEOUT})
+            self.events_available = response is not None
+            if response is None:
+                time.sleep(self.EVENTS_RETRY_DELAY)
+            elif response['cursor'] != since:
+                self.server_synced.clear()
+                os.write(self.events_pipe[1], 'e')
+                self.server_synced.wait(Daemon.EVENTS_TIMEOUT)
+                if self.server_cursor == since:
+                    # The synchronization failed: don't retry it at once
+                    time.sleep(self.EVENTS_RETRY_DELAY)
+
+    def _start_events_listener(self):
+        self.events_pipe = os.pipe()
+        events_thread = threading.Thread(target=self._listen_server_events, name='events listener')
+        events_thread.daemon = True
+        events_thread.start()
+        return events_thread
+
     def start(self):
         """
         Starts the communication with the command_manager.
@@ -747,10 +963,11 @@ class Daemon(RegexMatchingEventHandler):
         self.listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.listener_socket.bind((self.cfg['cmd_address'], self.cfg['cmd_port']))
         self.listener_socket.listen(BACKLOG_LISTENER_SOCK)
-        r_list = [self.listener_socket]
         self.daemon_state = 'started'
         self.running = 1
-        polling_counter = 0
+        self._start_events_listener()
+        r_list = [self.listener_socket, self.events_pipe[0]]
+        last_sync_time = time.time()
         try:
             while self.running:
                 r_ready, w_ready, e_ready = select.select(r_list, [], [], TIMEOUT_LISTENER_SOCK)
@@ -761,6 +978,12 @@ class Daemon(RegexMatchingEventHandler):
                         # handle the server socket
                         client_socket, client_address = self.listener_socket.accept()
                         r_list.append(client_socket)
+                    elif s == self.events_pipe[0]:
+                        # the server notified a change
+                        os.read(s, 1024)
+                        self.sync_with_server()
+                        last_sync_time = time.time()
+                        self.server_synced.set()
                     else:
                         # handle all other sockets
                         req = self._get_cmdmanager_request(s)
@@ -773,6 +996,9 @@ class Daemon(RegexMatchingEventHandler):
                                 else:
                                     if not self.cfg.get('activate', False):
                                         self._activation_check(s, cmd, data)
+                                    elif cmd == 'plan':
+                                        # dry-run of the synchronization with the server
+                                        self._set_cmdmanager_response(s, self.sync_plan())
                                     else:  # client is already activated
                                         response = self.conn_mng.dispatch_request(cmd, data)
                                         # for now the protocol is that for request sent by
@@ -787,12 +1013,11 @@ class Daemon(RegexMatchingEventHandler):
                             r_list.remove(s)
 
                 if self.cfg.get('activate', False):
-                    # synchronization polling
-                    # makes the polling every 3 seconds, so it waits six cycle (0.5 * 6 = 3 seconds)
-                    # maybe optimizable but now functional
-                    polling_counter += 1
-                    if polling_counter == 6:
-                        polling_counter = 0
+                    # synchronization polling, just for safety if the server notifies its changes
+                    polling_interval = Daemon.SAFETY_POLLING_INTERVAL if self.events_available \
+                        else Daemon.POLLING_INTERVAL
+                    if time.time() - last_sync_time >= polling_interval:
+                        last_sync_time = time.time()
                         self.sync_with_server()
 
         except KeyboardInterrupt:
@@ -822,7 +1047,28 @@ class Daemon(RegexMatchingEventHandler):
 
         self.local_dir_state['last_timestamp'] = last_timestamp
         self.local_dir_state['global_md5'] = self.md5_of_client_snapshot()
-        self.save_local_dir_state()
+        self.local_dir_state['version'] = self.LOCAL_DIR_STATE_VERSION
+        if self._local_dir_state_save_deferred:
+            self._local_dir_state_unsaved = True
+        else:
+            self.save_local_dir_state()
+
+    @contextmanager
+    def _deferred_local_dir_state_save(self):
+        """
+        Context manager saving local_dir_state once at the end, instead of at every update_local_dir_state.
+        """
+        if self._local_dir_state_save_deferred:
+            yield
+            return
+        self._local_dir_state_save_deferred = True
+        try:
+            yield
+        finally:
+            self._local_dir_state_save_deferred = False
+            if self._local_dir_state_unsaved:
+                self._local_dir_state_unsaved = False
+                self.save_local_dir_state()
 
     def save_local_dir_state(self):
         """
@@ -838,45 +1084,70 @@ class Daemon(RegexMatchingEventHandler):
         """
 
         def _rebuild_local_dir_state():
-            self.local_dir_state = {'last_timestamp': 0, 'global_md5': self.md5_of_client_snapshot()}
+            self.local_dir_state = {'last_timestamp': 0, 'global_md5': self.md5_of_client_snapshot(),
+                                    'version': self.LOCAL_DIR_STATE_VERSION}
             json.dump(self.local_dir_state, open(self.cfg['local_dir_state_path'], "w"), indent=4)
 
         if os.path.isfile(self.cfg['local_dir_state_path']):
             self.local_dir_state = json.load(open(self.cfg['local_dir_state_path'], "r"))
             print "Loaded local_dir_state"
+            if self.local_dir_state.get('version') != self.LOCAL_DIR_STATE_VERSION:
+                self._migrate_local_dir_state()
         else:
             print "local_dir_state not found. Initialize new local_dir_state"
             _rebuild_local_dir_state()
 
-    def md5_of_client_snapshot(self, verbose=0):
+    def _migrate_local_dir_state(self):
         """
-        Calculate the md5 of the entire directory snapshot,
-        with the md5 in client_snapshot and the md5 of full filepath string.
-        :return is the md5 hash of the directory
+        Convert the loaded local_dir_state from the old format, whose global md5 is the legacy digest of the
+        snapshot (see client_snapshot.legacy_digest): if it's still the one of the current snapshot, the folder
+        is not modified, and it's replaced by the current digest.
         """
+        if self.local_dir_state.get('global_md5') == legacy_digest(self.client_snapshot):
+            self.local_dir_state['global_md5'] = self.md5_of_client_snapshot()
+        else:
+            # Modified while the daemon was down
+            self.local_dir_state['global_md5'] = None
+        self.local_dir_state['version'] = self.LOCAL_DIR_STATE_VERSION
+        self.save_local_dir_state()
+        print "local_dir_state migrated to version {}".format(self.LOCAL_DIR_STATE_VERSION)
 
-        if verbose:
-            start = time.time()
-        md5Hash = hashlib.md5()
-
-        for path, time_md5 in sorted(self.client_snapshot.iteritems()):
-            # extract md5 from tuple. we don't need hexdigest it's already md5
-            if verbose:
-                print path
-            md5Hash.update(time_md5[1])
-            md5Hash.update(path)
-
-        if verbose:
-            stop = time.time()
-            print stop - start
-        return md5Hash.hexdigest()
+    def md5_of_client_snapshot(self):
+        """
+        Return the digest of the entire directory snapshot, kept up to date by the snapshot at every change
+        (see the client_snapshot module).
+        :return is the md5 hash of the directory
+        """
+        return self.client_snapshot.digest()
 
-    def hash_file(self, file_path, chunk_size=1024):
+    def hash_file(self, file_path, chunk_size=2 ** 16):
         """
         :accept an absolute file path
         :return the md5 hash of received file
+        The md5 of a file of the sharing folder is taken from the file index if the file is not changed since
+        it has been indexed, otherwise it's indexed.
+        """
+        try:
+            st = os.stat(file_path)
+            path = self.relativize_path(file_path)
+        except OSError as e:
+            print e
+            return None
+        except Exception:
+            # Not in the sharing folder
+            return self._file_md5(file_path, chunk_size)
+        entry = self.file_index.get(path)
+        if entry is not None and entry.matches(st):
+            return entry.md5
+        md5 = self._file_md5(file_path, chunk_size)
+        if md5 is not None and self._is_unchanged(file_path, st):
+            self.file_index.set(path, st, md5)
+        return md5
+
+    def _file_md5(self, file_path, chunk_size=2 ** 16):
+        """
+        Return the md5 of the file <file_path>, reading it, or None if it can't be read.
         """
-
         md5Hash = hashlib.md5()
         try:
             f1 = open(file_path, 'rb')
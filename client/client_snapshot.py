@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Snapshot of the sharing folder, with a digest of its content kept up to date at every change.
+
+The digest tells if the folder has been modified since the last synchronization (see Daemon.local_dir_state).
+It must not depend on the order of the files, and it must be updated without going through the whole snapshot:
+so it's the sum (modulo 2 ** 128) of the md5 of every entry (the path and the md5 of the file), and adding,
+removing or changing a file just adds or subtracts the md5 of its entry.
+
+The snapshot keeps also the paths of every md5 (see paths_by_md5), to find at once if a file is a copy or a move
+of a file already in the folder.
+"""
+import hashlib
+
+DIGEST_MODULUS = 2 ** 128
+
+
+def entry_hash(path, md5):
+    """
+    Return the hash of the snapshot entry of the file <path> with the given <md5>, as an int.
+    :return: long
+    """
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return long(hashlib.md5('{}\0{}'.format(path, md5)).hexdigest(), 16)
+
+
+def legacy_digest(snapshot):
+    """
+    Return the digest of the <snapshot> ({<path>: [<timestamp>, <md5>]}) of the old local_dir_state format:
+    the md5 of all the file md5 and paths, sorted by path.
+    :return: str
+    """
+    md5_hash = hashlib.md5()
+    for path, (timestamp, md5) in sorted(snapshot.iteritems()):
+        md5_hash.update(md5)
+        md5_hash.update(path)
+    return md5_hash.hexdigest()
+
+
+class ClientSnapshot(dict):
+    """
+    Snapshot of the sharing folder, {<path>: [<timestamp>, <md5>]}, with its digest (see digest()) and the
+    paths of every md5 (see paths_by_md5()).
+    NB: the entries must be replaced, not changed in place, or the digest and the md5 paths are not updated.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self._digest = 0
+        self._paths_by_md5 = {}
+        self.update(*args, **kwargs)
+
+    def _add(self, path, entry):
+        self._digest = (self._digest + entry_hash(path, entry[1])) % DIGEST_MODULUS
+        self._paths_by_md5.setdefault(entry[1], set()).add(path)
+
+    def _remove(self, path, entry):
+        self._digest = (self._digest - entry_hash(path, entry[1])) % DIGEST_MODULUS
+        paths = self._paths_by_md5[entry[1]]
+        paths.discard(path)
+        if not paths:
+            del self._paths_by_md5[entry[1]]
+
+    def __setitem__(self, path, entry):
+        old_entry = self.get(path)
+        if old_entry is not None:
+            self._remove(path, old_entry)
+        dict.__setitem__(self, path, entry)
+        self._add(path, entry)
+
+    def __delitem__(self, path):
+        self._remove(path, self[path])
+        dict.__delitem__(self, path)
+
+    def pop(self, path, *default):
+        if path not in self:
+            return dict.pop(self, path, *default)
+        entry = dict.pop(self, path)
+        self._remove(path, entry)
+        return entry
+
+    def popitem(self):
+        path, entry = dict.popitem(self)
+        self._remove(path, entry)
+        return path, entry
+
+    def setdefault(self, path, entry=None):
+        if path not in self:
+            self[path] = entry
+        return self[path]
+
+    def update(self, *args, **kwargs):
+        for path, entry in dict(*args, **kwargs).iteritems():
+            self[path] = entry
+
+    def clear(self):
+        dict.clear(self)
+        self._digest = 0
+        self._paths_by_md5.clear()
+
+    def copy(self):
+        snapshot = ClientSnapshot()
+        dict.update(snapshot, self)
+        snapshot._digest = self._digest
+        snapshot._paths_by_md5 = {md5: set(paths) for md5, paths in self._paths_by_md5.iteritems()}
+        return snapshot
+
+    def paths_by_md5(self, md5):
+        """
+        Return the sorted list of the paths of the files with the given <md5>.
+        :return: list
+        """
+        return sorted(self._paths_by_md5.get(md5, ()))
+
+    def digest(self):
+        """
+        Return the digest of the snapshot, as an hexadecimal string.
+        :return: str
+        """
+        return '{:032x}'.format(self._digest)
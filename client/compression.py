@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compression of the transferred file bodies (HTTP content codings).
+
+Codecs are registered by their content-coding name (see register_codec): gzip and deflate, from zlib, are
+available by default. A codec only has to create streaming compressor and decompressor objects, with the
+interface of zlib's ones (compress/decompress and flush).
+
+Compression is worth it only for compressible files of some size: should_compress() skips small files,
+files whose name tells they are already compressed, and files whose first block doesn't shrink.
+
+NB: this module is used by both the server and the client, and must be kept identical in both directories.
+"""
+import os
+import zlib
+from collections import OrderedDict
+
+# Files smaller than this are never compressed
+MIN_SIZE = 2 ** 12
+# Size of the first block of a file compressed to probe if the file is compressible
+PROBE_SIZE = 2 ** 16
+# A file is compressible if its first block is compressed to less than this fraction
+PROBE_MAX_RATIO = 0.9
+CHUNK_SIZE = 2 ** 16
+
+# Extensions of files already compressed
+COMPRESSED_EXTENSIONS = frozenset((
+    '.gz', '.tgz', '.bz2', '.tbz2', '.xz', '.txz', '.lz', '.lzma', '.zst', '.z', '.zip', '.rar', '.7z', '.cab',
+    '.jar', '.war', '.apk', '.deb', '.rpm', '.dmg', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp3', '.aac', '.ogg', '.oga', '.opus', '.flac', '.m4a',
+    '.mp4', '.m4v', '.mkv', '.avi', '.mov', '.webm', '.wmv', '.flv',
+))
+
+
+class Codec(object):
+    """
+    Content coding. Subclasses must set the content-coding <name> and create the streaming compressor and
+    decompressor objects.
+    """
+    name = None
+
+    def compressor(self):
+        raise NotImplementedError
+
+    def decompressor(self):
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+    """
+    zlib based codec, <wbits> selects the format (see zlib.compressobj).
+    """
+    def __init__(self, name, wbits, level=6):
+        self.name = name
+        self.wbits = wbits
+        self.level = level
+
+    def compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, self.wbits)
+
+    def decompressor(self):
+        return zlib.decompressobj(self.wbits)
+
+
+_codecs = OrderedDict()
+
+
+def register_codec(codec):
+    """
+    Make <codec> available (replacing the registered codec with its name, if any).
+    The codecs registered first are preferred.
+    :param codec: Codec
+    """
+    _codecs[codec.name] = codec
+
+
+def get_codec(name):
+    """
+    Return the registered codec with content-coding <name>, or None.
+    :return: Codec
+    """
+    return _codecs.get(name.strip().lower())
+
+
+def codec_names():
+    """
+    Return the names of the registered codecs, preferred first.
+    :return: list
+    """
+    return list(_codecs)
+
+
+register_codec(ZlibCodec('gzip', 16 + zlib.MAX_WBITS))
+register_codec(ZlibCodec('deflate', zlib.MAX_WBITS))
+
+
+def should_compress(fp, size, filename=''):
+    """
+    Return True if the file <fp> (of <size> bytes, named <filename>) is worth compressing.
+    The first block of the file is read, and the file is moved back to its current position.
+    :param fp: file (seekable)
+    :return: bool
+    """
+    if size < MIN_SIZE or os.path.splitext(filename)[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+    position = fp.tell()
+    block = fp.read(PROBE_SIZE)
+    fp.seek(position)
+    compressor = zlib.compressobj(1)
+    compressed_size = len(compressor.compress(block)) + len(compressor.flush())
+    return compressed_size < len(block) * PROBE_MAX_RATIO
+
+
+def iter_compressed(fp, codec, chunk_size=CHUNK_SIZE):
+    """
+    Yield the content of the file <fp> compressed with <codec>, and close the file at the end.
+    """
+    try:
+        compressor = codec.compressor()
+        for chunk in iter(lambda: fp.read(chunk_size), ''):
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        fp.close()
+
+
+def compress_file(src, dst, codec, chunk_size=CHUNK_SIZE):
+    """
+    Write in <dst> the content of the file <src> compressed with <codec>.
+    """
+    compressor = codec.compressor()
+    for chunk in iter(lambda: src.read(chunk_size), ''):
+        dst.write(compressor.compress(chunk))
+    dst.write(compressor.flush())
+
+
+def decompress_file(src, dst, codec, chunk_size=CHUNK_SIZE):
+    """
+    Write in <dst> the content of the file <src> decompressed with <codec>.
+    Raise ValueError if the data is corrupted.
+    """
+    decompressor = codec.decompressor()
+    try:
+        for chunk in iter(lambda: src.read(chunk_size), ''):
+            dst.write(decompressor.decompress(chunk))
+        dst.write(decompressor.flush())
+    except zlib.error as e:
+        raise ValueError('Corrupted {} data: {}'.format(codec.name, e))
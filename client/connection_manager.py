@@ -3,15 +3,35 @@
 
 # API:
 #
+# sessions:
+# - POST /sessions - scambia le credenziali con un token di sessione, da usare al posto della password
 # files:
 # - GET /files/ - ottiene la lista dei file sul server con relativi metadati necessari e/o md5
+# - GET /files/?since=<cursor> - ottiene solo le modifiche successive al cursore
+# - GET /events?since=<cursor>&timeout=<s> - attende (long-poll) una modifica successiva al cursore
 # - GET /files/<path> - scarica un file
 # - POST /files/<path> - crea un file
 # - PUT /files/<path> - modifica un file
+# - POST/PUT /files/<path> senza file, parametri md5, size - crea/modifica un file con un contenuto
+#   già presente tra i file dell'utente
+# - GET /signatures/<path> - ottiene la firma a blocchi di un file, per inviarne le modifiche come delta
+# - PUT /files/<path> con il file 'delta' al posto di 'file', parametro md5 - modifica un file inviando solo un delta
+# - POST /bundles/ - archivio tar di più file, con il loro md5 nell'header PAX PYBOX.md5, li crea/modifica tutti
+# - POST /bundles/download - parametri path (ripetuto) e/o prefix (directory), scarica i file in un archivio tar
+# - POST /deltas/<path> - parametro signature (firma del file locale), scarica il delta per aggiornare il file locale
+# blobs:
+# - POST /blobs/exists - parametro md5 (ripetuto), restituisce gli md5 dei contenuti già presenti tra i file
+#   dell'utente
+# uploads (file grandi, a pezzi):
+# - POST /uploads/ - apre una sessione di upload, parametri path, size, md5, replace
+# - PUT /uploads/<upload_id>/<index> - invia un pezzo del file
+# - GET /uploads/<upload_id> - ottiene i pezzi ricevuti
+# - POST /uploads/<upload_id> - completa l'upload
 # actions:
 # - POST /actions/copy - parametri src, dest
 # - POST /actions/delete - parametro path
 # - POST /actions/move - parametri src, dest
+# - POST /actions/batch - parametro actions (lista json di azioni), le esegue tutte insieme
 # ---------
 # shares:
 # - POST /shares/<root_path>/<user> - crea (se necessario) lo share, e l’utente che “vede” la condivisione
@@ -22,6 +42,91 @@ import requests
 import json
 import os
 import logging
+import time
+import hashlib
+import tempfile
+import tarfile
+import threading
+import uuid
+
+import delta
+import compression
+from transfer_pool import TransferPool
+
+# Seconds before its expiration when the session token is considered expired and it's renewed
+SESSION_TOKEN_MARGIN = 60
+# Seconds before asking again for a session token after failing to get one (e.g. the server does not support them):
+# meanwhile the password is used
+SESSION_TOKEN_RETRY_INTERVAL = 300
+# Files are downloaded in a partial file with this suffix, moved to the actual path only when complete
+# and verified, and resumed from their current length after a failure.
+PARTIAL_DOWNLOAD_SUFFIX = '.pybox.part'
+# Max number of attempts to complete a download
+DOWNLOAD_ATTEMPTS = 3
+DOWNLOAD_CHUNK_SIZE = 2 ** 16
+# Files bigger than this are uploaded in chunks with an upload session (changeable with the
+# 'upload_session_threshold' configuration key)
+UPLOAD_SESSION_THRESHOLD = 2 ** 24
+# Max number of attempts to send all the chunks of an upload session
+UPLOAD_ATTEMPTS = 3
+# Max number of chunks of an upload session sent concurrently
+UPLOAD_SESSION_WORKERS = 4
+# Files at least this big are first uploaded by reference (only their md5, if the server already has their content),
+# smaller ones are just sent (changeable with the 'upload_by_reference_threshold' configuration key)
+UPLOAD_BY_REFERENCE_THRESHOLD = 2 ** 16
+# Modifications of files at least this big are sent and received as deltas (see the delta module), if convenient
+# (changeable with the 'delta_threshold' configuration key)
+DELTA_THRESHOLD = 2 ** 20
+# A delta is not convenient if the data to send in it would be more than this fraction of the file
+DELTA_MAX_LITERAL_RATIO = 0.5
+# Files smaller than this are uploaded many at once in a tar archive, a bundle (changeable with the
+# 'bundle_threshold' configuration key). A bundle has at most BUNDLE_MAX_FILES files and about BUNDLE_MAX_SIZE bytes.
+BUNDLE_THRESHOLD = 2 ** 16
+BUNDLE_MAX_FILES = 1000
+BUNDLE_MAX_SIZE = 2 ** 24
+# PAX header of every file in a bundle with its md5 (see Bundles in the server)
+BUNDLE_MD5_HEADER = 'PYBOX.md5'
+# Seconds to wait for the server response to a long-poll of the events, beyond the long-poll timeout
+EVENTS_READ_MARGIN = 10
+
+
+def calculate_file_md5(filepath, chunk_len=2 ** 16):
+    """
+    Return the md5 hexdigest of the file <filepath>.
+    """
+    h = hashlib.md5()
+    with open(filepath, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_len), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class CompressedUploadBody(object):
+    """
+    multipart/form-data request body with the form <fields> and the 'file' field with the content of <filepath>
+    compressed with <codec>. The file is compressed while it's sent (chunked, see compression.iter_compressed),
+    neither read in memory nor written compressed first. Every iteration reads the file again, so the request
+    can be retried.
+    """
+    def __init__(self, fields, filepath, codec):
+        self.fields = fields
+        self.filepath = filepath
+        self.codec = codec
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def __iter__(self):
+        for name, value in sorted(self.fields.iteritems()):
+            yield '--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(self.boundary, name, value)
+        yield ('--{}\r\nContent-Disposition: form-data; name="file"; filename="file"\r\n'
+               'Content-Type: application/octet-stream\r\n\r\n'.format(self.boundary))
+        chunks = compression.iter_compressed(open(self.filepath, 'rb'), self.codec)
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            chunks.close()
+        yield '\r\n--{}--\r\n'.format(self.boundary)
 
 
 class ConnectionManager(object):
@@ -31,6 +136,10 @@ class ConnectionManager(object):
                         )
 
     def __init__(self, cfg, logging_level=logging.ERROR):
+        # The requests can be made by many threads (see the transfer_pool module): each one keeps its own
+        # requests session, so its connections to the server are reused (see self._session)
+        self._local = threading.local()
+        self._auth_lock = threading.Lock()
         self.load_cfg(cfg)
 
         self.logger = logging.getLogger("ConMng")
@@ -63,6 +172,18 @@ class ConnectionManager(object):
         """
         self.cfg = cfg
         self.auth = (self.cfg.get('user', None), self.cfg.get('pass', None))
+        # The session token is requested at the first authenticated request (see self._get_auth)
+        self.session_token = None
+        self.session_token_expiration = 0
+        # Time before which no session token is asked, after failing to get one
+        self.session_token_retry = 0
+        # Content codings accepted by the server for the uploaded files, learned from its responses
+        # (see self._authenticated_request)
+        self.server_encodings = []
+        # ETag and body of the last server snapshot received, sent again if the server answers that the
+        # snapshot is not modified (see self.do_get_server_snapshot)
+        self.snapshot_etag = None
+        self.snapshot_text = None
 
         # example of self.base_url = 'http://localhost:5000/API/V1/'
         self.base_url = ''.join([self.cfg['server_address'], self.cfg['api_suffix']])
@@ -70,6 +191,74 @@ class ConnectionManager(object):
         self.actions_url = ''.join([self.base_url, 'actions/'])
         self.shares_url = ''.join([self.base_url, 'shares/'])
         self.users_url = ''.join([self.base_url, 'users/'])
+        self.sessions_url = ''.join([self.base_url, 'sessions'])
+        self.uploads_url = ''.join([self.base_url, 'uploads/'])
+        self.blobs_url = ''.join([self.base_url, 'blobs/'])
+        self.signatures_url = ''.join([self.base_url, 'signatures/'])
+        self.deltas_url = ''.join([self.base_url, 'deltas/'])
+        self.events_url = ''.join([self.base_url, 'events'])
+        self.bundles_url = ''.join([self.base_url, 'bundles/'])
+        self.upload_session_threshold = self.cfg.get('upload_session_threshold', UPLOAD_SESSION_THRESHOLD)
+        self.upload_by_reference_threshold = self.cfg.get('upload_by_reference_threshold',
+                                                          UPLOAD_BY_REFERENCE_THRESHOLD)
+        self.delta_threshold = self.cfg.get('delta_threshold', DELTA_THRESHOLD)
+        self.bundle_threshold = self.cfg.get('bundle_threshold', BUNDLE_THRESHOLD)
+
+    def _get_auth(self):
+        """
+        Return the (user, session token) authentication, getting a new session token from the server
+        if there isn't one or it's expiring, so the server does not verify the password at every request.
+        If the token can't be obtained, return the (user, password) authentication, without asking for a token
+        again for SESSION_TOKEN_RETRY_INTERVAL seconds.
+        :return: tuple
+        """
+        # Only one thread at a time gets a new token, the others wait for it
+        with self._auth_lock:
+            if self.session_token and time.time() < self.session_token_expiration:
+                return self.auth[0], self.session_token
+            self.session_token = None
+            if time.time() < self.session_token_retry:
+                return self.auth
+            try:
+                r = self._session().post(self.sessions_url, auth=self.auth)
+                r.raise_for_status()
+                session = json.loads(r.text)
+            except ConnectionManager.EXCEPTIONS_CATCHED + (ValueError,) as e:
+                self.logger.warning('_get_auth: URL: {} - EXCEPTION_CATCHED: {} '.format(self.sessions_url, e))
+                self.session_token_retry = time.time() + SESSION_TOKEN_RETRY_INTERVAL
+                return self.auth
+            self.session_token = session['token']
+            self.session_token_expiration = time.time() + session['expires_in'] - SESSION_TOKEN_MARGIN
+            return self.auth[0], self.session_token
+
+    def _session(self):
+        """
+        Return the requests session of the current thread, which keeps its connections to the server open.
+        :return: requests.Session
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _authenticated_request(self, method, url, **kwargs):
+        """
+        Make an authenticated request with the given requests <method> name.
+        If the session token is refused (e.g. the server has been restarted), the request is retried once
+        with a new session token.
+        :return: requests.Response
+        """
+        r = getattr(self._session(), method)(url, auth=self._get_auth(), **kwargs)
+        if r.status_code == 401 and self.session_token:
+            self.session_token = None
+            for fp in kwargs.get('files', {}).values():
+                fp.seek(0)
+            if hasattr(kwargs.get('data'), 'seek'):
+                kwargs['data'].seek(0)
+            r = getattr(self._session(), method)(url, auth=self._get_auth(), **kwargs)
+        if 'Accept-Encoding' in r.headers:
+            self.server_encodings = [name.strip() for name in r.headers['Accept-Encoding'].split(',')]
+        return r
 
     def dispatch_request(self, command, args=None):
         method_name = ''.join(['do_', command])
@@ -154,57 +343,417 @@ class ConnectionManager(object):
     # files
 
     def do_download(self, data):
+        """
+        Download the file data['filepath'].
+        The file is written in a partial file, which is resumed (HTTP Range request) after a failure
+        or if it already exists, and moved to its actual path when complete.
+        If data['md5'] is given, the downloaded file is verified before moving it.
+        """
         url = ''.join([self.files_url, data['filepath']])
         self.logger.info('{}: URL: {} - DATA: {} '.format('do_download', url, data))
+        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        part_filepath = ''.join([filepath, PARTIAL_DOWNLOAD_SUFFIX])
+        md5 = data.get('md5')
+        dirpath = os.path.dirname(filepath)
+        if not os.path.isdir(dirpath):
+            # Create all missing directories
+            os.makedirs(dirpath)
+
+        # A modified file is updated with a delta, if convenient.
+        if md5 and os.path.isfile(filepath) and not os.path.isfile(part_filepath) \
+                and os.path.getsize(filepath) >= self.delta_threshold \
+                and self._download_delta(data, filepath, part_filepath):
+            os.rename(part_filepath, filepath)
+            return True
+
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            headers = {}
+            # Without the md5 it's impossible to know if the partial file is of the same version of the server file.
+            if md5 and os.path.isfile(part_filepath):
+                headers['Range'] = 'bytes={}-'.format(os.path.getsize(part_filepath))
+                headers['If-Range'] = '"{}"'.format(md5)
+            try:
+                r = self._authenticated_request('get', url, headers=headers, stream=True)
+                # 416: the partial file is already complete (or it's broken, and the md5 check will remove it)
+                if r.status_code != 416:
+                    r.raise_for_status()
+                    with open(part_filepath, 'ab' if r.status_code == 206 else 'wb') as f:
+                        for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+            except (requests.HTTPError, requests.exceptions.MissingSchema) as e:
+                self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_download', url, e))
+                return False
+            except requests.exceptions.RequestException as e:
+                # The download will be resumed
+                self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_download', url, e))
+                continue
+            if md5 and calculate_file_md5(part_filepath) != md5:
+                self.logger.error('{}: URL: {} - md5 of downloaded file doesn\'t match'.format('do_download', url))
+                os.remove(part_filepath)
+                continue
+            os.rename(part_filepath, filepath)
+            return True
+        return False
+
+    def _download_delta(self, data, filepath, part_filepath):
+        """
+        Write in <part_filepath> the new version of the file data['filepath'], rebuilt from the local
+        file <filepath> and the delta sent by the server, and verify it with data['md5'].
+        Return False if the delta is not available or convenient, or the rebuilt file is wrong.
+        :return: bool
+        """
+        url = ''.join([self.deltas_url, data['filepath']])
+        self.logger.info('{}: URL: {} - DATA: {} '.format('_download_delta', url, data))
+        try:
+            with open(filepath, 'rb') as basis:
+                sig = delta.signature(basis, delta.block_size_for(os.fstat(basis.fileno()).st_size))
+            r = self._authenticated_request('post', url, data={'signature': json.dumps(sig)}, stream=True)
+            r.raise_for_status()
+            with tempfile.TemporaryFile() as delta_file:
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    delta_file.write(chunk)
+                delta_file.seek(0)
+                with open(filepath, 'rb') as basis:
+                    with open(part_filepath, 'wb') as out:
+                        delta.apply_delta(basis, delta_file, out)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # Usually 412 Precondition Failed: most of the file is changed
+            self.logger.info('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('_download_delta', url, e))
+        else:
+            if calculate_file_md5(part_filepath) == data['md5']:
+                return True
+            self.logger.error('{}: URL: {} - md5 of rebuilt file doesn\'t match'.format('_download_delta', url))
+        if os.path.isfile(part_filepath):
+            os.remove(part_filepath)
+        return False
+
+    def _upload_session(self, data, replace):
+        """
+        Upload the file data['filepath'] in chunks, with an upload session.
+        The chunks are sent concurrently, UPLOAD_SESSION_WORKERS at a time (see the transfer_pool module), and
+        the ones not received by the server (e.g. after a connection error) are sent again, up to UPLOAD_ATTEMPTS
+        times.
+        Return the server response like do_upload and do_modify.
+        :param replace: bool (True if the file modifies an existing one)
+        """
+        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        self.logger.info('{}: URL: {} - DATA: {} '.format('_upload_session', self.uploads_url, data))
         try:
-            r = requests.get(url, auth=self.auth)
+            r = self._authenticated_request('post', self.uploads_url,
+                                            data={'path': data['filepath'], 'size': os.path.getsize(filepath),
+                                                  'md5': data['md5'], 'replace': replace})
+            r.raise_for_status()
+            session = json.loads(r.text)
+            upload_url = ''.join([self.uploads_url, session['upload_id']])
+            chunk_size = session['chunk_size']
+
+            received = []
+            for attempt in range(UPLOAD_ATTEMPTS):
+                with TransferPool(UPLOAD_SESSION_WORKERS) as pool:
+                    for index in range(session['chunks']):
+                        if index not in received:
+                            pool.submit(index, self._send_chunk, upload_url, filepath, index, chunk_size)
+                    # The chunks not sent are found below
+                    for index, sent in pool.results():
+                        pass
+                r = self._authenticated_request('get', upload_url)
+                r.raise_for_status()
+                received = json.loads(r.text)['received']
+                if len(received) == session['chunks']:
+                    break
+
+            # Commit the upload (the server checks that all chunks has been received)
+            r = self._authenticated_request('post', upload_url)
             r.raise_for_status()
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
-            self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_download', url, e))
+            self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('_upload_session', self.uploads_url, e))
         else:
-            filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
-            dirpath, filename = os.path.split(filepath)
-            if not os.path.isdir(dirpath):
-                # Create all missing directories
-                os.makedirs(dirpath)
-            with open(filepath, 'wb') as f:
-                f.write(r.content)
-            return True
+            return json.loads(r.text)
         return False
 
-    def do_upload(self, data):
+    def _send_chunk(self, upload_url, filepath, index, chunk_size):
+        """
+        Send the chunk <index> of the file <filepath> to the upload session <upload_url>, and return True if it's
+        received. It runs in a transfer pool thread, so the file is read with its own file object.
+        :return: bool
+        """
+        try:
+            with open(filepath, 'rb') as f:
+                f.seek(index * chunk_size)
+                r = self._authenticated_request('put', '{}/{}'.format(upload_url, index), data=f.read(chunk_size))
+            r.raise_for_status()
+        except ConnectionManager.EXCEPTIONS_CATCHED as e:
+            self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('_send_chunk', upload_url, e))
+            return False
+        return True
+
+    def _upload_by_reference(self, data, method):
+        """
+        Try to create (method 'post') or modify (method 'put') the file data['filepath'] without sending it,
+        from the content with its md5 already stored on the server (see do_blobs_exist): it's tried only if
+        data['stored'] is True.
+        Return the server response like do_upload and do_modify, or None if the file must be sent.
+        """
+        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        url = ''.join([self.files_url, data['filepath']])
+        self.logger.info('{}: URL: {} - DATA: {} '.format('_upload_by_reference', url, data))
+        try:
+            r = self._authenticated_request(method, url, data={'md5': data['md5'],
+                                                               'size': os.path.getsize(filepath)})
+            r.raise_for_status()
+            return json.loads(r.text)
+        except ConnectionManager.EXCEPTIONS_CATCHED + (ValueError,) as e:
+            # Usually 412 Precondition Failed: the server does not have the content
+            self.logger.info('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('_upload_by_reference', url, e))
+        return None
+
+    def _upload_delta(self, data):
+        """
+        Try to modify the file data['filepath'] sending only a delta from the server version of the file.
+        Return the server response like do_modify, or None if the whole file must be sent.
+        """
+        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        url = ''.join([self.files_url, data['filepath']])
+        signature_url = ''.join([self.signatures_url, data['filepath']])
+        self.logger.info('{}: URL: {} - DATA: {} '.format('_upload_delta', url, data))
+        try:
+            r = self._authenticated_request('get', signature_url)
+            r.raise_for_status()
+            sig = json.loads(r.text)
+            with tempfile.TemporaryFile() as delta_file:
+                with open(filepath, 'rb') as fp:
+                    max_literal_length = int(os.fstat(fp.fileno()).st_size * DELTA_MAX_LITERAL_RATIO)
+                    if not delta.write_delta(sig, fp, delta_file, max_literal_length):
+                        self.logger.info('{}: URL: {} - delta not convenient'.format('_upload_delta', url))
+                        return None
+                delta_file.seek(0)
+                r = self._authenticated_request('put', url, files={'delta': delta_file}, data={'md5': data['md5']})
+            r.raise_for_status()
+            return json.loads(r.text)
+        except ConnectionManager.EXCEPTIONS_CATCHED + (ValueError, KeyError, TypeError) as e:
+            self.logger.info('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('_upload_delta', url, e))
+        return None
+
+    def _upload_codec(self, filepath, size):
+        """
+        Return the codec to compress the file to upload, or None to send it as it is: the file is compressed
+        with the first content coding accepted by the server and known here, if it's worth it
+        (see compression.should_compress).
+        Downloads are compressed by the server when convenient, and decompressed by requests.
+        :return: compression.Codec
+        """
+        for name in self.server_encodings:
+            codec = compression.get_codec(name)
+            if codec is not None:
+                with open(filepath, 'rb') as fp:
+                    if compression.should_compress(fp, size, filepath):
+                        return codec
+                return None
+        return None
+
+    def _send_file(self, data, method):
         filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        try:
+            size = os.path.getsize(filepath)
+        except OSError as e:
+            # Usually the file has been removed in the meantime
+            self.logger.error('{}: PATH: {} - EXCEPTION_CATCHED: {} '.format('_send_file', filepath, e))
+            return False
+        if size >= self.upload_by_reference_threshold and data.get('stored'):
+            event_timestamp = self._upload_by_reference(data, method)
+            if event_timestamp is not None:
+                return event_timestamp
+        if method == 'put' and size >= self.delta_threshold:
+            event_timestamp = self._upload_delta(data)
+            if event_timestamp is not None:
+                return event_timestamp
+        if size > self.upload_session_threshold:
+            return self._upload_session(data, replace=(method == 'put'))
         url = ''.join([self.files_url, data['filepath']])
-        self.logger.info('{}: URL: {} - DATA: {} '.format('do_upload', url, data))
-        _file = {'file': (open(filepath, 'rb'))}
+        command = {'post': 'do_upload', 'put': 'do_modify'}[method]
+        self.logger.info('{}: URL: {} - DATA: {} '.format(command, url, data))
 
+        form = {'md5': data['md5']}
         try:
-            r = requests.post(url, auth=self.auth, files=_file, data={'md5': data['md5']})
+            codec = self._upload_codec(filepath, size)
+            if codec is not None:
+                form['content_encoding'] = codec.name
+                body = CompressedUploadBody(form, filepath, codec)
+                r = self._authenticated_request(method, url, data=body, headers={'Content-Type': body.content_type})
+            else:
+                with open(filepath, 'rb') as fp:
+                    r = self._authenticated_request(method, url, files={'file': fp}, data=form)
             r.raise_for_status()
-        except ConnectionManager.EXCEPTIONS_CATCHED as e:
-            self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_upload', url, e))
+        except ConnectionManager.EXCEPTIONS_CATCHED + (EnvironmentError,) as e:
+            self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format(command, url, e))
         else:
             event_timestamp = json.loads(r.text)
 
             return event_timestamp
         return False
 
-    def do_modify(self, data):
-        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
-        url = ''.join([self.files_url, data['filepath']])
+    def do_upload(self, data):
+        return self._send_file(data, 'post')
 
-        self.logger.info('{}: URL: {} - DATA: {} '.format('do_modify', url, data))
+    def do_modify(self, data):
+        return self._send_file(data, 'put')
 
-        _file = {'file': (open(filepath, 'rb'))}
+    def _iter_bundles(self, files):
+        """
+        Split the list of <files> to upload in bundles, of at most BUNDLE_MAX_FILES files and about
+        BUNDLE_MAX_SIZE bytes. The files not readable anymore are left out.
+        """
+        bundle = []
+        bundle_size = 0
+        for item in files:
+            try:
+                bundle_size += os.path.getsize(os.path.join(self.cfg['sharing_path'], item['filepath']))
+            except OSError as e:
+                self.logger.error('{}: PATH: {} - EXCEPTION_CATCHED: {} '.format('_iter_bundles', item['filepath'], e))
+                continue
+            bundle.append(item)
+            if len(bundle) == BUNDLE_MAX_FILES or bundle_size >= BUNDLE_MAX_SIZE:
+                yield bundle
+                bundle = []
+                bundle_size = 0
+        if bundle:
+            yield bundle
+
+    def _write_bundle(self, files):
+        """
+        Return a temporary file with the tar archive of the <files>, gzip compressed if the server accepts it,
+        or None if none of them is readable anymore (the files not readable are left out).
+        Raise EnvironmentError if a file can't be read while it's archived (e.g. it has been truncated).
+        """
+        bundle_file = tempfile.TemporaryFile()
+        try:
+            mode = 'w:gz' if 'gzip' in self.server_encodings else 'w'
+            bundle = tarfile.open(fileobj=bundle_file, mode=mode, format=tarfile.PAX_FORMAT)
+            bundled = 0
+            for item in files:
+                filepath = os.path.join(self.cfg['sharing_path'], item['filepath'])
+                try:
+                    info = bundle.gettarinfo(filepath, arcname=item['filepath'])
+                    fp = open(filepath, 'rb')
+                except EnvironmentError as e:
+                    self.logger.error('{}: PATH: {} - EXCEPTION_CATCHED: {} '.format('_write_bundle',
+                                                                                   item['filepath'], e))
+                    continue
+                info.pax_headers = {BUNDLE_MD5_HEADER: item['md5']}
+                with fp:
+                    bundle.addfile(info, fp)
+                bundled += 1
+            bundle.close()
+        except:
+            bundle_file.close()
+            raise
+        if not bundled:
+            bundle_file.close()
+            return None
+        bundle_file.seek(0)
+        return bundle_file
+
+    def do_upload_bundle(self, data):
+        """
+        Upload (create or modify) many small files at once: <data> is the list of files, every one a dict with
+        'filepath' and 'md5' keys. Return the results of the server, or False on error. The files not readable
+        while they're bundled are not in the results (and there's no 'server_timestamp' if no file is uploaded):
+        they must be uploaded one by one.
+        json format: {'results': {<filepath>: int (HTTP status code)}, 'server_timestamp': int}
+        """
+        url = self.bundles_url
+        self.logger.info('{}: URL: {} - DATA: {} files'.format('do_upload_bundle', url, len(data)))
+        results = {}
+        response = {}
+        for files in self._iter_bundles(data):
+            try:
+                bundle_file = self._write_bundle(files)
+            except EnvironmentError as e:
+                # A file has changed while it was archived: none of the bundle files is uploaded.
+                self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_upload_bundle', url, e))
+                continue
+            if bundle_file is None:
+                continue
+            try:
+                r = self._authenticated_request('post', url, data=bundle_file,
+                                                headers={'Content-Type': 'application/x-tar'})
+                r.raise_for_status()
+            except ConnectionManager.EXCEPTIONS_CATCHED as e:
+                self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_upload_bundle', url, e))
+                return False
+            finally:
+                bundle_file.close()
+            response = json.loads(r.text)
+            results.update(response['results'])
+        response['results'] = results
+        return response
+
+    def _write_bundle_member(self, fp, filepath, md5):
+        """
+        Write the file <filepath>, read from <fp> (a file of a downloaded bundle), in a partial file, and move it
+        to its actual path if its md5 is <md5>.
+        :return: bool
+        """
+        filepath = os.path.join(self.cfg['sharing_path'], filepath)
+        part_filepath = ''.join([filepath, PARTIAL_DOWNLOAD_SUFFIX])
+        dirpath = os.path.dirname(filepath)
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        h = hashlib.md5()
+        with open(part_filepath, 'wb') as f:
+            for chunk in iter(lambda: fp.read(DOWNLOAD_CHUNK_SIZE), ''):
+                h.update(chunk)
+                f.write(chunk)
+        if h.hexdigest() != md5:
+            os.remove(part_filepath)
+            return False
+        os.rename(part_filepath, filepath)
+        return True
+
+    def do_download_bundle(self, data):
+        """
+        Download many files at once: <data> is the list of files, every one a dict with 'filepath' and 'md5' keys.
+        The tar archive sent by the server is unpacked while it's received, and every file is verified.
+        Return the list of the files downloaded (the ones not downloaded, e.g. because of an error or changed
+        on the server, must be downloaded again one by one).
+        """
+        url = ''.join([self.bundles_url, 'download'])
+        self.logger.info('{}: URL: {} - DATA: {} files'.format('do_download_bundle', url, len(data)))
+        # The paths in the archive are utf-8 encoded
+        files = {item['filepath'].encode('utf-8') if isinstance(item['filepath'], unicode) else item['filepath']:
+                 item for item in data}
+        downloaded = []
         try:
-            r = requests.put(url, auth=self.auth, files=_file, data={'md5': data['md5']})
+            r = self._authenticated_request('post', url, data={'path': [item['filepath'] for item in data]},
+                                            stream=True)
+            r.raise_for_status()
+            r.raw.decode_content = True
+            bundle = tarfile.open(fileobj=r.raw, mode='r|*')
+            for member in bundle:
+                item = files.get(member.name)
+                if item is None or not member.isfile():
+                    continue
+                if self._write_bundle_member(bundle.extractfile(member), item['filepath'], item['md5']):
+                    downloaded.append(item['filepath'])
+        except (requests.exceptions.RequestException, requests.packages.urllib3.exceptions.HTTPError,
+                tarfile.TarError, EnvironmentError) as e:
+            self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_download_bundle', url, e))
+        return downloaded
+
+    def do_blobs_exist(self, data):
+        """
+        Return which of the md5 in the list data['md5'] are the md5 of contents already stored on the server
+        (so the files with that md5 can be uploaded by reference), or False on error.
+        """
+        url = ''.join([self.blobs_url, 'exists'])
+        self.logger.info('{}: URL: {} - DATA: {} '.format('do_blobs_exist', url, data))
+        try:
+            r = self._authenticated_request('post', url, data={'md5': data['md5']})
             r.raise_for_status()
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
-            self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_modify', url, e))
+            self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_blobs_exist', url, e))
         else:
-            event_timestamp = json.loads(r.text)
-
-            return event_timestamp
+            return json.loads(r.text)['existing']
         return False
 
     # actions:
@@ -214,7 +763,7 @@ class ConnectionManager(object):
         d = {'src': data['src'], 'dst': data['dst']}
         self.logger.info('{}: URL: {} - DATA: {} '.format('do_move', url, data))
         try:
-            r = requests.post(url, auth=self.auth, data=d)
+            r = self._authenticated_request('post', url, data=d)
             r.raise_for_status()
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
             self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_move', url, e))
@@ -229,7 +778,7 @@ class ConnectionManager(object):
         self.logger.info('{}: URL: {} - DATA: {} '.format('do_delete', url, data))
         d = {'filepath': data['filepath']}
         try:
-            r = requests.post(url, auth=self.auth, data=d)
+            r = self._authenticated_request('post', url, data=d)
             r.raise_for_status()
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
             self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_delete', url, e))
@@ -243,7 +792,7 @@ class ConnectionManager(object):
         d = {'src': data['src'], 'dst': data['dst']}
         self.logger.info('{}: URL: {} - DATA: {} '.format('do_copy', url, data))
         try:
-            r = requests.post(url, auth=self.auth, data=d)
+            r = self._authenticated_request('post', url, data=d)
             r.raise_for_status()
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
             self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_copy', url, e))
@@ -253,18 +802,91 @@ class ConnectionManager(object):
             return event_timestamp
         return False
 
+    def do_batch_actions(self, data):
+        """
+        Make many actions at once: <data> is the list of actions, every one a dict with the 'cmd' key ('delete',
+        'copy' or 'move') and its parameters (e.g. 'filepath'). Return the server response, or False on error.
+        json format: {'results': list (the HTTP status code of every action), 'server_timestamp': int}
+        """
+        url = ''.join([self.actions_url, 'batch'])
+        self.logger.info('{}: URL: {} - DATA: {} actions'.format('do_batch_actions', url, len(data)))
+        try:
+            r = self._authenticated_request('post', url, data={'actions': json.dumps(data)})
+            r.raise_for_status()
+        except ConnectionManager.EXCEPTIONS_CATCHED as e:
+            self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_batch_actions', url, e))
+        else:
+            return json.loads(r.text)
+        return False
+
     def do_get_server_snapshot(self, data):
+        """
+        Return the server snapshot, or None on error.
+        The snapshot is requested only if it's changed since the last one received (If-None-Match header with
+        its ETag), otherwise the last one is returned again.
+        """
         url = self.files_url
 
         self.logger.info('{}: URL: {} - DATA: {} '.format('do_get_server_snapshot', url, data))
 
+        headers = {}
+        if self.snapshot_etag and self.snapshot_text is not None:
+            headers['If-None-Match'] = self.snapshot_etag
         try:
-            r = requests.get(url, auth=self.auth)
+            r = self._authenticated_request('get', url, headers=headers)
             r.raise_for_status()
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
 
             self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_get_server_snapshot', url, e))
 
+        else:
+            if r.status_code == 304:
+                self.logger.debug('do_get_server_snapshot: snapshot not modified')
+            else:
+                self.snapshot_etag = r.headers.get('ETag')
+                self.snapshot_text = r.text
+            # A new object at every call, so the caller can modify it
+            return json.loads(self.snapshot_text)
+
+    def do_get_server_changes(self, data):
+        """
+        Return the changes of the server snapshot after the cursor data['since'] (see Files.get in the server),
+        or None on error.
+        json format: {'server_timestamp': int, 'changes': list, 'cursor': int, 'has_more': bool}
+        or {'server_timestamp': int, 'resync': True} if the whole snapshot must be got again.
+        """
+        url = self.files_url
+
+        self.logger.info('{}: URL: {} - DATA: {} '.format('do_get_server_changes', url, data))
+
+        try:
+            r = self._authenticated_request('get', url, params={'since': data['since']})
+            r.raise_for_status()
+        except ConnectionManager.EXCEPTIONS_CATCHED as e:
+
+            self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_get_server_changes', url, e))
+
+        else:
+            return json.loads(r.text)
+
+    def do_wait_server_events(self, data):
+        """
+        Wait (at most data['timeout'] seconds) for a change of the server snapshot after the cursor data['since'],
+        and return the current cursor (see Events in the server), or None on error.
+        json format: {'server_timestamp': int, 'cursor': int}
+        """
+        url = self.events_url
+
+        self.logger.debug('{}: URL: {} - DATA: {} '.format('do_wait_server_events', url, data))
+
+        try:
+            r = self._authenticated_request('get', url, params={'since': data['since'], 'timeout': data['timeout']},
+                                            timeout=data['timeout'] + EVENTS_READ_MARGIN)
+            r.raise_for_status()
+        except ConnectionManager.EXCEPTIONS_CATCHED + (requests.exceptions.Timeout,) as e:
+
+            self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_wait_server_events', url, e))
+
         else:
             return json.loads(r.text)
 
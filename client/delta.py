@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+rsync-like delta transfer of a modified file.
+
+The receiver of a file sends the signature of the version it already has (the "basis"): the size of the blocks
+the basis is split into, and a weak rolling checksum plus a strong hash of every block.
+The sender looks for those blocks at any offset of the new version, and writes a delta made of references to
+the basis blocks and of the literal data not found in the basis. The receiver rebuilds the new version from
+its basis and the delta (apply_delta), and must verify its md5, since the delta is correct only if the basis
+has not changed after its signature.
+
+Delta format: MAGIC, the block size (4 bytes, big-endian), then a sequence of instructions:
+- COPY: 'C', index of the first block and number of consecutive blocks (4 bytes each);
+- LITERAL: 'L', length of the data (4 bytes) and the data.
+
+NB: this module is used by both the server and the client, and must be kept identical in both directories.
+"""
+import struct
+import zlib
+import hashlib
+
+MAGIC = 'PYBOXDELTA1'
+MIN_BLOCK_SIZE = 2 ** 11
+MAX_BLOCK_SIZE = 2 ** 17
+# Literal data is written in instructions of at most this length
+MAX_LITERAL_LENGTH = 2 ** 20
+# write_delta gives up when the literal data (the data checked byte by byte) exceeds this length, whatever the
+# limit asked, and checks it every LITERAL_CHECK_LENGTH bytes
+MAX_SCANNED_LITERAL_LENGTH = 2 ** 23
+LITERAL_CHECK_LENGTH = 2 ** 16
+# write_delta gives up also when it has hashed this many bytes of windows whose weak checksum is in the signature
+# but the strong hash is not (few, unless the signature is forged)
+MAX_MISSED_HASH_LENGTH = 2 ** 26
+READ_SIZE = 2 ** 20
+COPY_SIZE = 2 ** 16
+
+_HEADER = struct.Struct('>I')
+_COPY = struct.Struct('>cII')
+_LITERAL = struct.Struct('>cI')
+# Modulus of the Adler-32 checksum
+_ADLER_MOD = 65521
+
+
+def block_size_for(size):
+    """
+    Return the block size of the signature of a file of <size> bytes: about its square root, so both the
+    number of blocks in the signature and the data sent for a changed block grow slowly with the file size.
+    :param size: int
+    :return: int
+    """
+    block_size = MIN_BLOCK_SIZE
+    while block_size * block_size < size and block_size < MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
+
+
+def weak_checksum(data):
+    """
+    Return the weak (rolling) checksum of <data>, the Adler-32 checksum.
+    :return: int
+    """
+    return zlib.adler32(data) & 0xffffffff
+
+
+def roll(checksum, out_byte, in_byte, block_size):
+    """
+    Return the weak checksum of a window of <block_size> bytes moved by one byte, given the <checksum> of
+    the previous window, the byte leaving it and the byte entering it (as int).
+    :return: int
+    """
+    a = checksum & 0xffff
+    b = checksum >> 16
+    a = (a - out_byte + in_byte) % _ADLER_MOD
+    b = (b - block_size * out_byte + a - 1) % _ADLER_MOD
+    return (b << 16) | a
+
+
+def strong_hash(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def signature(fp, block_size):
+    """
+    Return the signature of the file <fp> (read from its current position).
+    json format: {'block_size': int, 'blocks': [[weak checksum, strong hash], ...]}
+    :param fp: file
+    :param block_size: int
+    :return: dict
+    """
+    blocks = []
+    for block in iter(lambda: fp.read(block_size), ''):
+        blocks.append([weak_checksum(block), strong_hash(block)])
+    return {'block_size': block_size, 'blocks': blocks}
+
+
+class _DeltaWriter(object):
+    """
+    Write the delta instructions in a file, merging the copies of consecutive blocks.
+    """
+    def __init__(self, out, block_size):
+        self.out = out
+        self.copy_start = None
+        self.copy_count = 0
+        self.literal_length = 0
+        out.write(MAGIC)
+        out.write(_HEADER.pack(block_size))
+
+    def _flush_copy(self):
+        if self.copy_count:
+            self.out.write(_COPY.pack('C', self.copy_start, self.copy_count))
+            self.copy_count = 0
+
+    def copy(self, index):
+        if self.copy_count and index == self.copy_start + self.copy_count:
+            self.copy_count += 1
+            return
+        self._flush_copy()
+        self.copy_start = index
+        self.copy_count = 1
+
+    def literal(self, data):
+        if not data:
+            return
+        self._flush_copy()
+        self.literal_length += len(data)
+        for start in range(0, len(data), MAX_LITERAL_LENGTH):
+            chunk = data[start:start + MAX_LITERAL_LENGTH]
+            self.out.write(_LITERAL.pack('L', len(chunk)))
+            self.out.write(chunk)
+
+    def close(self):
+        self._flush_copy()
+
+
+def write_delta(sig, fp, out, max_literal_length=None):
+    """
+    Write in <out> the delta to rebuild the file <fp> from the basis with the signature <sig>.
+    The window is moved byte by byte over the unmatched data, rolling its weak checksum, and its strong hash is
+    computed only when the weak checksum is in the signature. That's still slow for a file that is mostly new,
+    and the signature may come from the other side of the connection: so if the literal data exceeds
+    <max_literal_length>, or MAX_SCANNED_LITERAL_LENGTH anyway (checked every LITERAL_CHECK_LENGTH bytes), or
+    the strong hashes computed in vain exceed MAX_MISSED_HASH_LENGTH bytes, the delta is left incomplete and
+    False is returned, so the caller can send the whole file instead.
+    Return True if the delta is complete.
+    :param sig: dict (see signature())
+    :param fp: file
+    :param out: file
+    :param max_literal_length: int
+    :return: bool
+    """
+    if max_literal_length is None or max_literal_length > MAX_SCANNED_LITERAL_LENGTH:
+        max_literal_length = MAX_SCANNED_LITERAL_LENGTH
+    block_size = sig['block_size']
+    blocks = {}
+    for index, (weak, strong) in enumerate(sig['blocks']):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+
+    writer = _DeltaWriter(out, block_size)
+    mod = _ADLER_MOD
+    buf = bytearray()
+    # Start of the current window, and of the literal data before it, in buf
+    pos = literal_start = 0
+    # Weak checksum of the current window, None if it must be computed
+    weak = None
+    missed_hashes = 0
+    max_missed_hashes = MAX_MISSED_HASH_LENGTH // block_size
+    eof = False
+    while True:
+        if len(buf) - pos < block_size and not eof:
+            writer.literal(bytes(buf[literal_start:pos]))
+            if writer.literal_length > max_literal_length:
+                return False
+            data = fp.read(max(READ_SIZE, block_size))
+            eof = not data
+            buf = buf[pos:] + data
+            pos = literal_start = 0
+            continue
+        last = len(buf) - block_size
+        if pos > last:
+            # End of the file: the remaining data can't match a whole block.
+            pos = len(buf)
+            break
+        if weak is None:
+            weak = weak_checksum(bytes(buf[pos:pos + block_size]))
+        a = weak & 0xffff
+        b = weak >> 16
+        # Move the window until a block matches, the end of buf or the next check of the literal length
+        stop = min(last, literal_start + LITERAL_CHECK_LENGTH)
+        index = None
+        while True:
+            weak = (b << 16) | a
+            if weak in blocks:
+                index = blocks[weak].get(strong_hash(buf[pos:pos + block_size]))
+                if index is not None:
+                    break
+                missed_hashes += 1
+                if missed_hashes > max_missed_hashes:
+                    return False
+            if pos >= stop:
+                break
+            out_byte = buf[pos]
+            a = (a - out_byte + buf[pos + block_size]) % mod
+            b = (b - block_size * out_byte + a - 1) % mod
+            pos += 1
+        if index is not None:
+            writer.literal(bytes(buf[literal_start:pos]))
+            writer.copy(index)
+            pos += block_size
+            literal_start = pos
+            weak = None
+        elif pos == last:
+            # The next window needs the next data, or there is none
+            pos += 1
+            weak = None
+        else:
+            writer.literal(bytes(buf[literal_start:pos]))
+            literal_start = pos
+            if writer.literal_length > max_literal_length:
+                return False
+    writer.literal(bytes(buf[literal_start:pos]))
+    writer.close()
+    return True
+
+
+def _read_exactly(fp, length):
+    data = fp.read(length)
+    if len(data) != length:
+        raise ValueError('Truncated delta')
+    return data
+
+
+def apply_delta(basis, delta, out):
+    """
+    Write in <out> the file rebuilt from the <basis> file and the <delta> file.
+    Raise ValueError if the delta is malformed or refers to blocks not in the basis.
+    :param basis: file (seekable)
+    :param delta: file
+    :param out: file
+    """
+    if delta.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a delta')
+    block_size, = _HEADER.unpack(_read_exactly(delta, _HEADER.size))
+    if not block_size:
+        raise ValueError('Invalid block size')
+    while True:
+        op = delta.read(1)
+        if not op:
+            break
+        if op == 'C':
+            start, count = _COPY.unpack(op + _read_exactly(delta, _COPY.size - 1))[1:]
+            basis.seek(start * block_size)
+            remaining = count * block_size
+            while remaining:
+                data = basis.read(min(remaining, COPY_SIZE))
+                if not data:
+                    break
+                out.write(data)
+                remaining -= len(data)
+            # Only the last block of the basis can be shorter than block_size.
+            if remaining >= block_size:
+                raise ValueError('Block out of the basis')
+        elif op == 'L':
+            length = _LITERAL.unpack(op + _read_exactly(delta, _LITERAL.size - 1))[1]
+            while length:
+                data = _read_exactly(delta, min(length, COPY_SIZE))
+                out.write(data)
+                length -= len(data)
+        else:
+            raise ValueError('Invalid delta instruction {!r}'.format(op))
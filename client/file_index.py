@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Persistent index of the files of the sharing folder, stored in a SQLite database next to local_dir_state.
+
+Every file whose md5 is known is recorded with its stat key (size, modification time and inode), and with its
+server timestamp if it's known too. While the stat key of a file doesn't change, its md5 is taken from the index
+instead of reading the file: so at the daemon start only the new and changed files are hashed, and a warm start
+reads just the directories metadata (see Daemon.build_client_snapshot).
+"""
+import sqlite3
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    inode INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    timestamp INTEGER
+);
+"""
+
+FIELDS = ('size', 'mtime', 'inode', 'md5', 'timestamp')
+
+
+def stat_key(st):
+    """
+    Return the stat key of a file, given its stat result: (<size>, <mtime>, <inode>)
+    :return: tuple
+    """
+    return st.st_size, st.st_mtime, st.st_ino
+
+
+class Entry(namedtuple('Entry', FIELDS)):
+    """
+    Indexed file: its stat key, md5 and server timestamp (None if unknown).
+    """
+    __slots__ = ()
+
+    def matches(self, st):
+        """
+        Return True if the file with the stat result <st> is unchanged since it has been indexed.
+        :return: bool
+        """
+        return (self.size, self.mtime, self.inode) == stat_key(st)
+
+
+class FileIndex(object):
+    """
+    Index of the files of the sharing folder, keyed by their path relative to it.
+    The same instance can be shared by several threads: every access is serialized by a lock,
+    and the transaction() context manager groups many changes in a single commit.
+    """
+    def __init__(self, path=':memory:'):
+        self.path = None
+        self._conn = None
+        self._lock = threading.RLock()
+        self._transaction_depth = 0
+        self.connect(path)
+
+    def connect(self, path):
+        """
+        (Re)open the index on the database <path>, creating it if needed.
+        :param path: str
+        """
+        with self._lock:
+            self.close()
+            # isolation_level=None: transactions are explicitly handled by self.transaction()
+            self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            if path != ':memory:':
+                self._conn.execute('PRAGMA journal_mode = WAL')
+                self._conn.execute('PRAGMA synchronous = NORMAL')
+            self._conn.executescript(SCHEMA)
+            self.path = path
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager grouping all the changes made inside it in a single atomic commit.
+        Nested transactions are merged in the outermost one.
+        """
+        with self._lock:
+            if self._transaction_depth == 0:
+                self._conn.execute('BEGIN IMMEDIATE')
+            self._transaction_depth += 1
+            try:
+                yield self
+            except:
+                self._transaction_depth -= 1
+                if self._transaction_depth == 0:
+                    self._conn.execute('ROLLBACK')
+                raise
+            else:
+                self._transaction_depth -= 1
+                if self._transaction_depth == 0:
+                    self._conn.execute('COMMIT')
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def __len__(self):
+        return self._execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def entries(self):
+        """
+        Return all the indexed files: {<path>: Entry}
+        :return: dict
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT path, {} FROM files'.format(', '.join(FIELDS))).fetchall()
+        return {row[0]: Entry(*row[1:]) for row in rows}
+
+    def get(self, path):
+        """
+        Return the Entry of the file <path>, or None if it's not indexed.
+        :return: Entry
+        """
+        row = self._execute('SELECT {} FROM files WHERE path = ?'.format(', '.join(FIELDS)), (path,)).fetchone()
+        return Entry(*row) if row else None
+
+    def set(self, path, st, md5, timestamp=None):
+        """
+        Index the file <path>, with the stat result <st>, the <md5> and the server <timestamp>.
+        """
+        self.update({path: Entry(*(stat_key(st) + (md5, timestamp)))})
+
+    def set_timestamp(self, path, timestamp):
+        """
+        Set the server timestamp of the indexed file <path>. Return False if it's not indexed.
+        :return: bool
+        """
+        return self._execute('UPDATE files SET timestamp = ? WHERE path = ?', (timestamp, path)).rowcount > 0
+
+    def update(self, entries=None, removed=()):
+        """
+        Index the files <entries> ({<path>: Entry}, replacing the existing ones) and remove the <removed> paths,
+        in a single commit.
+        """
+        with self.transaction():
+            if entries:
+                self._conn.executemany('INSERT OR REPLACE INTO files (path, {}) VALUES (?, ?, ?, ?, ?, ?)'
+                                       .format(', '.join(FIELDS)),
+                                       ((path,) + tuple(entry) for path, entry in entries.iteritems()))
+            if removed:
+                self._conn.executemany('DELETE FROM files WHERE path = ?', ((path,) for path in removed))
+
+    def delete(self, path):
+        """
+        Remove the file <path> from the index. Return False if it's not indexed.
+        :return: bool
+        """
+        return self._execute('DELETE FROM files WHERE path = ?', (path,)).rowcount > 0
+
+    def move(self, src, dst):
+        """
+        Move the indexed file <src> to <dst> (a rename keeps the stat key). Return False if <src> is not indexed.
+        :return: bool
+        """
+        with self.transaction():
+            if self.get(src) is None:
+                return False
+            self._execute('DELETE FROM files WHERE path = ?', (dst,))
+            self._execute('UPDATE files SET path = ? WHERE path = ?', (dst, src))
+        return True
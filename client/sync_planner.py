@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Planning of the synchronization of the whole sharing folder with the server snapshot.
+
+plan_sync() compares the client snapshot with the server one and, given the state of the last synchronization,
+returns a SyncPlan: what has to be downloaded, uploaded and deleted, which files can be moved or copied locally
+instead of downloaded, and which ones are in conflict. It doesn't touch the folder nor the server, so a plan
+can be shown without executing it (see the 'plan' command of client_cmdmanager), and it's made with set
+operations and dict lookups only, in O(n) time (see benchmark_sync_planner.py).
+
+Daemon._execute_sync_plan applies the plan.
+
+merge_changes() reduces the server changes got from the change feed (see Daemon._sync_changes_with_server) to the
+last one of every path, so that only the final state of the server is applied.
+"""
+from collections import namedtuple, OrderedDict
+
+# Suffix of the local copy of a file modified both on client and server
+CONFLICTED_SUFFIX = '.conflicted'
+
+# The file <src> of the client is moved or copied to <dst>
+Move = namedtuple('Move', 'src dst')
+Copy = namedtuple('Copy', 'src dst')
+# The file <path> has been modified both on client and server: the client version is kept in <conflicted_path>
+# and uploaded, while the server version is downloaded in <path>
+Conflict = namedtuple('Conflict', 'path conflicted_path')
+
+
+class SyncPlan(object):
+    """
+    Operations needed to synchronize the sharing folder with the server.
+    The local ones (moves, copies, conflict copies and client_deletes) must be made before the sync commands
+    (see sync_commands()).
+    """
+    FIELDS = ('downloads', 'uploads', 'modifies', 'server_deletes', 'client_deletes', 'moves', 'copies', 'conflicts')
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, [])
+
+    def __eq__(self, other):
+        return isinstance(other, SyncPlan) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'SyncPlan({})'.format(', '.join('{}={!r}'.format(field, getattr(self, field))
+                                                for field in self.FIELDS if getattr(self, field)))
+
+    def is_empty(self):
+        return not any(getattr(self, field) for field in self.FIELDS)
+
+    def sync_commands(self):
+        """
+        Return the commands to send to the server after the local operations, as a list of (<command>, <path>):
+        the deletes first, then the downloads, modifies and uploads.
+        :return: list
+        """
+        commands = [('delete', path) for path in self.server_deletes]
+        commands.extend(('download', path) for path in self.downloads)
+        commands.extend(('download', conflict.path) for conflict in self.conflicts)
+        commands.extend(('modify', path) for path in self.modifies)
+        commands.extend(('upload', conflict.conflicted_path) for conflict in self.conflicts)
+        commands.extend(('upload', path) for path in self.uploads)
+        return commands
+
+    def to_dict(self):
+        """
+        Return the plan as a JSON serializable dict, with the fields sorted.
+        :return: dict
+        """
+        return {field: sorted(list(item) if isinstance(item, tuple) else item for item in getattr(self, field))
+                for field in self.FIELDS}
+
+
+def plan_sync(client_snapshot, server_snapshot, server_timestamp, last_timestamp, directory_modified):
+    """
+    Return the SyncPlan to synchronize the client with the server.
+    :param client_snapshot: dict ({<path>: [<timestamp>, <md5>]}, the files of the sharing folder)
+    :param server_snapshot: dict ({<path>: [<timestamp>, <md5>]}, the files on the server)
+    :param server_timestamp: the timestamp of the last change on the server
+    :param last_timestamp: the server timestamp of the last synchronization
+    :param directory_modified: bool (True if the folder has been modified since the last synchronization)
+    :return: SyncPlan
+    """
+    plan = SyncPlan()
+    if last_timestamp == server_timestamp and not directory_modified:
+        # Client and server are already synchronized
+        return plan
+
+    new_on_server = []
+    modified = []
+    for path, (timestamp, md5) in server_snapshot.iteritems():
+        client_entry = client_snapshot.get(path)
+        if client_entry is None:
+            new_on_server.append(path)
+        elif client_entry[1] != md5:
+            modified.append(path)
+    new_on_client = client_snapshot.viewkeys() - server_snapshot.viewkeys()
+
+    if last_timestamp == server_timestamp:
+        # Only the client has changed: it sends all its changes to the server
+        plan.server_deletes.extend(new_on_server)
+        plan.modifies.extend(modified)
+        plan.uploads.extend(new_on_client)
+        return plan
+
+    assert last_timestamp <= server_timestamp, 'e\' successo qualcosa di brutto nella sync, ' \
+                                               'local_timestamp > di server_timestamp '
+    # The server has changed. A file new on server with the content of a file still in the client is a copy of it,
+    # or a move if that file is not on the server anymore.
+    wanted_md5 = {server_snapshot[path][1] for path in new_on_server}
+    local_paths = {}
+    if wanted_md5:
+        for path, (timestamp, md5) in client_snapshot.iteritems():
+            if md5 in wanted_md5 and md5 not in local_paths:
+                local_paths[md5] = path
+    movable_paths = {}
+    for path in new_on_client:
+        md5 = client_snapshot[path][1]
+        if md5 in wanted_md5:
+            movable_paths.setdefault(md5, []).append(path)
+
+    moved = set()
+    for path in new_on_server:
+        file_timestamp, md5 = server_snapshot[path]
+        if movable_paths.get(md5):
+            src = movable_paths[md5].pop()
+            moved.add(src)
+            plan.moves.append(Move(src, path))
+        elif md5 in local_paths:
+            plan.copies.append(Copy(local_paths[md5], path))
+        elif not directory_modified or file_timestamp > last_timestamp:
+            plan.downloads.append(path)
+        else:
+            # The client has deleted the file while the daemon was down
+            plan.server_deletes.append(path)
+
+    for path in modified:
+        if not directory_modified:
+            plan.downloads.append(path)
+        elif server_snapshot[path][0] < last_timestamp:
+            # Modified on client only
+            plan.modifies.append(path)
+        else:
+            # Modified both on client and server
+            plan.conflicts.append(Conflict(path, path + CONFLICTED_SUFFIX))
+
+    for path in new_on_client - moved:
+        if directory_modified:
+            plan.uploads.append(path)
+        else:
+            # Deleted on server
+            plan.client_deletes.append(path)
+    return plan
+
+
+def merge_changes(changes):
+    """
+    Reduce the list of server <changes> (items of the change feed, in order) to the last change of every path,
+    in the order of the last changes: the intermediate contents of a path are never applied, and the paths deleted
+    or moved away afterwards are just deleted. The deletes are the last ones, so that the contents they remove
+    can still be copied or moved by the other changes.
+    :return: list
+    """
+    merged = OrderedDict()
+    for change in changes:
+        merged.pop(change['path'], None)
+        merged[change['path']] = change
+        if change['op'] == 'move':
+            merged.pop(change['src'], None)
+            merged[change['src']] = {'seq': change['seq'], 'op': 'delete', 'path': change['src'], 'src': None,
+                                     'timestamp': change['timestamp'], 'md5': None}
+    return ([change for change in merged.itervalues() if change['op'] != 'delete'] +
+            [change for change in merged.itervalues() if change['op'] == 'delete'])
@@ -9,6 +9,7 @@ import shutil
 import json
 import time
 import random
+import select
 # import httpretty
 import client_daemon
 import test_utils
@@ -103,6 +104,51 @@ def fake_make_copy(self, src, dst, timestamp):
     return True
 
 
+# The actual methods, before they are replaced by the fake ones above
+make_move_on_client = client_daemon.Daemon._make_move_on_client
+make_copy_on_client = client_daemon.Daemon._make_copy_on_client
+
+
+class FakeConnectionManager(object):
+    """
+    Connection manager answering the change feed requests with the given responses, and recording the requests.
+    """
+    def __init__(self, changes_responses, snapshot=None):
+        self.changes_responses = list(changes_responses)
+        self.snapshot = snapshot
+        self.requests = []
+        self.bundle_threshold = 2 ** 16
+        self.upload_by_reference_threshold = 2 ** 16
+        # md5 of the contents stored on the server
+        self.stored = []
+
+    def dispatch_request(self, command, args=None):
+        self.requests.append((command, args))
+        if command == 'get_server_changes':
+            return self.changes_responses.pop(0)
+        if command == 'get_server_snapshot':
+            return self.snapshot
+        if command == 'download_bundle':
+            # The last file is not in the bundle
+            for item in args[:-1]:
+                with open(os.path.join(TEST_SHARING_FOLDER, item['filepath']), 'w') as f:
+                    f.write('downloaded')
+            return [item['filepath'] for item in args[:-1]]
+        if command == 'upload_bundle':
+            # The last file is left out of the bundle
+            return {'results': {item['filepath']: 201 for item in args[:-1]}, 'server_timestamp': 6}
+        if command in ('upload', 'modify'):
+            return {'server_timestamp': 7}
+        if command == 'batch_actions':
+            return {'results': [200] * len(args), 'server_timestamp': 5}
+        if command == 'blobs_exist':
+            return [md5 for md5 in args['md5'] if md5 in self.stored]
+        if command == 'download':
+            with open(os.path.join(TEST_SHARING_FOLDER, args['filepath']), 'w') as f:
+                f.write('downloaded')
+            return True
+
+
 def fake_set_cmdmanager_response(socket, message):
     response = {'message': message}
     response_packet = json.dumps(response)
@@ -316,20 +362,14 @@ class TestClientDaemon(unittest.TestCase):
         Test MD5_OF_CLIENT_SNAPSHOT: Check the global_md5_method
         :return:
         """
-
-        time_stamp = timestamp_generator()
         self.daemon.client_snapshot = base_dir_tree.copy()
+        self.assertIsInstance(self.daemon.client_snapshot, client_daemon.ClientSnapshot)
 
-        md5hash = hashlib.md5()
-
-        for path, time_md5 in sorted(self.daemon.client_snapshot.iteritems()):
-            # extract md5 from tuple. we don't need hexdigest it's already md5
-
-            md5hash.update(time_md5[1])
-            md5hash.update(path)
-
-        self.daemon.md5_of_client_snapshot()
-        self.assertEqual(md5hash.hexdigest(), self.daemon.md5_of_client_snapshot())
+        # The digest doesn't depend on the order of the files
+        snapshot = client_daemon.ClientSnapshot()
+        for path in sorted(base_dir_tree, reverse=True):
+            snapshot[path] = base_dir_tree[path]
+        self.assertEqual(snapshot.digest(), self.daemon.md5_of_client_snapshot())
 
     def test_is_directory_not_modified(self):
 
@@ -375,6 +415,41 @@ class TestClientDaemon(unittest.TestCase):
         self.assertEqual(self.daemon.local_dir_state['global_md5'], self.daemon.md5_of_client_snapshot(), msg="The global_md5 i save is the save i load")
         self.assertEqual(self.daemon.local_dir_state['last_timestamp'], time_stamp, msg="The timestamp i save is the save i load")
 
+    def test_search_md5(self):
+        self.daemon.client_snapshot = base_dir_tree.copy()
+        path = 'folder/pysqualo.txt'
+        md5 = base_dir_tree[path][1]
+        self.assertEqual(self.daemon.search_md5(md5), path)
+        self.assertIsNone(self.daemon.search_md5(md5[:10]))
+        self.daemon.client_snapshot['copy.txt'] = base_dir_tree[path]
+        self.assertEqual(self.daemon.search_md5(md5), 'copy.txt')
+        self.daemon.client_snapshot.pop('copy.txt')
+        self.daemon.client_snapshot.pop(path)
+        self.assertIsNone(self.daemon.search_md5(md5))
+
+    def test_load_old_local_dir_state(self):
+        """
+        Test LOCAL_DIR_STATE: the old local_dir_state format, with the legacy global md5, is migrated.
+        """
+        self.daemon.client_snapshot = base_dir_tree.copy()
+        old_local_dir_state = {'last_timestamp': 5, 'global_md5': client_daemon.legacy_digest(base_dir_tree)}
+        with open(LOCAL_DIR_STATE_FOR_TEST, 'w') as f:
+            json.dump(old_local_dir_state, f)
+        self.daemon.load_local_dir_state()
+        self.assertEqual(self.daemon.local_dir_state, {'last_timestamp': 5,
+                                                       'global_md5': self.daemon.md5_of_client_snapshot(),
+                                                       'version': client_daemon.Daemon.LOCAL_DIR_STATE_VERSION})
+        self.assertFalse(self.daemon._is_directory_modified())
+        with open(LOCAL_DIR_STATE_FOR_TEST) as f:
+            self.assertEqual(json.load(f), self.daemon.local_dir_state)
+
+        # A folder modified after the old local_dir_state has been saved
+        with open(LOCAL_DIR_STATE_FOR_TEST, 'w') as f:
+            json.dump(old_local_dir_state, f)
+        self.daemon.client_snapshot['new_file.txt'] = [1, '321456879']
+        self.daemon.load_local_dir_state()
+        self.assertTrue(self.daemon._is_directory_modified())
+
     ####################### DIRECTORY NOT MODIFIED #####################################
     def test_sync_process_move_on_server(self):
 
@@ -652,6 +727,319 @@ class TestClientDaemon(unittest.TestCase):
         self.assertNotEqual(new_global_md5_client, old_global_md5_client)
 
 
+class TestSyncServerChanges(unittest.TestCase):
+    """
+    Test the synchronization with the server change feed.
+    """
+    def setUp(self):
+        create_environment()
+        self.daemon = client_daemon.Daemon(CONFIG_FILEPATH, TEST_SHARING_FOLDER)
+        self.daemon.create_observer()
+        self.daemon.observer.start()
+        # Use the actual methods, even if the fake ones have been set by other tests
+        self.daemon._make_move_on_client = make_move_on_client.__get__(self.daemon)
+        self.daemon._make_copy_on_client = make_copy_on_client.__get__(self.daemon)
+        self.daemon.client_snapshot = {}
+        for path in ('file1.txt', 'folder/file2.txt'):
+            create_files([path])
+            self.daemon.client_snapshot[path] = [1, self.daemon.hash_file(self.daemon.absolutize_path(path))]
+        self.daemon.update_local_dir_state(1)
+        self.daemon.server_cursor = 10
+
+    def tearDown(self):
+        self.daemon.observer.stop()
+        self.daemon.observer.join()
+        for fd in self.daemon.events_pipe or ():
+            os.close(fd)
+        destroy_folder()
+
+    def _changes_response(self, changes, cursor, server_timestamp=2, has_more=False):
+        return {'server_timestamp': server_timestamp, 'changes': changes, 'cursor': cursor, 'has_more': has_more}
+
+    def _change(self, op, path, md5=None, src=None, timestamp=2):
+        return {'seq': 0, 'op': op, 'path': path, 'src': src, 'timestamp': timestamp, 'md5': md5}
+
+    def test_no_changes(self):
+        self.daemon.conn_mng = FakeConnectionManager([self._changes_response([], 10, server_timestamp=1)])
+        self.daemon.sync_with_server()
+        self.assertEqual(self.daemon.conn_mng.requests, [('get_server_changes', {'since': 10})])
+        self.assertEqual(self.daemon.local_dir_state['last_timestamp'], 1)
+
+    def test_changes_are_applied(self):
+        md5 = self.daemon.client_snapshot['file1.txt'][1]
+        self.daemon.conn_mng = FakeConnectionManager([
+            self._changes_response([self._change('create', 'new.txt', 'new_md5'),
+                                    self._change('copy', 'copy.txt', md5, src='file1.txt')], 12, has_more=True),
+            self._changes_response([self._change('move', 'moved.txt', md5, src='file1.txt'),
+                                    self._change('delete', 'folder/file2.txt')], 14, server_timestamp=3),
+        ])
+        self.daemon.sync_with_server()
+        self.assertEqual([args['since'] for command, args in self.daemon.conn_mng.requests
+                          if command == 'get_server_changes'], [10, 12])
+        # Only the new content is downloaded
+        self.assertEqual([args['filepath'] for command, args in self.daemon.conn_mng.requests
+                          if command == 'download'], ['new.txt'])
+        self.assertEqual(sorted(self.daemon.client_snapshot), ['copy.txt', 'moved.txt', 'new.txt'])
+        self.assertEqual(sorted(os.listdir(TEST_SHARING_FOLDER)), ['copy.txt', 'folder', 'moved.txt', 'new.txt'])
+        self.assertFalse(os.path.exists(self.daemon.absolutize_path('folder/file2.txt')))
+        self.assertEqual(self.daemon.server_cursor, 14)
+        self.assertEqual(self.daemon.local_dir_state['last_timestamp'], 3)
+
+    def test_own_changes_are_skipped(self):
+        md5 = self.daemon.client_snapshot['file1.txt'][1]
+        self.daemon.conn_mng = FakeConnectionManager([
+            self._changes_response([self._change('modify', 'file1.txt', md5),
+                                    self._change('delete', 'deleted.txt')], 12)])
+        self.daemon.sync_with_server()
+        self.assertEqual(len(self.daemon.conn_mng.requests), 1)
+        self.assertEqual(sorted(self.daemon.client_snapshot), ['file1.txt', 'folder/file2.txt'])
+
+    def test_created_and_deleted_file_is_not_downloaded(self):
+        self.daemon.conn_mng = FakeConnectionManager([
+            self._changes_response([self._change('create', 'tmp.txt', 'tmp_md5')], 11, has_more=True),
+            self._changes_response([self._change('delete', 'tmp.txt')], 12)])
+        self.daemon.sync_with_server()
+        self.assertEqual([command for command, args in self.daemon.conn_mng.requests],
+                         ['get_server_changes', 'get_server_changes'])
+        self.assertNotIn('tmp.txt', self.daemon.client_snapshot)
+        self.assertFalse(os.path.exists(self.daemon.absolutize_path('tmp.txt')))
+        self.assertEqual(self.daemon.server_cursor, 12)
+
+    def test_only_last_modification_is_downloaded(self):
+        self.daemon.conn_mng = FakeConnectionManager([
+            self._changes_response([self._change('modify', 'file1.txt', 'md5_a', timestamp=2),
+                                    self._change('modify', 'file1.txt', 'md5_b', timestamp=3)], 12)])
+        self.daemon.sync_with_server()
+        self.assertEqual([args for command, args in self.daemon.conn_mng.requests if command == 'download'],
+                         [{'filepath': 'file1.txt', 'md5': 'md5_b'}])
+        self.assertEqual(self.daemon.client_snapshot['file1.txt'], [3, 'md5_b'])
+
+    def test_listen_server_events(self):
+        events = [{'server_timestamp': 1, 'cursor': 10}, {'server_timestamp': 2, 'cursor': 11}]
+        requests = []
+
+        def dispatch_request(command, args):
+            requests.append((command, args))
+            if events:
+                return events.pop(0)
+            self.daemon.running = 0
+
+        self.daemon.conn_mng = FakeConnectionManager([])
+        self.daemon.conn_mng.dispatch_request = dispatch_request
+        self.daemon.cfg['activate'] = True
+        self.daemon.running = 1
+        self.daemon.EVENTS_RETRY_DELAY = 0
+        events_thread = self.daemon._start_events_listener()
+        # Only the change wakes the main loop
+        self.assertEqual(select.select([self.daemon.events_pipe[0]], [], [], 10)[0], [self.daemon.events_pipe[0]])
+        self.assertEqual(os.read(self.daemon.events_pipe[0], 1024), 'e')
+        self.assertTrue(self.daemon.events_available)
+        self.daemon.server_cursor = 11
+        self.daemon.server_synced.set()
+        events_thread.join(10)
+        self.assertFalse(events_thread.is_alive())
+        self.assertEqual([args['since'] for command, args in requests], [10, 10, 11])
+        self.assertEqual(select.select([self.daemon.events_pipe[0]], [], [], 0)[0], [])
+
+    def test_delete_on_server(self):
+        self.daemon.conn_mng = FakeConnectionManager([])
+        self.daemon.BATCH_SIZE = 1
+        self.assertEqual(self.daemon._delete_on_server(['file1.txt', 'folder/file2.txt']), 5)
+        self.assertEqual(self.daemon.conn_mng.requests,
+                         [('batch_actions', [{'cmd': 'delete', 'filepath': 'file1.txt'}]),
+                          ('batch_actions', [{'cmd': 'delete', 'filepath': 'folder/file2.txt'}])])
+        self.assertEqual(self.daemon.client_snapshot, {})
+
+    def test_upload_bundle_on_server(self):
+        self.daemon.conn_mng = FakeConnectionManager([])
+        self.assertEqual(self.daemon._sync_command_group(('upload', 'file1.txt')), 'bundle')
+        self.assertEqual(self.daemon._sync_command_group(('modify', 'file1.txt')), 'bundle')
+        self.assertEqual(self.daemon._sync_command_group(('delete', 'file1.txt')), 'delete')
+        self.assertIsNone(self.daemon._sync_command_group(('download', 'file1.txt')))
+        self.daemon.conn_mng.bundle_threshold = 1
+        self.assertIsNone(self.daemon._sync_command_group(('upload', 'file1.txt')))
+
+        commands = [('upload', 'file1.txt'), ('modify', 'folder/file2.txt')]
+        self.assertEqual(self.daemon._upload_bundle_on_server(commands, {}, 3), 7)
+        md5s = {path: self.daemon.client_snapshot[path][1] for command, path in commands}
+        self.assertEqual(self.daemon.conn_mng.requests, [
+            ('upload_bundle', [{'filepath': path, 'md5': md5s[path]} for command, path in commands]),
+            ('modify', {'filepath': 'folder/file2.txt', 'md5': md5s['folder/file2.txt']})])
+
+        # A removed file left out of the bundle is not uploaded
+        self.daemon.conn_mng.requests = []
+        os.remove(self.daemon.absolutize_path('folder/file2.txt'))
+        self.assertEqual(self.daemon._upload_bundle_on_server(commands, {}, 3), 6)
+        self.assertEqual([command for command, args in self.daemon.conn_mng.requests], ['upload_bundle'])
+
+    def test_download_bundle_from_server(self):
+        self.daemon.conn_mng = FakeConnectionManager([])
+        self.assertEqual(self.daemon._sync_command_group(('download', 'new.txt')), 'download_bundle')
+        self.assertIsNone(self.daemon._sync_command_group(('download', 'file1.txt')))
+        files = {'new1.txt': [3, 'md5_1'], 'new2.txt': [3, 'md5_2']}
+
+        self.assertEqual(self.daemon._download_bundle_from_server(['new1.txt', 'new2.txt'], files, 3), 3)
+        self.assertEqual(self.daemon.conn_mng.requests, [
+            ('download_bundle', [{'filepath': 'new1.txt', 'md5': 'md5_1'}, {'filepath': 'new2.txt', 'md5': 'md5_2'}]),
+            ('download', {'filepath': 'new2.txt', 'md5': 'md5_2'})])
+        self.assertEqual(self.daemon.client_snapshot['new1.txt'], files['new1.txt'])
+        self.assertEqual(self.daemon.client_snapshot['new2.txt'], files['new2.txt'])
+        # The downloaded files are indexed, with their server timestamp
+        self.assertEqual(self.daemon.file_index.get('new1.txt')[-2:], ('md5_1', 3))
+
+    def test_resync(self):
+        snapshot = {'server_timestamp': 1, 'files': self.daemon.client_snapshot.copy(), 'cursor': 20}
+        self.daemon.conn_mng = FakeConnectionManager([{'server_timestamp': 1, 'resync': True}], snapshot)
+        self.daemon.sync_with_server()
+        self.assertEqual([command for command, args in self.daemon.conn_mng.requests],
+                         ['get_server_changes', 'get_server_snapshot'])
+        self.assertEqual(self.daemon.server_cursor, 20)
+
+    def test_concurrent_transfers(self):
+        class SlowConnectionManager(FakeConnectionManager):
+            # The upload of file1.txt ends after the one of folder/file2.txt, with an older server timestamp
+            def dispatch_request(self, command, args=None):
+                if command == 'upload':
+                    self.requests.append((command, args))
+                    if args['filepath'] == 'file1.txt':
+                        time.sleep(0.1)
+                        return {'server_timestamp': 7}
+                    return {'server_timestamp': 9}
+                return FakeConnectionManager.dispatch_request(self, command, args)
+
+        self.daemon.cfg['transfer_workers'] = 3
+        self.daemon.conn_mng = SlowConnectionManager([])
+        files = {'new.txt': [8, 'new_md5']}
+        last_operation_timestamp = self.daemon._make_sync_commands(
+            [('upload', 'file1.txt'), ('upload', 'folder/file2.txt'), ('download', 'new.txt')], files, 2)
+        self.assertEqual(last_operation_timestamp, 9)
+        self.assertEqual(self.daemon.client_snapshot['new.txt'], [8, 'new_md5'])
+        self.assertEqual(sorted(args['filepath'] for command, args in self.daemon.conn_mng.requests),
+                         ['file1.txt', 'folder/file2.txt', 'new.txt'])
+
+    def test_uploads_by_reference(self):
+        """
+        The contents already stored on the server are found with a single request before the uploads, and only
+        their files are uploaded by reference.
+        """
+        class UploadConnectionManager(FakeConnectionManager):
+            def dispatch_request(self, command, args=None):
+                if command in ('upload', 'modify'):
+                    self.requests.append((command, args))
+                    return {'server_timestamp': 4}
+                return FakeConnectionManager.dispatch_request(self, command, args)
+
+        self.daemon.conn_mng = UploadConnectionManager([])
+        self.daemon.conn_mng.upload_by_reference_threshold = 1
+        stored_md5 = self.daemon.client_snapshot['file1.txt'][1]
+        self.daemon.conn_mng.stored = [stored_md5]
+        self.daemon._make_sync_commands([('upload', 'file1.txt'), ('modify', 'folder/file2.txt')], {}, 2)
+        requests = self.daemon.conn_mng.requests
+        self.assertEqual(requests[0], ('blobs_exist', {'md5': sorted(
+            set([stored_md5, self.daemon.client_snapshot['folder/file2.txt'][1]]))}))
+        self.assertEqual(sorted(requests[1:]), [
+            ('modify', {'filepath': 'folder/file2.txt', 'md5': self.daemon.client_snapshot['folder/file2.txt'][1]}),
+            ('upload', {'filepath': 'file1.txt', 'md5': stored_md5, 'stored': True})])
+
+        # The small files are not checked
+        self.daemon.conn_mng = UploadConnectionManager([])
+        self.daemon._make_sync_commands([('upload', 'file1.txt')], {}, 2)
+        self.assertEqual([command for command, args in self.daemon.conn_mng.requests], ['upload'])
+
+    def test_sync_plan(self):
+        files = self.daemon.client_snapshot.copy()
+        files['moved.txt'] = [2, files.pop('file1.txt')[1]]
+        self.daemon.conn_mng = FakeConnectionManager([], {'server_timestamp': 2, 'files': files, 'cursor': 20})
+        plan = self.daemon.sync_plan()
+        self.assertEqual(plan['moves'], [['file1.txt', 'moved.txt']])
+        # Dry-run: nothing changed
+        self.assertIn('file1.txt', self.daemon.client_snapshot)
+        self.assertTrue(os.path.isfile(self.daemon.absolutize_path('file1.txt')))
+        self.assertEqual(self.daemon.server_cursor, 10)
+
+    def test_execute_sync_plan(self):
+        saves = []
+        save_local_dir_state = self.daemon.save_local_dir_state
+
+        def counting_save_local_dir_state():
+            saves.append(dict(self.daemon.local_dir_state))
+            save_local_dir_state()
+        self.daemon.save_local_dir_state = counting_save_local_dir_state
+
+        files = self.daemon.client_snapshot.copy()
+        md5 = files['file1.txt'][1]
+        files['moved.txt'] = [2, md5]
+        files['copy.txt'] = [2, files['folder/file2.txt'][1]]
+        files['new.txt'] = [2, 'new_md5']
+        del files['file1.txt']
+        self.assertEqual(self.daemon._sync_process(2, files), [('download', 'new.txt')])
+        self.assertEqual(sorted(self.daemon.client_snapshot), ['copy.txt', 'folder/file2.txt', 'moved.txt'])
+        self.assertFalse(os.path.exists(self.daemon.absolutize_path('file1.txt')))
+        self.assertEqual(self.daemon.hash_file(self.daemon.absolutize_path('moved.txt')), md5)
+        # local_dir_state saved once, after all the local operations
+        self.assertEqual(len(saves), 1)
+        self.assertEqual(saves[0]['global_md5'], self.daemon.md5_of_client_snapshot())
+
+
+class TestBuildClientSnapshot(unittest.TestCase):
+    """
+    Test the client snapshot built with the file index.
+    """
+    def setUp(self):
+        create_environment()
+        create_files(['file1.txt', 'folder/file2.txt'])
+        self.daemon = client_daemon.Daemon(CONFIG_FILEPATH, TEST_SHARING_FOLDER)
+        self.daemon.open_file_index()
+        self.hashed = []
+        file_md5 = self.daemon._file_md5
+
+        def counting_file_md5(file_path, *args):
+            self.hashed.append(self.daemon.relativize_path(file_path))
+            return file_md5(file_path, *args)
+        self.daemon._file_md5 = counting_file_md5
+
+    def tearDown(self):
+        self.daemon.file_index.close()
+        destroy_folder()
+
+    def test_index_path(self):
+        self.assertEqual(self.daemon.file_index.path, os.path.join(CONFIG_DIR, 'file_index.db'))
+
+    def test_only_changed_files_are_hashed(self):
+        self.daemon.build_client_snapshot()
+        self.assertEqual(sorted(self.hashed), ['file1.txt', 'folder/file2.txt'])
+        snapshot = self.daemon.client_snapshot.copy()
+        self.assertEqual(snapshot['file1.txt'], ['', hashlib.md5(self.daemon.absolutize_path('file1.txt')).hexdigest()])
+
+        # A new daemon, as after a restart
+        self.daemon.file_index.close()
+        self.daemon.file_index = client_daemon.FileIndex()
+        self.daemon.open_file_index()
+        self.hashed = []
+        self.daemon.build_client_snapshot()
+        self.assertEqual(self.hashed, [])
+        self.assertEqual(self.daemon.client_snapshot, snapshot)
+
+        with open(self.daemon.absolutize_path('file1.txt'), 'a') as f:
+            f.write('changed')
+        os.remove(self.daemon.absolutize_path('folder/file2.txt'))
+        self.daemon.build_client_snapshot()
+        self.assertEqual(self.hashed, ['file1.txt'])
+        self.assertEqual(sorted(self.daemon.client_snapshot), ['file1.txt'])
+        self.assertEqual(sorted(self.daemon.file_index.entries()), ['file1.txt'])
+        # hash_file uses the index too
+        self.assertEqual(self.daemon.hash_file(self.daemon.absolutize_path('file1.txt')),
+                         self.daemon.client_snapshot['file1.txt'][1])
+        self.assertEqual(self.hashed, ['file1.txt'])
+
+    def test_server_timestamps_are_kept(self):
+        self.daemon.build_client_snapshot()
+        self.daemon._index_file('file1.txt', self.daemon.client_snapshot['file1.txt'][1], 30)
+        self.daemon.build_client_snapshot()
+        self.assertEqual(self.daemon.client_snapshot['file1.txt'][0], 30)
+        self.assertEqual(self.daemon.client_snapshot['folder/file2.txt'][0], '')
+
+
 class TestDaemonCmdManagerConnection(unittest.TestCase):
     def setUp(self):
 
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+client_snapshot test module
+"""
+import unittest
+
+from client_snapshot import ClientSnapshot
+
+FILES = {'file1.txt': [1, 'acbd18db4cc2f85cedef654fccc4a4d8'],
+         'folder/file2.txt': [2, '37b51d194a7513e45b56f6524f2d51f2'],
+         'folder/copy.txt': [3, 'acbd18db4cc2f85cedef654fccc4a4d8'],
+         }
+
+
+class TestClientSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.snapshot = ClientSnapshot(FILES)
+
+    def test_empty(self):
+        self.assertEqual(ClientSnapshot().digest(), '0' * 32)
+        self.assertNotEqual(self.snapshot.digest(), '0' * 32)
+        self.snapshot.clear()
+        self.assertEqual(self.snapshot.digest(), '0' * 32)
+
+    def test_order_independent(self):
+        snapshot = ClientSnapshot()
+        for path in sorted(FILES, reverse=True):
+            snapshot[path] = FILES[path]
+        self.assertEqual(snapshot.digest(), self.snapshot.digest())
+        self.assertEqual(snapshot, FILES)
+
+    def test_changes(self):
+        digest = self.snapshot.digest()
+        # The timestamp is not in the digest
+        self.snapshot['file1.txt'] = [10, FILES['file1.txt'][1]]
+        self.assertEqual(self.snapshot.digest(), digest)
+
+        self.snapshot['file1.txt'] = [10, 'other md5']
+        self.assertNotEqual(self.snapshot.digest(), digest)
+        self.snapshot.pop('file1.txt')
+        self.assertIsNone(self.snapshot.pop('file1.txt', None))
+        self.snapshot.setdefault('file1.txt', FILES['file1.txt'])
+        self.assertEqual(self.snapshot.digest(), digest)
+
+        # A file moved to another path
+        del self.snapshot['folder/copy.txt']
+        self.snapshot.update({'moved.txt': FILES['folder/copy.txt']})
+        self.assertNotEqual(self.snapshot.digest(), digest)
+        path, entry = self.snapshot.popitem()
+        self.snapshot[path] = entry
+        self.assertEqual(self.snapshot.digest(), ClientSnapshot(dict(self.snapshot)).digest())
+
+    def test_paths_by_md5(self):
+        md5 = FILES['file1.txt'][1]
+        self.assertEqual(self.snapshot.paths_by_md5(md5), ['file1.txt', 'folder/copy.txt'])
+        self.assertEqual(self.snapshot.paths_by_md5('unknown'), [])
+        # Only whole md5 are found
+        self.assertEqual(self.snapshot.paths_by_md5(md5[:8]), [])
+
+        self.snapshot['moved.txt'] = self.snapshot.pop('file1.txt')
+        self.assertEqual(self.snapshot.paths_by_md5(md5), ['folder/copy.txt', 'moved.txt'])
+        self.snapshot['folder/copy.txt'] = [4, 'other md5']
+        self.assertEqual(self.snapshot.paths_by_md5(md5), ['moved.txt'])
+        self.assertEqual(self.snapshot.paths_by_md5('other md5'), ['folder/copy.txt'])
+        copy = self.snapshot.copy()
+        del self.snapshot['moved.txt']
+        self.assertEqual(self.snapshot.paths_by_md5(md5), [])
+        self.assertEqual(copy.paths_by_md5(md5), ['moved.txt'])
+        copy.clear()
+        self.assertEqual(copy.paths_by_md5('other md5'), [])
+
+    def test_copy(self):
+        copy = self.snapshot.copy()
+        self.assertIsInstance(copy, ClientSnapshot)
+        copy.pop('file1.txt')
+        self.assertEqual(self.snapshot.digest(), ClientSnapshot(FILES).digest())
+        self.assertEqual(copy.digest(), ClientSnapshot(dict(copy)).digest())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -173,6 +173,26 @@ class TestCmdManagerDaemonConnection(unittest.TestCase):
         self.assertFalse(response)
 
 
+class TestDoPlan(unittest.TestCase):
+    """
+    Test the plan command (dry-run of the synchronization)
+    """
+    EMPTY_PLAN = {field: [] for field in ('downloads', 'uploads', 'modifies', 'server_deletes', 'client_deletes',
+                                          'moves', 'copies', 'conflicts')}
+
+    def test_plan(self):
+        plan = dict(self.EMPTY_PLAN, downloads=['new.txt'], moves=[['old.txt', 'folder/old.txt']])
+        self.assertEqual(CmdParserMock(plan).do_plan(''), plan)
+        self.assertEqual(client_cmdmanager.format_plan(plan).splitlines(),
+                         ['move           old.txt -> folder/old.txt', 'download       new.txt'])
+
+    def test_empty_plan(self):
+        self.assertEqual(client_cmdmanager.format_plan(self.EMPTY_PLAN), 'Already synchronized: nothing to do.')
+
+    def test_server_down(self):
+        self.assertFalse(CmdParserMock(None).do_plan(''))
+
+
 class TestDoQuitDoEOF(unittest.TestCase):
     """
     Test do_quit and EOF method
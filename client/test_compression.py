@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+compression test module: compression.py is a copy of the server module, so the server tests are run against this copy.
+"""
+import unittest
+import os
+import imp
+
+import compression
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'server')
+
+# The server tests import compression by name, so they get this copy.
+server_test_compression = imp.load_source('server_test_compression', os.path.join(SERVER_DIR, 'test_compression.py'))
+TestCompression = server_test_compression.TestCompression
+
+
+class TestCompressionCopy(unittest.TestCase):
+    def test_tested_module_is_the_client_copy(self):
+        self.assertIs(server_test_compression.compression, compression)
+
+    def test_same_as_server_module(self):
+        with open(os.path.join(SERVER_DIR, 'compression.py'), 'rb') as server_module:
+            with open(os.path.splitext(compression.__file__)[0] + '.py', 'rb') as client_module:
+                self.assertEqual(client_module.read(), server_module.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
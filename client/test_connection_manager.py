@@ -2,12 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import unittest
-from connection_manager import ConnectionManager
+import connection_manager
+from connection_manager import ConnectionManager, PARTIAL_DOWNLOAD_SUFFIX
+import delta
+import compression
 import os
 import json
 import httpretty
+import base64
+import hashlib
+import re
+import io
 import time
 import shutil
+import threading
+import tarfile
+import tempfile
+import cgi
 
 # API:
 # - GET /diffs, con parametro timestamp
@@ -301,6 +312,328 @@ class TestConnectionManager(unittest.TestCase):
         response = self.cm.do_download(data)
         self.assertEqual(response, False)
 
+    @httpretty.activate
+    def test_download_is_resumed(self):
+        url = ''.join((self.files_url, 'file.txt'))
+        content = 'some file content'
+        md5 = hashlib.md5(content).hexdigest()
+        filepath = os.path.join(self.cfg['sharing_path'], 'file.txt')
+        # A previous download was interrupted after 5 bytes
+        with open(filepath + PARTIAL_DOWNLOAD_SUFFIX, 'wb') as f:
+            f.write(content[:5])
+
+        httpretty.register_uri(httpretty.GET, url, status=206, body=content[5:])
+        response = self.cm.do_download({'filepath': 'file.txt', 'md5': md5})
+        self.assertEqual(response, True)
+        self.assertEqual(httpretty.last_request().headers['Range'], 'bytes=5-')
+        self.assertEqual(httpretty.last_request().headers['If-Range'], '"{}"'.format(md5))
+        with open(filepath) as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(filepath + PARTIAL_DOWNLOAD_SUFFIX))
+
+    @httpretty.activate
+    def test_download_of_changed_file_is_restarted(self):
+        url = ''.join((self.files_url, 'file.txt'))
+        content = 'some file content'
+        filepath = os.path.join(self.cfg['sharing_path'], 'file.txt')
+        with open(filepath + PARTIAL_DOWNLOAD_SUFFIX, 'wb') as f:
+            f.write('old c')
+
+        # If-Range not satisfied: the server sends the whole file
+        httpretty.register_uri(httpretty.GET, url, status=200, body=content)
+        response = self.cm.do_download({'filepath': 'file.txt', 'md5': hashlib.md5(content).hexdigest()})
+        self.assertEqual(response, True)
+        with open(filepath) as f:
+            self.assertEqual(f.read(), content)
+
+    @httpretty.activate
+    def test_download_with_wrong_md5(self):
+        url = ''.join((self.files_url, 'file.txt'))
+        httpretty.register_uri(httpretty.GET, url, status=200, body='corrupted content')
+        response = self.cm.do_download({'filepath': 'file.txt', 'md5': hashlib.md5('content').hexdigest()})
+        self.assertEqual(response, False)
+        filepath = os.path.join(self.cfg['sharing_path'], 'file.txt')
+        self.assertFalse(os.path.exists(filepath))
+        self.assertFalse(os.path.exists(filepath + PARTIAL_DOWNLOAD_SUFFIX))
+
+    @httpretty.activate
+    def test_download_of_already_complete_partial_file(self):
+        url = ''.join((self.files_url, 'file.txt'))
+        content = 'some file content'
+        filepath = os.path.join(self.cfg['sharing_path'], 'file.txt')
+        with open(filepath + PARTIAL_DOWNLOAD_SUFFIX, 'wb') as f:
+            f.write(content)
+
+        httpretty.register_uri(httpretty.GET, url, status=416)
+        response = self.cm.do_download({'filepath': 'file.txt', 'md5': hashlib.md5(content).hexdigest()})
+        self.assertEqual(response, True)
+        with open(filepath) as f:
+            self.assertEqual(f.read(), content)
+
+    def _make_delta(self, old_content, new_content):
+        sig = delta.signature(io.BytesIO(old_content), delta.MIN_BLOCK_SIZE)
+        delta_data = io.BytesIO()
+        delta.write_delta(sig, io.BytesIO(new_content), delta_data)
+        return sig, delta_data.getvalue()
+
+    @httpretty.activate
+    def test_download_delta(self):
+        self.cm.delta_threshold = 10
+        old_content = os.urandom(delta.MIN_BLOCK_SIZE * 3)
+        new_content = old_content + 'appended'
+        filepath = os.path.join(self.cfg['sharing_path'], 'file.dat')
+        with open(filepath, 'wb') as f:
+            f.write(old_content)
+        sig, delta_data = self._make_delta(old_content, new_content)
+        httpretty.register_uri(httpretty.POST, ''.join((self.cm.deltas_url, 'file.dat')), status=200, body=delta_data)
+
+        response = self.cm.do_download({'filepath': 'file.dat', 'md5': hashlib.md5(new_content).hexdigest()})
+        self.assertEqual(response, True)
+        self.assertEqual(json.loads(httpretty.last_request().parsed_body['signature'][0]), sig)
+        with open(filepath, 'rb') as f:
+            self.assertEqual(f.read(), new_content)
+        self.assertFalse(os.path.exists(filepath + PARTIAL_DOWNLOAD_SUFFIX))
+
+    @httpretty.activate
+    def test_download_without_convenient_delta(self):
+        self.cm.delta_threshold = 5
+        httpretty.register_uri(httpretty.POST, ''.join((self.cm.deltas_url, 'foo.txt')), status=412)
+        httpretty.register_uri(httpretty.GET, ''.join((self.files_url, 'foo.txt')), status=200, body='new content')
+
+        response = self.cm.do_download({'filepath': 'foo.txt', 'md5': hashlib.md5('new content').hexdigest()})
+        self.assertEqual(response, True)
+        with open(os.path.join(self.cfg['sharing_path'], 'foo.txt')) as f:
+            self.assertEqual(f.read(), 'new content')
+
+    @httpretty.activate
+    def test_delta_temporary_files_are_closed(self):
+        temporary_files = []
+
+        class RecordingTempfile(object):
+            # The tempfile module, as seen by connection_manager
+            def __getattr__(self, name):
+                return getattr(tempfile, name)
+
+            def TemporaryFile(self, *args, **kwargs):
+                temporary_files.append(tempfile.TemporaryFile(*args, **kwargs))
+                return temporary_files[-1]
+        connection_manager.tempfile = RecordingTempfile()
+        self.addCleanup(setattr, connection_manager, 'tempfile', tempfile)
+        self.cm.delta_threshold = 10
+        self.cm.upload_by_reference_threshold = 2 ** 30
+        content = os.urandom(delta.MIN_BLOCK_SIZE * 3)
+        with open(os.path.join(self.cfg['sharing_path'], 'file.dat'), 'wb') as f:
+            f.write(content)
+        url = ''.join((self.files_url, 'file.dat'))
+
+        # Delta not convenient: the whole file is sent
+        sig, delta_data = self._make_delta(os.urandom(len(content)), content)
+        httpretty.register_uri(httpretty.GET, ''.join((self.cm.signatures_url, 'file.dat')), status=200,
+                               body=json.dumps(sig))
+        httpretty.register_uri(httpretty.PUT, url, status=201, body=json.dumps({"server_timestamp": time.time()}))
+        self.assertTrue(self.cm.do_modify({'filepath': 'file.dat', 'md5': 'test_md5'}))
+
+        # Corrupted delta: the whole file is downloaded
+        httpretty.register_uri(httpretty.POST, ''.join((self.cm.deltas_url, 'file.dat')), status=200, body='corrupted')
+        httpretty.register_uri(httpretty.GET, url, status=200, body='new content')
+        self.assertTrue(self.cm.do_download({'filepath': 'file.dat', 'md5': hashlib.md5('new content').hexdigest()}))
+
+        self.assertEqual(len(temporary_files), 2)
+        self.assertTrue(all(f.closed for f in temporary_files))
+
+    @httpretty.activate
+    def test_do_modify_with_delta(self):
+        self.cm.delta_threshold = 10
+        self.cm.upload_by_reference_threshold = 2 ** 30
+        old_content = os.urandom(delta.MIN_BLOCK_SIZE * 3)
+        new_content = old_content[:100] + 'inserted' + old_content[100:]
+        with open(os.path.join(self.cfg['sharing_path'], 'file.dat'), 'wb') as f:
+            f.write(new_content)
+        sig, delta_data = self._make_delta(old_content, new_content)
+        httpretty.register_uri(httpretty.GET, ''.join((self.cm.signatures_url, 'file.dat')), status=200,
+                               body=json.dumps(sig))
+        js = json.dumps({"server_timestamp": time.time()})
+        httpretty.register_uri(httpretty.PUT, ''.join((self.files_url, 'file.dat')), status=201, body=js)
+
+        response = self.cm.do_modify({'filepath': 'file.dat', 'md5': 'test_md5'})
+        self.assertEqual(response, json.loads(js))
+        sent = httpretty.last_request().body
+        self.assertIn(delta_data, sent)
+        self.assertLess(len(sent), len(new_content))
+
+    @httpretty.activate
+    def test_do_modify_without_signature(self):
+        self.cm.delta_threshold = 5
+        self.cm.upload_by_reference_threshold = 2 ** 30
+        httpretty.register_uri(httpretty.GET, ''.join((self.cm.signatures_url, 'foo.txt')), status=404)
+        js = json.dumps({"server_timestamp": time.time()})
+        httpretty.register_uri(httpretty.PUT, ''.join((self.files_url, 'foo.txt')), status=201, body=js)
+
+        response = self.cm.do_modify({'filepath': 'foo.txt', 'md5': 'test_md5'})
+        self.assertEqual(response, json.loads(js))
+        self.assertIn('foo.txt :)', httpretty.last_request().body)
+
+    @httpretty.activate
+    def test_download_compressed(self):
+        content = ''.join('{},"some text"\n'.format(i) for i in range(1000))
+        compressed = ''.join(compression.iter_compressed(io.BytesIO(content), compression.get_codec('gzip')))
+        httpretty.register_uri(httpretty.GET, ''.join((self.files_url, 'data.csv')), status=200, body=compressed,
+                               adding_headers={'Content-Encoding': 'gzip'})
+
+        response = self.cm.do_download({'filepath': 'data.csv', 'md5': hashlib.md5(content).hexdigest()})
+        self.assertEqual(response, True)
+        self.assertIn('gzip', httpretty.last_request().headers['Accept-Encoding'])
+        with open(os.path.join(self.cfg['sharing_path'], 'data.csv'), 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    @httpretty.activate
+    def test_do_upload_compressed(self):
+        content = ''.join('{},"some text"\n'.format(i) for i in range(1000))
+        with open(os.path.join(self.cfg['sharing_path'], 'data.csv'), 'wb') as f:
+            f.write(content)
+        js = json.dumps({"server_timestamp": time.time()})
+        httpretty.register_uri(httpretty.GET, self.files_url, status=200, body=json.dumps({'files': {}}),
+                               adding_headers={'Accept-Encoding': 'br, deflate'})
+        httpretty.register_uri(httpretty.POST, ''.join((self.files_url, 'data.csv')), status=201, body=js)
+
+        # The content codings accepted by the server are learned from its responses
+        self.cm.do_get_server_snapshot('')
+        self.assertEqual(self.cm.server_encodings, ['br', 'deflate'])
+        self.cm.upload_by_reference_threshold = 2 ** 30
+        response = self.cm.do_upload({'filepath': 'data.csv', 'md5': 'test_md5'})
+        self.assertEqual(response, json.loads(js))
+        # The file is compressed while it's sent
+        sent = httpretty.last_request()
+        self.assertEqual(sent.headers['Transfer-Encoding'], 'chunked')
+        self.assertTrue(sent.headers['Content-Type'].startswith('multipart/form-data; boundary='))
+
+    def test_compressed_upload_body(self):
+        content = ''.join('{},"some text"\n'.format(i) for i in range(1000))
+        filepath = os.path.join(self.cfg['sharing_path'], 'data.csv')
+        with open(filepath, 'wb') as f:
+            f.write(content)
+        codec = compression.get_codec('deflate')
+        body = connection_manager.CompressedUploadBody({'md5': 'test_md5', 'content_encoding': 'deflate'},
+                                                       filepath, codec)
+        sent = ''.join(body)
+        self.assertNotIn(content, sent)
+        self.assertLess(len(sent), len(content) / 2)
+        # It can be sent again
+        self.assertEqual(''.join(body), sent)
+        form = cgi.parse_multipart(io.BytesIO(sent), {'boundary': body.boundary})
+        self.assertEqual(form['md5'], ['test_md5'])
+        self.assertEqual(form['content_encoding'], ['deflate'])
+        decompressed = io.BytesIO()
+        compression.decompress_file(io.BytesIO(form['file'][0]), decompressed, codec)
+        self.assertEqual(decompressed.getvalue(), content)
+
+    @httpretty.activate
+    def test_do_upload_bundle(self):
+        files = []
+        os.mkdir(os.path.join(self.cfg['sharing_path'], 'bundle'))
+        for i in range(3):
+            filepath = 'bundle/file{}.txt'.format(i)
+            with open(os.path.join(self.cfg['sharing_path'], filepath), 'wb') as f:
+                f.write('content {}'.format(i))
+            files.append({'filepath': filepath, 'md5': hashlib.md5('content {}'.format(i)).hexdigest()})
+        bodies = []
+
+        def request_callback(request, uri, headers):
+            bodies.append(request.body)
+            results = {}
+            for member in tarfile.open(fileobj=io.BytesIO(request.body), mode='r:*'):
+                results[member.name] = 201
+            return 200, headers, json.dumps({'results': results, 'server_timestamp': len(bodies)})
+        httpretty.register_uri(httpretty.POST, self.cm.bundles_url, body=request_callback)
+
+        self.cm.server_encodings = ['gzip']
+        old_max_files, connection_manager.BUNDLE_MAX_FILES = connection_manager.BUNDLE_MAX_FILES, 2
+        try:
+            response = self.cm.do_upload_bundle(files)
+        finally:
+            connection_manager.BUNDLE_MAX_FILES = old_max_files
+        self.assertEqual(response, {'results': {f['filepath']: 201 for f in files}, 'server_timestamp': 2})
+        self.assertEqual(httpretty.last_request().headers['Content-Type'], 'application/x-tar')
+        # Two compressed bundles, with the md5 of every file
+        self.assertEqual(len(bodies), 2)
+        bundle = tarfile.open(fileobj=io.BytesIO(bodies[0]), mode='r:gz')
+        self.assertEqual([(member.name, member.pax_headers[connection_manager.BUNDLE_MD5_HEADER])
+                          for member in bundle], [(f['filepath'], f['md5']) for f in files[:2]])
+        self.assertEqual(bundle.extractfile('bundle/file1.txt').read(), 'content 1')
+
+        httpretty.register_uri(httpretty.POST, self.cm.bundles_url, status=415)
+        self.assertFalse(self.cm.do_upload_bundle(files))
+
+    @httpretty.activate
+    def test_do_upload_bundle_with_unreadable_files(self):
+        filepath = os.path.join(self.cfg['sharing_path'], 'file.txt')
+        with open(filepath, 'wb') as f:
+            f.write('content')
+        files = [{'filepath': 'removed.txt', 'md5': 'md5'},
+                 {'filepath': 'file.txt', 'md5': hashlib.md5('content').hexdigest()}]
+        members = []
+
+        def request_callback(request, uri, headers):
+            members.extend(member.name for member in tarfile.open(fileobj=io.BytesIO(request.body), mode='r:*'))
+            return 200, headers, json.dumps({'results': {name: 201 for name in members}, 'server_timestamp': 1})
+        httpretty.register_uri(httpretty.POST, self.cm.bundles_url, body=request_callback)
+
+        # The removed files are left out
+        self.assertEqual(self.cm.do_upload_bundle(files), {'results': {'file.txt': 201}, 'server_timestamp': 1})
+        self.assertEqual(members, ['file.txt'])
+        self.assertEqual(self.cm.do_upload_bundle(files[:1]), {'results': {}})
+
+        # A file truncated while it's archived: the bundle is not sent
+        original_gettarinfo = tarfile.TarFile.gettarinfo
+
+        def gettarinfo_then_truncate(bundle, name=None, arcname=None, fileobj=None):
+            info = original_gettarinfo(bundle, name, arcname, fileobj)
+            open(name, 'wb').close()
+            return info
+        tarfile.TarFile.gettarinfo = gettarinfo_then_truncate
+        try:
+            self.assertEqual(self.cm.do_upload_bundle(files), {'results': {}})
+        finally:
+            tarfile.TarFile.gettarinfo = original_gettarinfo
+        self.assertEqual(members, ['file.txt'])
+
+    @httpretty.activate
+    def test_do_download_bundle(self):
+        files = [('new/a.txt', 'a content'), ('new/b.txt', 'b content'), ('wrong_md5.txt', 'content'),
+                 ('not_requested.txt', 'content')]
+        body = io.BytesIO()
+        bundle = tarfile.open(fileobj=body, mode='w', format=tarfile.PAX_FORMAT)
+        for path, content in files:
+            info = tarfile.TarInfo(path)
+            info.size = len(content)
+            bundle.addfile(info, io.BytesIO(content))
+        bundle.close()
+        httpretty.register_uri(httpretty.POST, ''.join((self.cm.bundles_url, 'download')), body=body.getvalue())
+
+        data = [{'filepath': path, 'md5': hashlib.md5(content).hexdigest()} for path, content in files[:2]]
+        data.append({'filepath': 'wrong_md5.txt', 'md5': 'md5'})
+        self.assertEqual(self.cm.do_download_bundle(data), ['new/a.txt', 'new/b.txt'])
+        self.assertEqual(httpretty.last_request().parsed_body['path'], ['new/a.txt', 'new/b.txt', 'wrong_md5.txt'])
+        for path, content in files[:2]:
+            with open(os.path.join(self.cfg['sharing_path'], path), 'rb') as f:
+                self.assertEqual(f.read(), content)
+        for path in ('wrong_md5.txt', 'wrong_md5.txt' + PARTIAL_DOWNLOAD_SUFFIX, 'not_requested.txt'):
+            self.assertFalse(os.path.exists(os.path.join(self.cfg['sharing_path'], path)))
+
+        httpretty.register_uri(httpretty.POST, ''.join((self.cm.bundles_url, 'download')), status=404)
+        self.assertEqual(self.cm.do_download_bundle(data), [])
+
+    @httpretty.activate
+    def test_incompressible_file_is_uploaded_uncompressed(self):
+        self.cm.server_encodings = ['gzip']
+        httpretty.register_uri(httpretty.POST, ''.join((self.files_url, 'foo.txt')), status=201,
+                               body=json.dumps({"server_timestamp": time.time()}))
+
+        self.cm.do_upload({'filepath': 'foo.txt', 'md5': 'test_md5'})
+        sent = httpretty.last_request().body
+        self.assertNotIn('content_encoding', sent)
+        self.assertIn('foo.txt :)', sent)
+
     @httpretty.activate
     def test_do_upload_success(self):
 
@@ -316,6 +649,101 @@ class TestConnectionManager(unittest.TestCase):
         response = self.cm.do_upload({'filepath': 'foo.txt', 'md5': 'test_md5'})
         self.assertEqual(response, recv_js)
 
+    def test_do_upload_of_removed_file(self):
+        self.assertFalse(self.cm.do_upload({'filepath': 'removed.txt', 'md5': 'test_md5'}))
+
+    def _register_upload_session_uris(self, received_responses):
+        upload_url = ''.join((self.cm.uploads_url, 'id1'))
+        httpretty.register_uri(httpretty.POST, self.cm.uploads_url, status=201,
+                               body=json.dumps({'upload_id': 'id1', 'chunk_size': 4, 'chunks': 3}))
+        httpretty.register_uri(httpretty.PUT, re.compile(re.escape(upload_url) + '/\d+$'), status=200, body='{}')
+        httpretty.register_uri(httpretty.GET, upload_url,
+                               responses=[httpretty.Response(body=json.dumps({'received': received}), status=200)
+                                          for received in received_responses])
+        js = json.dumps({"server_timestamp": time.time()})
+        httpretty.register_uri(httpretty.POST, upload_url, status=201, body=js, content_type="application/json")
+        return json.loads(js)
+
+    @httpretty.activate
+    def test_do_upload_with_session(self):
+        # The fake file is 10 bytes long, so it's uploaded in 3 chunks of 4 bytes
+        self.cm.upload_session_threshold = 5
+        recv_js = self._register_upload_session_uris([[0, 1, 2]])
+
+        response = self.cm.do_upload({'filepath': 'foo.txt', 'md5': 'test_md5'})
+        self.assertEqual(response, recv_js)
+        # The chunks are sent concurrently, in any order
+        chunks = [r for r in httpretty.HTTPretty.latest_requests if r.method == 'PUT']
+        self.assertEqual(sorted((r.path.rsplit('/', 1)[1], r.body) for r in chunks),
+                         [('0', 'foo.'), ('1', 'txt '), ('2', ':)')])
+
+    @httpretty.activate
+    def test_do_modify_with_session_resends_missing_chunks(self):
+        self.cm.upload_session_threshold = 5
+        recv_js = self._register_upload_session_uris([[0, 2], [0, 1, 2]])
+
+        response = self.cm.do_modify({'filepath': 'foo.txt', 'md5': 'test_md5'})
+        self.assertEqual(response, recv_js)
+        requests_sent = httpretty.HTTPretty.latest_requests
+        self.assertIn('replace=True', [r.body for r in requests_sent if r.path.endswith('/uploads/')][0])
+        chunks = [r.path.rsplit('/', 1)[1] for r in requests_sent if r.method == 'PUT']
+        self.assertEqual(sorted(chunks[:3]) + chunks[3:], ['0', '1', '2', '1'])
+
+    @httpretty.activate
+    def test_do_upload_by_reference(self):
+        self.cm.upload_by_reference_threshold = 5
+        url = ''.join((self.files_url, 'foo.txt'))
+        js = json.dumps({"server_timestamp": time.time()})
+        httpretty.register_uri(httpretty.POST, url, status=201, body=js, content_type="application/json")
+
+        response = self.cm.do_upload({'filepath': 'foo.txt', 'md5': 'test_md5', 'stored': True})
+        self.assertEqual(response, json.loads(js))
+        # Only the md5 and the size are sent
+        sent = httpretty.last_request()
+        self.assertNotIn('foo.txt :)', sent.body)
+        self.assertEqual(sent.parsed_body, {'md5': ['test_md5'], 'size': ['10']})
+
+    @httpretty.activate
+    def test_do_modify_by_reference_of_unknown_content(self):
+        self.cm.upload_by_reference_threshold = 5
+        url = ''.join((self.files_url, 'foo.txt'))
+        js = json.dumps({"server_timestamp": time.time()})
+        httpretty.register_uri(httpretty.PUT, url,
+                               responses=[httpretty.Response(body='', status=412),
+                                          httpretty.Response(body=js, status=201)])
+
+        response = self.cm.do_modify({'filepath': 'foo.txt', 'md5': 'test_md5', 'stored': True})
+        self.assertEqual(response, json.loads(js))
+        # The file is sent after the refused upload by reference
+        self.assertIn('foo.txt :)', httpretty.last_request().body)
+
+    @httpretty.activate
+    def test_unknown_contents_are_not_uploaded_by_reference(self):
+        self.cm.upload_by_reference_threshold = 5
+        url = ''.join((self.files_url, 'foo.txt'))
+        httpretty.register_uri(httpretty.POST, url, status=201, body=json.dumps({"server_timestamp": time.time()}))
+
+        self.cm.do_upload({'filepath': 'foo.txt', 'md5': 'test_md5'})
+        self.assertEqual(len([r for r in httpretty.HTTPretty.latest_requests if r.path.endswith('foo.txt')]), 1)
+        self.assertIn('foo.txt :)', httpretty.last_request().body)
+
+    @httpretty.activate
+    def test_small_files_are_not_uploaded_by_reference(self):
+        url = ''.join((self.files_url, 'foo.txt'))
+        httpretty.register_uri(httpretty.POST, url, status=201, body=json.dumps({"server_timestamp": time.time()}))
+
+        self.cm.do_upload({'filepath': 'foo.txt', 'md5': 'test_md5', 'stored': True})
+        self.assertEqual(len([r for r in httpretty.HTTPretty.latest_requests if r.path.endswith('foo.txt')]), 1)
+        self.assertIn('foo.txt :)', httpretty.last_request().body)
+
+    @httpretty.activate
+    def test_do_blobs_exist(self):
+        httpretty.register_uri(httpretty.POST, ''.join((self.cm.blobs_url, 'exists')), status=200,
+                               body=json.dumps({'existing': ['md5_1']}))
+
+        self.assertEqual(self.cm.do_blobs_exist({'md5': ['md5_1', 'md5_2']}), ['md5_1'])
+        self.assertEqual(httpretty.last_request().parsed_body, {'md5': ['md5_1', 'md5_2']})
+
     # actions:
     @httpretty.activate
     def test_do_move(self):
@@ -380,6 +808,125 @@ class TestConnectionManager(unittest.TestCase):
         response = self.cm.do_get_server_snapshot('')
         self.assertEqual(json.dumps(response), js)
 
+    @httpretty.activate
+    def test_get_server_snapshot_not_modified(self):
+        url = self.files_url
+        js = json.dumps({'files': {'foo.txt': [1, 'md5']}})
+        httpretty.register_uri(httpretty.GET, url, responses=[
+            httpretty.Response(body=js, status=200, etag='"1-1"', content_type='application/json'),
+            httpretty.Response(body='', status=304, etag='"1-1"'),
+        ])
+
+        self.assertEqual(json.dumps(self.cm.do_get_server_snapshot('')), js)
+        self.assertNotIn('If-None-Match', httpretty.last_request().headers)
+        response = self.cm.do_get_server_snapshot('')
+        self.assertEqual(httpretty.last_request().headers['If-None-Match'], '"1-1"')
+        self.assertEqual(json.dumps(response), js)
+        # The returned snapshot is a copy of the kept one
+        response['files'].clear()
+        self.assertEqual(json.dumps(self.cm.do_get_server_snapshot('')), js)
+
+    @httpretty.activate
+    def test_batch_actions(self):
+        url = ''.join((self.base_url, 'actions/batch'))
+        actions = [{'cmd': 'delete', 'filepath': 'a.txt'}, {'cmd': 'move', 'src': 'b.txt', 'dst': 'c.txt'}]
+        js = json.dumps({'results': [200, 404], 'server_timestamp': 1})
+        httpretty.register_uri(httpretty.POST, url, status=200, body=js, content_type='application/json')
+        self.assertEqual(self.cm.do_batch_actions(actions), json.loads(js))
+        self.assertEqual(json.loads(httpretty.last_request().parsed_body['actions'][0]), actions)
+
+        httpretty.register_uri(httpretty.POST, url, status=404)
+        self.assertFalse(self.cm.do_batch_actions(actions))
+
+    @httpretty.activate
+    def test_wait_server_events(self):
+        js = json.dumps({'server_timestamp': 1, 'cursor': 5})
+        httpretty.register_uri(httpretty.GET, self.cm.events_url, body=js, content_type='application/json')
+        self.assertEqual(self.cm.do_wait_server_events({'since': 4, 'timeout': 30}), json.loads(js))
+        self.assertEqual(httpretty.last_request().querystring, {'since': ['4'], 'timeout': ['30']})
+
+        httpretty.register_uri(httpretty.GET, self.cm.events_url, status=404)
+        self.assertIsNone(self.cm.do_wait_server_events({'since': 4, 'timeout': 30}))
+
+    # sessions:
+    def _register_sessions_uri(self, *tokens):
+        responses = [httpretty.Response(body=json.dumps({'token': token, 'expires_in': 3600}), status=201)
+                     for token in tokens]
+        httpretty.register_uri(httpretty.POST, self.cm.sessions_url, responses=responses)
+
+    def _sent_auth(self, request):
+        return base64.b64decode(request.headers['Authorization'].split()[1]).split(':', 1)
+
+    @httpretty.activate
+    def test_session_token_is_reused(self):
+        self._register_sessions_uri('token1')
+        httpretty.register_uri(httpretty.GET, self.files_url, status=200, body=json.dumps({'files': {}}))
+
+        self.cm.do_get_server_snapshot('')
+        self.cm.do_get_server_snapshot('')
+        requests_sent = httpretty.HTTPretty.latest_requests
+        self.assertEqual([r.path for r in requests_sent].count('/API/V1/sessions'), 1)
+        # The token is asked with the password, then it's used in place of it
+        self.assertEqual(self._sent_auth(requests_sent[0]), [self.cfg['user'], self.cfg['pass']])
+        self.assertEqual(self._sent_auth(requests_sent[-1]), [self.cfg['user'], 'token1'])
+
+    @httpretty.activate
+    def test_session_token_is_refreshed_when_expired(self):
+        self._register_sessions_uri('token1', 'token2')
+        httpretty.register_uri(httpretty.GET, self.files_url, status=200, body=json.dumps({'files': {}}))
+
+        self.cm.do_get_server_snapshot('')
+        self.cm.session_token_expiration = time.time() - 1
+        self.cm.do_get_server_snapshot('')
+        self.assertEqual(self._sent_auth(httpretty.last_request()), [self.cfg['user'], 'token2'])
+
+    @httpretty.activate
+    def test_refused_session_token_is_renewed(self):
+        self._register_sessions_uri('old_token', 'new_token')
+        js = json.dumps({'files': {}})
+        httpretty.register_uri(httpretty.GET, self.files_url,
+                               responses=[httpretty.Response(body='', status=401),
+                                          httpretty.Response(body=js, status=200)])
+
+        response = self.cm.do_get_server_snapshot('')
+        self.assertEqual(response, json.loads(js))
+        self.assertEqual(self._sent_auth(httpretty.last_request()), [self.cfg['user'], 'new_token'])
+
+    @httpretty.activate
+    def test_without_session_token_password_is_used(self):
+        httpretty.register_uri(httpretty.POST, self.cm.sessions_url, status=404)
+        httpretty.register_uri(httpretty.GET, self.files_url, status=200, body=json.dumps({'files': {}}))
+
+        self.cm.do_get_server_snapshot('')
+        self.assertEqual(self._sent_auth(httpretty.last_request()), [self.cfg['user'], self.cfg['pass']])
+
+    @httpretty.activate
+    def test_session_token_failure_is_not_retried_at_every_request(self):
+        httpretty.register_uri(httpretty.POST, self.cm.sessions_url, status=404)
+        httpretty.register_uri(httpretty.GET, self.files_url, status=200, body=json.dumps({'files': {}}))
+
+        def sessions_requests():
+            return [r.path for r in httpretty.HTTPretty.latest_requests].count('/API/V1/sessions')
+
+        self.cm.do_get_server_snapshot('')
+        self.cm.do_get_server_snapshot('')
+        self.assertEqual(sessions_requests(), 1)
+        self.assertEqual(self._sent_auth(httpretty.last_request()), [self.cfg['user'], self.cfg['pass']])
+        # The token is asked again after a while
+        self.cm.session_token_retry = time.time() - 1
+        self.cm.do_get_server_snapshot('')
+        self.assertEqual(sessions_requests(), 2)
+
+    def test_session_per_thread(self):
+        # Every thread reuses its own requests session (and its connections)
+        session = self.cm._session()
+        self.assertIs(self.cm._session(), session)
+        thread_sessions = []
+        thread = threading.Thread(target=lambda: thread_sessions.append(self.cm._session()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(thread_sessions[0], session)
+
     def tearDown(self):
         httpretty.disable()
         httpretty.reset()
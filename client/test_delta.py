@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+delta test module: delta.py is a copy of the server module, so the server tests are run against this copy.
+"""
+import unittest
+import os
+import imp
+
+import delta
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'server')
+
+# The server tests import delta by name, so they get this copy.
+server_test_delta = imp.load_source('server_test_delta', os.path.join(SERVER_DIR, 'test_delta.py'))
+TestDelta = server_test_delta.TestDelta
+
+
+class TestDeltaCopy(unittest.TestCase):
+    def test_tested_module_is_the_client_copy(self):
+        self.assertIs(server_test_delta.delta, delta)
+
+    def test_same_as_server_module(self):
+        with open(os.path.join(SERVER_DIR, 'delta.py'), 'rb') as server_module:
+            with open(os.path.splitext(delta.__file__)[0] + '.py', 'rb') as client_module:
+                self.assertEqual(client_module.read(), server_module.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+file_index test module
+"""
+import unittest
+import os
+import shutil
+import tempfile
+
+from file_index import FileIndex, Entry, stat_key
+
+
+class TestFileIndex(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.test_dir, 'file.txt')
+        with open(self.filepath, 'wb') as fp:
+            fp.write('content')
+        self.index = FileIndex(os.path.join(self.test_dir, 'file_index.db'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.test_dir)
+
+    def test_set_and_match(self):
+        st = os.stat(self.filepath)
+        self.assertIsNone(self.index.get('file.txt'))
+        self.index.set('file.txt', st, 'md5', 10)
+        entry = self.index.get('file.txt')
+        self.assertEqual(entry, Entry(*(stat_key(st) + ('md5', 10))))
+        self.assertTrue(entry.matches(st))
+
+        with open(self.filepath, 'ab') as fp:
+            fp.write(' changed')
+        self.assertFalse(entry.matches(os.stat(self.filepath)))
+
+    def test_persistence(self):
+        st = os.stat(self.filepath)
+        self.index.set('file.txt', st, 'md5')
+        self.index.close()
+        self.index = FileIndex(os.path.join(self.test_dir, 'file_index.db'))
+        self.assertEqual(self.index.entries(), {'file.txt': Entry(*(stat_key(st) + ('md5', None)))})
+
+    def test_update_move_and_delete(self):
+        st = os.stat(self.filepath)
+        entry = Entry(*(stat_key(st) + ('md5', None)))
+        self.index.update({'a': entry, 'b': entry, 'c': entry})
+        self.index.update({'d': entry}, removed=['a', 'b'])
+        self.assertEqual(sorted(self.index.entries()), ['c', 'd'])
+
+        self.assertTrue(self.index.set_timestamp('c', 20))
+        self.assertEqual(self.index.get('c').timestamp, 20)
+        self.assertTrue(self.index.move('c', 'd'))
+        self.assertFalse(self.index.move('c', 'd'))
+        self.assertEqual(self.index.get('d').timestamp, 20)
+        self.assertTrue(self.index.delete('d'))
+        self.assertFalse(self.index.delete('d'))
+        self.assertEqual(len(self.index), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
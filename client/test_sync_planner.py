@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+sync_planner test module
+"""
+import unittest
+
+from sync_planner import plan_sync, merge_changes, SyncPlan, Move, Copy, Conflict
+
+CLIENT = {'file1.txt': [1, 'md5_1'],
+          'folder/file2.txt': [2, 'md5_2'],
+          'folder/file3.txt': [3, 'md5_3'],
+          }
+LAST_TIMESTAMP = 3
+SERVER_TIMESTAMP = 10
+
+
+def plan(server, client=CLIENT, server_timestamp=SERVER_TIMESTAMP, directory_modified=False):
+    return plan_sync(client, server, server_timestamp, LAST_TIMESTAMP, directory_modified).to_dict()
+
+
+def expected(**fields):
+    expected_plan = SyncPlan()
+    for field, items in fields.iteritems():
+        setattr(expected_plan, field, items)
+    return expected_plan.to_dict()
+
+
+class TestPlanSync(unittest.TestCase):
+    def test_synchronized(self):
+        self.assertTrue(plan_sync(CLIENT, dict(CLIENT), LAST_TIMESTAMP, LAST_TIMESTAMP, False).is_empty())
+        self.assertTrue(plan_sync(CLIENT, dict(CLIENT), SERVER_TIMESTAMP, LAST_TIMESTAMP, False).is_empty())
+
+    def test_changed_on_client_only(self):
+        server = dict(CLIENT, **{'deleted.txt': [2, 'md5_4'], 'file1.txt': [1, 'old_md5']})
+        del server['folder/file3.txt']
+        self.assertEqual(plan(server, server_timestamp=LAST_TIMESTAMP, directory_modified=True),
+                         expected(server_deletes=['deleted.txt'], modifies=['file1.txt'],
+                                  uploads=['folder/file3.txt']))
+
+    def test_changed_on_server_only(self):
+        server = dict(CLIENT, **{'new.txt': [5, 'md5_4'], 'file1.txt': [5, 'new_md5']})
+        del server['folder/file3.txt']
+        self.assertEqual(plan(server), expected(downloads=['file1.txt', 'new.txt'],
+                                                client_deletes=['folder/file3.txt']))
+
+    def test_move_and_copy(self):
+        server = dict(CLIENT, **{'moved.txt': [5, 'md5_3'], 'copy.txt': [5, 'md5_1']})
+        del server['folder/file3.txt']
+        self.assertEqual(plan(server), expected(moves=[Move('folder/file3.txt', 'moved.txt')],
+                                                copies=[Copy('file1.txt', 'copy.txt')]))
+
+    def test_move_each_file_once(self):
+        # Two files with the same content moved on server: one is moved, the other one is copied
+        client = dict(CLIENT, **{'folder/copy.txt': [2, 'md5_2']})
+        server = dict(CLIENT, **{'a.txt': [5, 'md5_2'], 'b.txt': [5, 'md5_2']})
+        del server['folder/file2.txt']
+        result = plan(server, client=client, directory_modified=True)
+        self.assertEqual(sorted(src for src, dst in result['moves']), ['folder/copy.txt', 'folder/file2.txt'])
+        self.assertEqual(sorted(dst for src, dst in result['moves']), ['a.txt', 'b.txt'])
+        self.assertEqual(result['copies'], [])
+
+        del server['b.txt']
+        result = plan(server, client=client, directory_modified=True)
+        self.assertEqual(len(result['moves']), 1)
+        self.assertEqual(sorted([result['moves'][0][0]] + result['uploads']), ['folder/copy.txt', 'folder/file2.txt'])
+
+    def test_changed_on_both(self):
+        client = dict(CLIENT, **{'new_on_client.txt': [4, 'md5_5'], 'file1.txt': [4, 'client_md5'],
+                                 'folder/file2.txt': [4, 'client_md5_2']})
+        server = dict(CLIENT, **{'new_on_server.txt': [5, 'md5_4'], 'file1.txt': [5, 'server_md5'],
+                                 'folder/file2.txt': [1, 'old_md5_2'], 'deleted_on_client.txt': [1, 'md5_6']})
+        sync_plan = plan_sync(client, server, SERVER_TIMESTAMP, LAST_TIMESTAMP, True)
+        self.assertEqual(sync_plan.to_dict(),
+                         expected(downloads=['new_on_server.txt'], server_deletes=['deleted_on_client.txt'],
+                                  modifies=['folder/file2.txt'], uploads=['new_on_client.txt'],
+                                  conflicts=[Conflict('file1.txt', 'file1.txt.conflicted')]))
+        self.assertEqual(sync_plan.sync_commands(),
+                         [('delete', 'deleted_on_client.txt'), ('download', 'new_on_server.txt'),
+                          ('download', 'file1.txt'), ('modify', 'folder/file2.txt'),
+                          ('upload', 'file1.txt.conflicted'), ('upload', 'new_on_client.txt')])
+
+
+
+def change(op, path, md5=None, src=None, seq=0):
+    return {'seq': seq, 'op': op, 'path': path, 'src': src, 'timestamp': seq, 'md5': md5}
+
+
+class TestMergeChanges(unittest.TestCase):
+    def merged(self, *changes):
+        return [(item['op'], item['path'], item['md5']) for item in merge_changes(list(changes))]
+
+    def test_last_change_of_every_path(self):
+        self.assertEqual(self.merged(change('create', 'a', 'md5_1', seq=1), change('modify', 'b', 'md5_2', seq=2),
+                                     change('modify', 'a', 'md5_3', seq=3)),
+                         [('modify', 'b', 'md5_2'), ('modify', 'a', 'md5_3')])
+
+    def test_created_and_deleted(self):
+        self.assertEqual(self.merged(change('create', 'tmp', 'md5_1', seq=1), change('delete', 'tmp', seq=2)),
+                         [('delete', 'tmp', None)])
+
+    def test_moves(self):
+        # Moved away, then the destination is changed: the source is deleted, after the other changes
+        self.assertEqual(self.merged(change('move', 'b', 'md5_1', src='a', seq=1),
+                                     change('copy', 'c', 'md5_1', src='b', seq=2)),
+                         [('move', 'b', 'md5_1'), ('copy', 'c', 'md5_1'), ('delete', 'a', None)])
+        # Created, then moved
+        self.assertEqual(self.merged(change('create', 'a', 'md5_1', seq=1),
+                                     change('move', 'b', 'md5_1', src='a', seq=2)),
+                         [('move', 'b', 'md5_1'), ('delete', 'a', None)])
+        # Moved, then created again
+        self.assertEqual(self.merged(change('move', 'b', 'md5_1', src='a', seq=1),
+                                     change('create', 'a', 'md5_2', seq=2)),
+                         [('move', 'b', 'md5_1'), ('create', 'a', 'md5_2')])
+
+
+if __name__ == '__main__':
+    unittest.main()
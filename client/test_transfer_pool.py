@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+transfer_pool test module
+"""
+import time
+import threading
+import unittest
+
+from transfer_pool import TransferPool
+
+
+class TestTransferPool(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.done = []
+
+    def task(self, name, delay=0.01):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(delay)
+        with self.lock:
+            self.running -= 1
+            self.done.append(name)
+        return name.upper()
+
+    def test_results(self):
+        with TransferPool(4) as pool:
+            for name in ('a', 'b', 'c'):
+                pool.submit(name, self.task, name)
+            self.assertEqual(sorted(pool.results()), [('a', 'A'), ('b', 'B'), ('c', 'C')])
+            # The pool can be used again
+            pool.submit('d', self.task, 'd')
+            self.assertEqual(list(pool.results()), [('d', 'D')])
+
+    def test_bounded_concurrency(self):
+        with TransferPool(3) as pool:
+            for n in range(12):
+                pool.submit('file{}'.format(n), self.task, str(n))
+            self.assertEqual(len(list(pool.results())), 12)
+        self.assertLessEqual(self.max_running, 3)
+        self.assertGreater(self.max_running, 1)
+
+    def test_same_path_in_order(self):
+        with TransferPool(4) as pool:
+            # The first task on the path is the slowest: the others wait for it
+            pool.submit('file', self.task, 'first', 0.05)
+            pool.submit('other', self.task, 'other')
+            pool.submit('file', self.task, 'second')
+            pool.submit('file', self.task, 'third')
+            self.assertEqual([result for path, result in pool.results() if path == 'file'],
+                             ['FIRST', 'SECOND', 'THIRD'])
+        self.assertEqual(self.done.index('other'), 0)
+
+    def test_exception(self):
+        def fail():
+            raise IOError('transfer failed')
+        with TransferPool(2) as pool:
+            pool.submit('file', fail)
+            self.assertRaises(IOError, list, pool.results())
+
+
+if __name__ == '__main__':
+    unittest.main()
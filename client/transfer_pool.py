@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bounded pool of threads running the file transfers of a synchronization concurrently.
+
+The transfers are latency bound, so a few of them in flight at once (each thread with its own connection to the
+server, see ConnectionManager._session) make the synchronization of many files much faster. The tasks are
+submitted with the path of their file: the tasks on the same path are run one at a time, in the submission order,
+while the others run in any order.
+
+The tasks run in the pool threads, so they must not change the state of the daemon: their results are got by the
+submitting thread with results(), as they complete, and applied there.
+"""
+import sys
+import threading
+import Queue
+from collections import deque
+
+
+class TransferPool(object):
+    """
+    Pool of <workers> threads. Use it as a context manager, which closes it at the end.
+    """
+    def __init__(self, workers):
+        self._tasks = Queue.Queue()
+        self._results = Queue.Queue()
+        # Tasks waiting for the running one on the same path: {<path>: deque of (<function>, <args>)}
+        self._waiting = {}
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+        self._closed = False
+        self._threads = []
+        for n in range(max(1, workers)):
+            thread = threading.Thread(target=self._work, name='transfer {}'.format(n))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # On errors the running transfers are not waited for
+        self.close(wait=exc_type is None)
+
+    def submit(self, path, function, *args):
+        """
+        Run function(*args) in the pool, after the tasks already submitted for <path>.
+        """
+        with self._lock:
+            self._submitted += 1
+            if path in self._waiting:
+                self._waiting[path].append((function, args))
+                return
+            self._waiting[path] = deque()
+        self._tasks.put((path, function, args))
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            path, function, args = task
+            if self._closed:
+                continue
+            try:
+                self._results.put((path, function(*args), None))
+            except Exception:
+                self._results.put((path, None, sys.exc_info()))
+            with self._lock:
+                waiting = self._waiting[path]
+                if waiting:
+                    function, args = waiting.popleft()
+                    self._tasks.put((path, function, args))
+                else:
+                    del self._waiting[path]
+
+    def results(self):
+        """
+        Yield (<path>, <result>) of every submitted task, as they complete, until all of them are completed.
+        The exception raised by a task is raised again here.
+        """
+        while self._completed < self._submitted:
+            path, result, exc_info = self._results.get()
+            self._completed += 1
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield path, result
+
+    def close(self, wait=True):
+        """
+        Stop the threads, skipping the tasks not started yet. If <wait>, wait for the running tasks.
+        """
+        self._closed = True
+        for thread in self._threads:
+            self._tasks.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Content-addressable storage of the file contents ("blobs"), shared by all the users.
+
+Every distinct content is stored once, as <root>/<md5[:2]>/<md5[2:4]>/<md5>, and every user file with that content
+is a hard link to the blob. So the user files can still be read and sent from their own path, while copying a file
+is just a new link, and identical files uploaded by many users take the space of one.
+
+The reference count of a blob is the number of its links outside the store (st_nlink - 1): an unreferenced blob
+has just one link, and it's removed by release() or by the garbage collector (collect_garbage()).
+
+NB: since they are shared, blobs and user files must never be modified in place: a changed file must be written
+to a new file, then renamed over the old path (as the server does with uploads).
+If the filesystem does not support hard links (or the blob store is on another device), files are simply not
+deduplicated.
+"""
+import os
+import re
+import errno
+import hashlib
+import tempfile
+
+MD5_REGEX = re.compile(r'^[0-9a-f]{32}$')
+
+# Errors of os.link() that mean that the file can't be linked here, so it must be copied instead.
+UNLINKABLE_ERRORS = (errno.EXDEV, errno.EMLINK, errno.EPERM, errno.EOPNOTSUPP)
+
+
+def _file_md5(filepath, chunk_len=2 ** 16):
+    h = hashlib.md5()
+    with open(filepath, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_len), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _replace_with_link(src, dst):
+    """
+    Make <dst> a hard link to <src>, atomically replacing <dst> if it exists.
+    Raise OSError if the link is impossible.
+    """
+    dirpath, filename = os.path.split(dst)
+    tmp_path = tempfile.mktemp(dir=dirpath, prefix='.{}.link-'.format(filename))
+    os.link(src, tmp_path)
+    try:
+        os.rename(tmp_path, dst)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+
+
+class BlobStore(object):
+    """
+    Content-addressable store of file contents, keyed by md5 and shared by hard links.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def blob_path(self, md5):
+        """
+        Return the path of the blob with the given <md5>.
+        Raise ValueError if <md5> is not an hexadecimal md5 digest.
+        :param md5: str
+        :return: str
+        """
+        if not MD5_REGEX.match(md5):
+            raise ValueError('Invalid md5: {!r}'.format(md5))
+        return os.path.join(self.root, md5[:2], md5[2:4], md5)
+
+    def exists(self, md5):
+        """
+        Return True if a blob with the given <md5> is stored.
+        :return: bool
+        """
+        return MD5_REGEX.match(md5) is not None and os.path.isfile(self.blob_path(md5))
+
+    def refcount(self, md5):
+        """
+        Return the number of files linked to the blob, or 0 if it does not exist.
+        :return: int
+        """
+        try:
+            return os.stat(self.blob_path(md5)).st_nlink - 1
+        except OSError:
+            return 0
+
+    def store(self, filepath, md5):
+        """
+        Deduplicate the file <filepath>, whose content has the given <md5>: if the blob already exists, the file is
+        replaced with a link to it, otherwise the file becomes the blob.
+        Return False if the file can't be linked (so it's left untouched), True otherwise.
+        :param filepath: str
+        :param md5: str
+        :return: bool
+        """
+        blob_path = self.blob_path(md5)
+        if not os.path.isdir(os.path.dirname(blob_path)):
+            try:
+                os.makedirs(os.path.dirname(blob_path))
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        for attempt in range(2):
+            try:
+                if os.path.isfile(blob_path):
+                    if not os.path.samefile(filepath, blob_path):
+                        _replace_with_link(blob_path, filepath)
+                else:
+                    os.link(filepath, blob_path)
+                return True
+            except OSError as err:
+                if err.errno in UNLINKABLE_ERRORS:
+                    return False
+                if err.errno not in (errno.EEXIST, errno.ENOENT):
+                    raise
+                # The blob has been created or released meanwhile: try again.
+        return False
+
+    def link(self, md5, dst):
+        """
+        Create (or replace) the file <dst> as a link to the blob with the given <md5>.
+        Return False if the blob does not exist or it can't be linked.
+        :param md5: str
+        :param dst: str
+        :return: bool
+        """
+        if not self.exists(md5):
+            return False
+        try:
+            _replace_with_link(self.blob_path(md5), dst)
+        except OSError as err:
+            if err.errno in UNLINKABLE_ERRORS + (errno.ENOENT,):
+                return False
+            raise
+        return True
+
+    def release(self, md5):
+        """
+        Remove the blob with the given <md5> if it is not referenced anymore.
+        Return True if it has been removed.
+        :return: bool
+        """
+        blob_path = self.blob_path(md5)
+        try:
+            if os.stat(blob_path).st_nlink != 1:
+                return False
+            # The blob is moved away before checking its links again, so that it can't be linked meanwhile by
+            # another thread or process (link() just fails, and store() makes a new blob).
+            released_path = tempfile.mktemp(dir=os.path.dirname(blob_path), prefix='.released-')
+            os.rename(blob_path, released_path)
+        except OSError:
+            return False
+        if os.stat(released_path).st_nlink == 1:
+            os.remove(released_path)
+            return True
+        # Linked before being moved away: put it back
+        os.rename(released_path, blob_path)
+        return False
+
+    def collect_garbage(self):
+        """
+        Remove all the unreferenced blobs, and return their number.
+        :return: int
+        """
+        removed = 0
+        if not os.path.isdir(self.root):
+            return removed
+        for dirpath, dirs, files in os.walk(self.root):
+            for md5 in files:
+                if MD5_REGEX.match(md5) and self.release(md5):
+                    removed += 1
+        return removed
+
+    def migrate(self, file_root):
+        """
+        Convert in place the files under <file_root> (a tree of not deduplicated user files) to links to the blobs,
+        and return the number of converted files.
+        :param file_root: str
+        :return: int
+        """
+        linked = 0
+        for dirpath, dirs, files in os.walk(file_root):
+            for filename in files:
+                filepath = os.path.join(dirpath, filename)
+                if os.path.islink(filepath):
+                    continue
+                if self.store(filepath, _file_md5(filepath)):
+                    linked += 1
+        return linked
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Parallel indexing of a file tree: the md5 of every file.
+
+The tree is walked with scandir (if available: os.scandir, or the scandir package, otherwise os.listdir and
+os.stat), which gets the type of the directory entries without a stat call each. The files are hashed by a pool
+of processes, one per core, since hashing big trees is CPU and I/O bound.
+
+A previous index can be given: the md5 of a file whose size and modification time have not changed is reused
+without reading the file again.
+"""
+import os
+import stat
+import hashlib
+import logging
+import multiprocessing
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 2 ** 20
+# If there are less files than this to hash, they are hashed in the current process: starting the pool costs more.
+MIN_PARALLEL_FILES = 64
+
+
+def file_md5(filepath, chunk_size=CHUNK_SIZE):
+    """
+    Return the md5 of the file <filepath>.
+    :return: str
+    """
+    h = hashlib.md5()
+    with open(filepath, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _hash_file(args):
+    """
+    Pool worker: return (<path>, <md5>) of the file, or (<path>, None) if it can't be read.
+    """
+    path, filepath = args
+    try:
+        return path, file_md5(filepath)
+    except EnvironmentError as err:
+        logger.warning('file_md5({!r}) --> {}'.format(filepath, err))
+        return path, None
+
+
+def _list_dir(dirpath):
+    """
+    Yield (<name>, <is directory>, <stat result or None>) of the entries of <dirpath>.
+    """
+    if scandir is not None:
+        for entry in scandir(dirpath):
+            if entry.is_dir(follow_symlinks=False):
+                yield entry.name, True, None
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.name, False, entry.stat(follow_symlinks=False)
+        return
+    for name in os.listdir(dirpath):
+        st = os.lstat(os.path.join(dirpath, name))
+        if stat.S_ISDIR(st.st_mode):
+            yield name, True, None
+        elif stat.S_ISREG(st.st_mode):
+            yield name, False, st
+
+
+def scan_tree(root, exclude_prefixes=()):
+    """
+    Yield (<path>, <size>, <mtime>) of every regular file under <root>, where <path> is relative to <root>
+    (with '/' separators). The files and directories whose name starts with one of <exclude_prefixes> are skipped,
+    and so the ones that disappear while walking.
+    """
+    stack = ['']
+    while stack:
+        reldir = stack.pop()
+        try:
+            entries = list(_list_dir(os.path.join(root, reldir)))
+        except OSError as err:
+            logger.warning('scan_tree: {}'.format(err))
+            continue
+        for name, is_dir, st in entries:
+            if name.startswith(tuple(exclude_prefixes)):
+                continue
+            path = '/'.join((reldir, name)) if reldir else name
+            if is_dir:
+                stack.append(path)
+            else:
+                yield path, st.st_size, st.st_mtime
+
+
+def index_tree(root, known=None, processes=None, exclude_prefixes=(), progress=None):
+    """
+    Return the index of the files under <root>: {<path>: (<size>, <mtime>, <md5>)}.
+    :param known: dict (a previous index, whose md5 are reused for the files with the same size and mtime)
+    :param processes: int (the number of hashing processes, the number of cores by default)
+    :param exclude_prefixes: tuple (see scan_tree)
+    :param progress: function called as progress(<hashed files>, <files to hash>, <hashed bytes>, <bytes to hash>)
+    after every hashed file
+    """
+    known = known or {}
+    index = {}
+    to_hash = {}
+    for path, size, mtime in scan_tree(root, exclude_prefixes):
+        entry = known.get(path)
+        if entry and entry[0] == size and entry[1] == mtime:
+            index[path] = (size, mtime, entry[2])
+        else:
+            to_hash[path] = (size, mtime)
+    logger.info('index_tree({!r}): {:,} files, {:,} to hash'.format(root, len(index) + len(to_hash), len(to_hash)))
+
+    total_bytes = sum(size for size, mtime in to_hash.itervalues())
+    hashed_bytes = 0
+    tasks = [(path, os.path.join(root, path)) for path in to_hash]
+    if len(tasks) < MIN_PARALLEL_FILES or processes == 1:
+        pool = None
+        results = (_hash_file(task) for task in tasks)
+    else:
+        processes = processes or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes)
+        # Tasks sent in chunks, so the small files are not sent one by one, but still balanced between processes.
+        chunksize = max(1, min(64, len(tasks) // (4 * processes)))
+        results = pool.imap_unordered(_hash_file, tasks, chunksize)
+    try:
+        for done, (path, md5) in enumerate(results, 1):
+            size, mtime = to_hash[path]
+            if md5 is not None:
+                index[path] = (size, mtime, md5)
+            hashed_bytes += size
+            if progress:
+                progress(done, len(tasks), hashed_bytes, total_bytes)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return index
@@ -0,0 +1,620 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+SQLite-backed storage of the server metadata: users accounts and their files snapshots.
+
+Users are stored in the <users> table, and every file of an user snapshot is a row of the <files> table,
+indexed by (username, path) and by (username, md5), so every read or write touches only the rows it needs
+instead of the whole dataset.
+
+Every change of an user snapshot is also appended to the user change log (the <changes> table), numbered by
+an increasing sequence number, so that clients can get just the changes after the last one they know
+(see get_changes). Only the last <change_log_size> changes of every user are kept.
+
+The <file_stats> table keeps the size and modification time of the user files when they have been last indexed
+(see the indexer module), so that only the changed files have to be hashed again.
+
+The users waiting for the activation of their account are in the <pending_users> table, so that any server
+process can activate them (see the wsgi module).
+"""
+import sqlite3
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    creation_timestamp INTEGER,
+    server_timestamp INTEGER NOT NULL,
+    recoverpass_code TEXT,
+    recoverpass_timestamp INTEGER
+);
+CREATE TABLE IF NOT EXISTS files (
+    username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    PRIMARY KEY (username, path)
+);
+CREATE INDEX IF NOT EXISTS files_md5 ON files (username, md5);
+CREATE TABLE IF NOT EXISTS changes (
+    username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    op TEXT NOT NULL,
+    path TEXT NOT NULL,
+    src TEXT,
+    timestamp INTEGER,
+    md5 TEXT,
+    PRIMARY KEY (username, seq)
+);
+CREATE TABLE IF NOT EXISTS file_stats (
+    username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    md5 TEXT NOT NULL,
+    PRIMARY KEY (username, path)
+);
+CREATE TABLE IF NOT EXISTS pending_users (
+    username TEXT PRIMARY KEY,
+    activation_code TEXT NOT NULL,
+    password TEXT,
+    timestamp INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    upload_id TEXT PRIMARY KEY,
+    username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    chunk_size INTEGER NOT NULL,
+    replace INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS upload_chunks (
+    upload_id TEXT NOT NULL REFERENCES uploads(upload_id) ON DELETE CASCADE,
+    chunk_index INTEGER NOT NULL,
+    PRIMARY KEY (upload_id, chunk_index)
+);
+"""
+
+# Users table columns that can be changed by MetadataStore.update_user()
+USER_FIELDS = ('password', 'creation_timestamp', 'server_timestamp', 'recoverpass_code', 'recoverpass_timestamp')
+
+User = namedtuple('User', ('username',) + USER_FIELDS)
+
+PendingUser = namedtuple('PendingUser', ('username', 'activation_code', 'password', 'timestamp'))
+
+UPLOAD_FIELDS = ('upload_id', 'username', 'path', 'size', 'md5', 'chunk_size', 'replace', 'timestamp')
+
+Upload = namedtuple('Upload', UPLOAD_FIELDS)
+
+# Change log operations. copy and move changes have the source path in 'src'.
+CHANGE_CREATE, CHANGE_MODIFY, CHANGE_DELETE, CHANGE_COPY, CHANGE_MOVE = 'create', 'modify', 'delete', 'copy', 'move'
+CHANGE_FIELDS = ('seq', 'op', 'path', 'src', 'timestamp', 'md5')
+# Number of changes kept in the log of every user
+CHANGE_LOG_SIZE = 10000
+# The change log of an user is compacted every time this number of changes is added
+CHANGE_LOG_COMPACTION_INTERVAL = 1000
+# Seconds waited for the database lock held by another process before failing
+BUSY_TIMEOUT = 30
+
+
+class MetadataStoreError(Exception):
+    pass
+
+
+class _Connection(object):
+    """
+    A SQLite connection and the depth of the transaction() open on it.
+    """
+    def __init__(self, conn, generation):
+        self.conn = conn
+        self.generation = generation
+        self.transaction_depth = 0
+
+
+class MetadataStore(object):
+    """
+    Users and files metadata stored in a SQLite database.
+
+    The same instance can be shared by several threads: every thread uses its own connection to the database,
+    so that the readers never wait for a writer, and the transaction() context manager groups many changes
+    in a single commit. An in-memory database can't be shared by many connections, so its only connection
+    is shared by the threads, that access it one at a time.
+    The same database can be opened by several processes: a transaction waits at most BUSY_TIMEOUT seconds
+    for the ones of the other processes (and of the other threads).
+    """
+    def __init__(self, path=':memory:', change_log_size=CHANGE_LOG_SIZE):
+        self.path = None
+        self.change_log_size = change_log_size
+        # The connection of the in-memory database, used holding self._lock
+        self._shared = None
+        # The connection of every thread to the database file (see _connection)
+        self._local = threading.local()
+        # Incremented by connect() and close(), to drop the connections of the threads to the old database
+        self._generation = 0
+        self._lock = threading.RLock()
+        self.connect(path)
+
+    @staticmethod
+    def _open(path):
+        # isolation_level=None: transactions are explicitly handled by self.transaction()
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA foreign_keys = ON')
+        if path != ':memory:':
+            # With the write-ahead log every commit is an append, and readers don't block the writer.
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    def connect(self, path):
+        """
+        (Re)open the store on the database <path>, creating the tables if needed.
+        :param path: str
+        """
+        with self._lock:
+            self.close()
+            conn = self._open(path)
+            conn.executescript(SCHEMA)
+            self.path = path
+            if path == ':memory:':
+                self._shared = _Connection(conn, self._generation)
+            else:
+                self._local.connection = _Connection(conn, self._generation)
+
+    def close(self):
+        """
+        Close the connection of the current thread (the ones of the other threads are closed when they use
+        the store again, or when they end) and of the in-memory database.
+        """
+        with self._lock:
+            self._generation += 1
+            if self._shared is not None:
+                self._shared.conn.close()
+                self._shared = None
+            connection = getattr(self._local, 'connection', None)
+            if connection is not None:
+                connection.conn.close()
+                self._local.connection = None
+
+    def _connection(self):
+        """
+        Return the _Connection of the current thread to the database file, opening it the first time.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or connection.generation != self._generation:
+            if connection is not None:
+                connection.conn.close()
+            connection = self._local.connection = _Connection(self._open(self.path), self._generation)
+        return connection
+
+    @contextmanager
+    def _access(self):
+        """
+        Context manager giving the _Connection to be used by the current thread.
+        """
+        if self._shared is not None:
+            with self._lock:
+                yield self._shared
+        else:
+            yield self._connection()
+
+    @contextmanager
+    def transaction(self, write=True):
+        """
+        Context manager grouping all the changes made inside it in a single atomic commit.
+        Nested transactions are merged in the outermost one.
+        A read transaction (write=False) just reads a consistent state of the database: it neither waits for
+        the writers nor blocks them.
+        """
+        with self._access() as connection:
+            if connection.transaction_depth == 0:
+                connection.conn.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+            connection.transaction_depth += 1
+            try:
+                yield self
+            except:
+                connection.transaction_depth -= 1
+                if connection.transaction_depth == 0:
+                    connection.conn.execute('ROLLBACK')
+                raise
+            else:
+                connection.transaction_depth -= 1
+                if connection.transaction_depth == 0:
+                    connection.conn.execute('COMMIT')
+
+    def _execute(self, sql, params=()):
+        with self._access() as connection:
+            return connection.conn.execute(sql, params)
+
+    def _executemany(self, sql, seq_of_params):
+        with self._access() as connection:
+            return connection.conn.executemany(sql, seq_of_params)
+
+    def _query(self, sql, params=()):
+        with self._access() as connection:
+            return connection.conn.execute(sql, params).fetchall()
+
+    def clear(self):
+        """
+        Remove all users and files.
+        """
+        with self.transaction():
+            self._execute('DELETE FROM upload_chunks')
+            self._execute('DELETE FROM uploads')
+            self._execute('DELETE FROM changes')
+            self._execute('DELETE FROM file_stats')
+            self._execute('DELETE FROM files')
+            self._execute('DELETE FROM users')
+            self._execute('DELETE FROM pending_users')
+
+    # Users
+    # =====
+
+    def __contains__(self, username):
+        return bool(self._query('SELECT 1 FROM users WHERE username = ?', (username,)))
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM users')[0][0]
+
+    def usernames(self):
+        """
+        Return the list of registered usernames.
+        :return: list
+        """
+        return [row[0] for row in self._query('SELECT username FROM users ORDER BY username')]
+
+    def get_user(self, username):
+        """
+        Return the User data of <username>, or None if the user does not exist.
+        :param username: str
+        :return: User
+        """
+        rows = self._query('SELECT username, {} FROM users WHERE username = ?'.format(', '.join(USER_FIELDS)),
+                           (username,))
+        if rows:
+            return User(*rows[0])
+        return None
+
+    def create_user(self, username, password, creation_timestamp, server_timestamp, snapshot=None):
+        """
+        Create the user and its files snapshot ({<path>: [<timestamp>, <md5>]}).
+        Raise MetadataStoreError if the user already exists.
+        """
+        with self.transaction():
+            try:
+                self._execute('INSERT INTO users (username, password, creation_timestamp, server_timestamp) '
+                              'VALUES (?, ?, ?, ?)', (username, password, creation_timestamp, server_timestamp))
+            except sqlite3.IntegrityError:
+                raise MetadataStoreError('User "{}" already exists'.format(username))
+            if snapshot:
+                self._executemany('INSERT INTO files (username, path, timestamp, md5) VALUES (?, ?, ?, ?)',
+                                  ((username, path, timestamp, md5)
+                                   for path, (timestamp, md5) in snapshot.iteritems()))
+
+    def update_user(self, username, **fields):
+        """
+        Change the given <fields> (see USER_FIELDS) of the user.
+        Return False if the user does not exist.
+        :return: bool
+        """
+        for field in fields:
+            if field not in USER_FIELDS:
+                raise MetadataStoreError('Unknown user field "{}"'.format(field))
+        assignments = ', '.join('{} = ?'.format(field) for field in fields)
+        cursor = self._execute('UPDATE users SET {} WHERE username = ?'.format(assignments),
+                               fields.values() + [username])
+        return cursor.rowcount > 0
+
+    def delete_user(self, username):
+        """
+        Remove the user and all its files. Return False if the user does not exist.
+        :return: bool
+        """
+        with self.transaction():
+            self._execute('DELETE FROM upload_chunks WHERE upload_id IN '
+                          '(SELECT upload_id FROM uploads WHERE username = ?)', (username,))
+            self._execute('DELETE FROM uploads WHERE username = ?', (username,))
+            self._execute('DELETE FROM changes WHERE username = ?', (username,))
+            self._execute('DELETE FROM file_stats WHERE username = ?', (username,))
+            self._execute('DELETE FROM files WHERE username = ?', (username,))
+            cursor = self._execute('DELETE FROM users WHERE username = ?', (username,))
+        return cursor.rowcount > 0
+
+    # Pending users
+    # =============
+
+    def set_pending_user(self, username, activation_code, timestamp, password=None):
+        """
+        Create or replace the pending user <username>, waiting to be activated with <activation_code>.
+        """
+        self._execute('INSERT OR REPLACE INTO pending_users (username, activation_code, password, timestamp) '
+                      'VALUES (?, ?, ?, ?)', (username, activation_code, password, timestamp))
+
+    def get_pending_user(self, username):
+        """
+        Return the PendingUser data of <username>, or None if the user is not pending.
+        :return: PendingUser
+        """
+        rows = self._query('SELECT username, activation_code, password, timestamp FROM pending_users '
+                           'WHERE username = ?', (username,))
+        if rows:
+            return PendingUser(*rows[0])
+        return None
+
+    def delete_pending_user(self, username):
+        """
+        Remove the pending user. Return False if the user is not pending.
+        :return: bool
+        """
+        return self._execute('DELETE FROM pending_users WHERE username = ?', (username,)).rowcount > 0
+
+    def pending_usernames(self):
+        """
+        Return the list of the pending usernames.
+        :return: list
+        """
+        return [row[0] for row in self._query('SELECT username FROM pending_users ORDER BY username')]
+
+    def expire_pending_users(self, timestamp):
+        """
+        Remove the users pending since before <timestamp>, and return the list of their usernames.
+        :return: list
+        """
+        with self.transaction():
+            usernames = [row[0] for row in self._query('SELECT username FROM pending_users WHERE timestamp < ?',
+                                                       (timestamp,))]
+            self._execute('DELETE FROM pending_users WHERE timestamp < ?', (timestamp,))
+        return usernames
+
+    # Files
+    # =====
+
+    def get_snapshot(self, username):
+        """
+        Return the files snapshot of the user: {<path>: [<timestamp>, <md5>]}
+        :return: dict
+        """
+        rows = self._query('SELECT path, timestamp, md5 FROM files WHERE username = ?', (username,))
+        return {path: [timestamp, md5] for path, timestamp, md5 in rows}
+
+    def get_file(self, username, path):
+        """
+        Return the [<timestamp>, <md5>] of the user file <path>, or None if it does not exist.
+        :return: list
+        """
+        rows = self._query('SELECT timestamp, md5 FROM files WHERE username = ? AND path = ?', (username, path))
+        if rows:
+            return list(rows[0])
+        return None
+
+    def paths_by_md5(self, username, md5):
+        """
+        Return the list of user paths whose content has the given <md5>.
+        :return: list
+        """
+        return [row[0] for row in self._query('SELECT path FROM files WHERE username = ? AND md5 = ?',
+                                              (username, md5))]
+
+    def _touch(self, username, server_timestamp):
+        if server_timestamp is not None:
+            self._execute('UPDATE users SET server_timestamp = ? WHERE username = ?', (server_timestamp, username))
+
+    def _set_file(self, username, path, timestamp, md5):
+        """
+        Create or replace the user file <path>, and return True if it has been created.
+        :return: bool
+        """
+        created = self.get_file(username, path) is None
+        self._execute('INSERT OR REPLACE INTO files (username, path, timestamp, md5) VALUES (?, ?, ?, ?)',
+                      (username, path, timestamp, md5))
+        return created
+
+    def _delete_file(self, username, path):
+        cursor = self._execute('DELETE FROM files WHERE username = ? AND path = ?', (username, path))
+        return cursor.rowcount > 0
+
+    def set_file(self, username, path, timestamp, md5, server_timestamp=None):
+        """
+        Create or replace the user file <path>.
+        If <server_timestamp> is given, it becomes the last server timestamp of the user.
+        """
+        with self.transaction():
+            created = self._set_file(username, path, timestamp, md5)
+            self._add_change(username, (CHANGE_MODIFY, CHANGE_CREATE)[created], path, timestamp=timestamp, md5=md5)
+            self._touch(username, server_timestamp)
+
+    def delete_file(self, username, path, server_timestamp=None):
+        """
+        Remove the user file <path>. Return False if it does not exist.
+        If <server_timestamp> is given, it becomes the last server timestamp of the user.
+        :return: bool
+        """
+        with self.transaction():
+            deleted = self._delete_file(username, path)
+            if deleted:
+                self._add_change(username, CHANGE_DELETE, path, timestamp=server_timestamp)
+            self._touch(username, server_timestamp)
+        return deleted
+
+    def copy_file(self, username, src, dst, timestamp, server_timestamp=None):
+        """
+        Copy the user file <src> to <dst>, with the given <timestamp>. Return False if <src> does not exist.
+        :return: bool
+        """
+        with self.transaction():
+            entry = self.get_file(username, src)
+            if entry is None:
+                return False
+            self._set_file(username, dst, timestamp, entry[1])
+            self._add_change(username, CHANGE_COPY, dst, src=src, timestamp=timestamp, md5=entry[1])
+            self._touch(username, server_timestamp)
+        return True
+
+    def move_file(self, username, src, dst, timestamp, server_timestamp=None):
+        """
+        Move the user file <src> to <dst>, with the given <timestamp>. Return False if <src> does not exist.
+        :return: bool
+        """
+        with self.transaction():
+            entry = self.get_file(username, src)
+            if entry is None:
+                return False
+            self._delete_file(username, src)
+            self._set_file(username, dst, timestamp, entry[1])
+            self._add_change(username, CHANGE_MOVE, dst, src=src, timestamp=timestamp, md5=entry[1])
+            self._touch(username, server_timestamp)
+        return True
+
+    # Change log
+    # ==========
+
+    def _add_change(self, username, op, path, src=None, timestamp=None, md5=None):
+        """
+        Append a change to the user change log, compacting it if needed.
+        """
+        seq = self.last_change(username) + 1
+        self._execute('INSERT INTO changes (username, seq, op, path, src, timestamp, md5) '
+                      'VALUES (?, ?, ?, ?, ?, ?, ?)', (username, seq, op, path, src, timestamp, md5))
+        if seq % CHANGE_LOG_COMPACTION_INTERVAL == 0:
+            self._execute('DELETE FROM changes WHERE username = ? AND seq <= ?',
+                          (username, seq - self.change_log_size))
+
+    def last_change(self, username):
+        """
+        Return the sequence number of the last change of the user (0 if there are no changes), that is the
+        cursor to get the changes after the current snapshot.
+        :return: int
+        """
+        return self._query('SELECT COALESCE(MAX(seq), 0) FROM changes WHERE username = ?', (username,))[0][0]
+
+    def get_changes(self, username, since, limit=None):
+        """
+        Return the list of the user changes after the sequence number <since> (at most <limit>), oldest first,
+        as dicts with CHANGE_FIELDS keys.
+        Return None if the changes after <since> are not all available anymore (the log has been compacted,
+        or <since> is unknown): the whole snapshot must be got again.
+        :param since: int
+        :param limit: int
+        :return: list
+        """
+        with self.transaction(write=False):
+            first, last = self._query('SELECT MIN(seq), MAX(seq) FROM changes WHERE username = ?', (username,))[0]
+            if since > (last or 0) or since < (first or 1) - 1:
+                return None
+            rows = self._query('SELECT {} FROM changes WHERE username = ? AND seq > ? ORDER BY seq LIMIT ?'
+                               .format(', '.join(CHANGE_FIELDS)),
+                               (username, since, -1 if limit is None else limit))
+        return [dict(zip(CHANGE_FIELDS, row)) for row in rows]
+
+    # File stats
+    # ==========
+
+    def get_file_stats(self, username):
+        """
+        Return the stats of the user files when they have been last indexed: {<path>: (<size>, <mtime>, <md5>)}
+        :return: dict
+        """
+        rows = self._query('SELECT path, size, mtime, md5 FROM file_stats WHERE username = ?', (username,))
+        return {path: (size, mtime, md5) for path, size, mtime, md5 in rows}
+
+    def set_file_stats(self, username, stats):
+        """
+        Replace the stats of the user files with <stats>: {<path>: (<size>, <mtime>, <md5>)}
+        """
+        with self.transaction():
+            self._execute('DELETE FROM file_stats WHERE username = ?', (username,))
+            self._executemany('INSERT INTO file_stats (username, path, size, mtime, md5) VALUES (?, ?, ?, ?, ?)',
+                              ((username, path, size, mtime, md5)
+                               for path, (size, mtime, md5) in stats.iteritems()))
+
+    # Upload sessions
+    # ===============
+
+    def create_upload(self, upload_id, username, path, size, md5, chunk_size, replace, timestamp):
+        """
+        Open the upload session <upload_id> of the user file <path>, with the given total <size> and <md5>,
+        to be received in chunks of <chunk_size> bytes. <replace> tells if the upload modifies an existing file.
+        """
+        self._execute('INSERT INTO uploads ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(', '.join(UPLOAD_FIELDS)),
+                      (upload_id, username, path, size, md5, chunk_size, int(replace), timestamp))
+
+    def get_upload(self, upload_id):
+        """
+        Return the Upload session data of <upload_id>, or None if it does not exist.
+        :return: Upload
+        """
+        rows = self._query('SELECT {} FROM uploads WHERE upload_id = ?'.format(', '.join(UPLOAD_FIELDS)),
+                           (upload_id,))
+        if rows:
+            upload = Upload(*rows[0])
+            return upload._replace(replace=bool(upload.replace))
+        return None
+
+    def add_upload_chunk(self, upload_id, chunk_index):
+        """
+        Mark the chunk <chunk_index> of the upload session as received.
+        """
+        self._execute('INSERT OR REPLACE INTO upload_chunks (upload_id, chunk_index) VALUES (?, ?)',
+                      (upload_id, chunk_index))
+
+    def upload_chunks(self, upload_id):
+        """
+        Return the sorted list of the received chunk indexes of the upload session.
+        :return: list
+        """
+        return [row[0] for row in self._query('SELECT chunk_index FROM upload_chunks WHERE upload_id = ? '
+                                              'ORDER BY chunk_index', (upload_id,))]
+
+    def delete_upload(self, upload_id):
+        """
+        Remove the upload session. Return False if it does not exist.
+        :return: bool
+        """
+        with self.transaction():
+            self._execute('DELETE FROM upload_chunks WHERE upload_id = ?', (upload_id,))
+            cursor = self._execute('DELETE FROM uploads WHERE upload_id = ?', (upload_id,))
+        return cursor.rowcount > 0
+
+    def user_uploads(self, username):
+        """
+        Return the list of the ids of the upload sessions of the user.
+        :return: list
+        """
+        return [row[0] for row in self._query('SELECT upload_id FROM uploads WHERE username = ?', (username,))]
+
+    def expired_uploads(self, timestamp):
+        """
+        Return the list of the ids of the upload sessions opened before <timestamp>.
+        :return: list
+        """
+        return [row[0] for row in self._query('SELECT upload_id FROM uploads WHERE timestamp < ?', (timestamp,))]
+
+    # Migration
+    # =========
+
+    def import_userdata(self, userdata):
+        """
+        Import the users of an old-style <userdata> dict (the content of userdata.json):
+        {<user>: {'password': ..., 'creation_timestamp': ..., 'server_timestamp': ..., 'files': {...}}, ...}
+        Already existing users are replaced. Return the number of imported users.
+        :param userdata: dict
+        :return: int
+        """
+        with self.transaction():
+            for username, single_user_data in userdata.iteritems():
+                self.delete_user(username)
+                self.create_user(username,
+                                 single_user_data['password'],
+                                 single_user_data.get('creation_timestamp'),
+                                 single_user_data['server_timestamp'],
+                                 single_user_data.get('files'))
+                recoverpass_data = single_user_data.get('recoverpass_data')
+                if recoverpass_data:
+                    self.update_user(username,
+                                     recoverpass_code=recoverpass_data[0],
+                                     recoverpass_timestamp=recoverpass_data[1])
+        return len(userdata)
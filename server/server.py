@@ -2,27 +2,50 @@
 # -*- coding: utf-8 -*-
 import ConfigParser
 import os
+import sys
+import errno
 import json
 import shutil
 import logging
 import datetime
 import argparse
 import hashlib
+import hmac
 import time
 import string
+import threading
+import urllib
+import tempfile
+import tarfile
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows: the user locks are shared by the threads of a single process only.
+    fcntl = None
 
 join = os.path.join
 normpath = os.path.normpath
 abspath = os.path.abspath
 
-from flask import Flask, make_response, request, abort, jsonify
+from flask import Flask, Request, request, abort, jsonify, has_request_context
 from flask.ext.httpauth import HTTPBasicAuth
 from flask.ext.restful import Resource, Api
 from flask.ext.mail import Mail, Message
 from werkzeug import secure_filename
+from werkzeug.wsgi import wrap_file
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import HTTPException
 from passlib.hash import sha256_crypt
 import passwordmeter
 
+from metadata_store import MetadataStore, MetadataStoreError
+from blob_store import BlobStore
+import indexer
+import delta
+import compression
+
 __title__ = 'PyBOX'
 
 # HTTP STATUS CODES
@@ -34,24 +57,83 @@ HTTP_UNAUTHORIZED = 401
 HTTP_FORBIDDEN = 403
 HTTP_NOT_FOUND = 404
 HTTP_CONFLICT = 409
+HTTP_PRECONDITION_FAILED = 412
+HTTP_PARTIAL_CONTENT = 206
+HTTP_NOT_MODIFIED = 304
+HTTP_REQUESTED_RANGE_NOT_SATISFIABLE = 416
+HTTP_REQUEST_ENTITY_TOO_LARGE = 413
+HTTP_UNSUPPORTED_MEDIA_TYPE = 415
 
 FILE_ROOT = 'filestorage'
+# The contents of the user files are stored once here, and the user files are hard links to them (see blob_store)
+BLOB_ROOT = 'blobstorage'
+# Files being received by upload sessions (see UploadSessions) are stored here until committed
+UPLOADS_ROOT = 'uploads'
+# Directory of the lock files of the users, shared by the server processes (see UserLocks)
+LOCKS_ROOT = 'locks'
 
 URL_PREFIX = '/API/V1'
 SERVER_DIRECTORY = os.path.dirname(__file__)
-# Users login data are stored in a json file in the server
+# Users login data and files snapshots are stored in a SQLite database in the server
+METADATA_FILENAME = 'metadata.db'
+# File of the key signing the session tokens, shared by the server processes (see load_secret_key)
+SECRET_KEY_FILENAME = 'secret_key'
+# Old-style json user data file, that can be imported in the metadata database (see --import-userdata option)
 USERDATA_FILENAME = 'userdata.json'
 PASSWORD_RECOVERY_EMAIL_TEMPLATE_FILE_PATH = os.path.join(SERVER_DIRECTORY,
                                                           'password_recovery_email_template.txt')
 SIGNUP_EMAIL_TEMPLATE_FILE_PATH = os.path.join(SERVER_DIRECTORY,
                                                'signup_email_template.txt')
 
+# Verified credentials are cached to avoid running the (deliberately slow) password hash on every request.
+CREDENTIALS_CACHE_SIZE = 10000  # max number of cached users
+CREDENTIALS_CACHE_TTL = 60 * 5  # seconds
+# Session tokens (see the Sessions resource) can be used instead of the password in the basic authentication.
+SESSION_TOKEN_PREFIX = 'pybox-token:'
+SESSION_TOKEN_TTL = 60 * 60 * 12  # seconds
+
+# Downloaded files are streamed from disk in chunks of this size, unless the download is handed to a front
+# server (see --x-sendfile and --x-accel-redirect options).
+DOWNLOAD_CHUNK_SIZE = 2 ** 16
+
+# Prefix of the temporary files where uploaded files are received
+UPLOAD_TEMPFILE_PREFIX = '.pybox-upload-'
+
+# Upload sessions: size of the chunks (except the last one) and time after which an uncommitted session is removed
+UPLOAD_CHUNK_SIZE = 2 ** 22
+UPLOAD_SESSION_TIMEOUT = 60 * 60 * 24 * 10000  # expires after 1 day
+
+# Max number of changes sent in a response of the change feed (see Files.get)
+CHANGES_PAGE_SIZE = 1000
+
+# Bundle uploads (see Bundles): PAX header of every file in the archive with its md5
+BUNDLE_MD5_HEADER = 'PYBOX.md5'
+BUNDLE_CHUNK_SIZE = 2 ** 16
+
+# Max number of actions in a batch (see Actions.post)
+BATCH_MAX_ACTIONS = 1000
+
+# Long-poll of the events (see Events): default and max time (seconds) a request waits for a change
+EVENTS_TIMEOUT = 30
+# Seconds between the checks of the changes made by other server processes, which are not notified
+EVENTS_CHECK_INTERVAL = 1
+
+# Delta downloads (see Deltas) are refused when the data not found in the client file would be more than
+# this fraction of the file: the whole file is cheaper to send.
+DELTA_MAX_LITERAL_RATIO = 0.5
+
 USER_ACTIVATION_TIMEOUT = 60 * 60 * 24 * 3  # expires after 3 days
 USER_RECOVERPASS_TIMEOUT = 60 * 60 * 24 * 2 * 10000  # expires after 2 days (arbitrarily)
 
 # json key to access to the user directory snapshot:
 SNAPSHOT = 'files'
 LAST_SERVER_TIMESTAMP = 'server_timestamp'
+# json keys of the change feed (see Files.get): the cursor of the last change sent, the changes, if there are
+# more changes to get, and if the changes are not available and the whole snapshot must be got again
+CHANGES_CURSOR = 'cursor'
+CHANGES = 'changes'
+CHANGES_HAS_MORE = 'has_more'
+CHANGES_RESYNC = 'resync'
 PWD = 'password'
 USER_CREATION_TIME = 'creation_timestamp'
 DEFAULT_USER_DIRS = ('Misc', 'Music', 'Photos', 'Projects', 'Work')
@@ -59,6 +141,141 @@ DEFAULT_USER_DIRS = ('Misc', 'Music', 'Photos', 'Projects', 'Work')
 UNWANTED_PASS = 'words'
 
 
+class UserLock(object):
+    """
+    Reentrant lock of an user, held while changing the user files and their metadata.
+    The lock is shared by the threads of the process and, if it has a lock file, by the other server processes,
+    with an exclusive flock of the file while it's held.
+    """
+    def __init__(self, filepath=None):
+        self.filepath = filepath
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self):
+        self._lock.acquire()
+        if self._depth == 0 and self.filepath:
+            try:
+                self._fd = os.open(self.filepath, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except:
+                if self._fd is not None:
+                    os.close(self._fd)
+                    self._fd = None
+                self._lock.release()
+                raise
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            # Closing the file releases the flock.
+            os.close(self._fd)
+            self._fd = None
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class UserLocks(object):
+    """
+    The locks of the users (see UserLock). If <directory> is set (see create_app), the locks are shared with
+    the other server processes through their lock files in <directory>.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, username):
+        """
+        Return the lock of the user.
+        :return: UserLock
+        """
+        with self._lock:
+            lock = self._locks.get(username)
+            if lock is None:
+                filepath = None
+                if self.directory and fcntl is not None:
+                    # The lock file name is a digest, since the username can have any character.
+                    filename = hashlib.md5(username.encode('utf-8')).hexdigest() + '.lock'
+                    filepath = join(self.directory, filename)
+                lock = self._locks[username] = UserLock(filepath)
+            return lock
+
+    def clear(self):
+        with self._lock:
+            self._locks.clear()
+
+
+user_locks = UserLocks()
+
+
+def user_lock(username):
+    """
+    Return the lock of the user, held while changing the user files.
+    :return: UserLock
+    """
+    return user_locks.get(username)
+
+
+class ChangeNotifier(object):
+    """
+    Wake the requests waiting for a change of the user data (see Events).
+    Every user has a version, incremented by notify(): a waiter takes the current version before checking the
+    user data, and then waits for a newer one, so no notification can be lost in between.
+    NB: only the requests of the same process are notified.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        # Conditions of the users with waiters, and their number of waiters
+        self._conditions = {}
+
+    def version(self, username):
+        with self._lock:
+            return self._versions.get(username, 0)
+
+    def notify(self, username):
+        """
+        Notify a change of the user data, waking the requests waiting for it.
+        """
+        with self._lock:
+            self._versions[username] = self._versions.get(username, 0) + 1
+            if username in self._conditions:
+                self._conditions[username][0].notify_all()
+
+    def wait(self, username, version, timeout):
+        """
+        Wait at most <timeout> seconds for a user version newer than <version>.
+        Return True if there is one.
+        :return: bool
+        """
+        deadline = time.time() + timeout
+        with self._lock:
+            condition, waiters = self._conditions.get(username, (threading.Condition(self._lock), 0))
+            self._conditions[username] = (condition, waiters + 1)
+            try:
+                while self._versions.get(username, 0) == version:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    condition.wait(remaining)
+                return True
+            finally:
+                condition, waiters = self._conditions[username]
+                if waiters == 1:
+                    del self._conditions[username]
+                else:
+                    self._conditions[username] = (condition, waiters - 1)
+
+
 class ServerError(Exception):
     pass
 
@@ -103,19 +320,101 @@ logger.info('Server {} at {}'.format(launched_or_imported, datetime.datetime.now
 
 # Server initialization
 # =====================
-userdata = {}
-pending_users = {}
+# Users and files metadata. The store is in memory until main() connects it to METADATA_FILENAME.
+metadata = MetadataStore()
+blobs = BlobStore(BLOB_ROOT)
+notifier = ChangeNotifier()
+
+
+class HashingFile(object):
+    """
+    Wrapper of a file object that calculates the md5 of the data written in it.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self._md5 = hashlib.md5()
+
+    def write(self, data):
+        self._md5.update(data)
+        self.fp.write(data)
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+class UploadRequest(Request):
+    """
+    Request class that writes the uploaded files directly in a temporary file inside the directory of the
+    authenticated user, calculating their md5 at the same time, so that they can be verified and moved
+    to their actual path without reading or copying them again (see Files.post and Files.put).
+    """
+    def __init__(self, *args, **kwargs):
+        Request.__init__(self, *args, **kwargs)
+        self.upload_tempfiles = []
+        # Set by verify_password
+        self.authenticated_username = None
+
+    def upload_tempfile(self, dirpath=None):
+        """
+        Return a new temporary file in <dirpath>, hashing the data written in it, that is removed at the end of
+        the request unless it's moved.
+        :return: HashingFile
+        """
+        fp = tempfile.NamedTemporaryFile(dir=dirpath, prefix=UPLOAD_TEMPFILE_PREFIX, delete=False)
+        self.upload_tempfiles.append(fp.name)
+        return HashingFile(fp)
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Only the directory of an already authenticated user (see verify_password), never the one of the
+        # username just claimed by the request.
+        dirpath = None
+        if self.authenticated_username:
+            dirpath = userpath2serverpath(self.authenticated_username)
+            if not os.path.isdir(dirpath):
+                dirpath = None
+        return self.upload_tempfile(dirpath)
+
+    def close(self):
+        """
+        Close the request files, and remove the temporary ones that have not been moved to the user files.
+        """
+        Request.close(self)
+        for filepath in self.upload_tempfiles:
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.testing = __name__ != '__main__'  # Reasonable assumption?
+# Key used to sign the session tokens: create_app() sets the one shared by the server processes.
+app.config['SECRET_KEY'] = os.urandom(32)
+# Internal location of a nginx front server mapped to FILE_ROOT: if set, downloads are handed to nginx.
+app.config['X_ACCEL_REDIRECT_PREFIX'] = None
 # if True, you can see the exception traceback, suppress the sending of emails, etc.
-EMAIL_SETTINGS_FILEPATH = join(os.path.dirname(__file__),
-                               ('email_settings.ini', 'email_settings.ini.example')[app.testing])
+# The example settings configure the mail until create_app() loads the actual ones, only to run the server: the
+# administration commands (see main) don't need them.
+EMAIL_SETTINGS_FILEPATH = join(os.path.dirname(__file__), 'email_settings.ini.example')
 
 api = Api(app)
 auth = HTTPBasicAuth()
 
 
+@app.after_request
+def advertise_content_encodings(response):
+    """
+    Tell the clients the content codings accepted for the uploaded files (see Files._decode_upload),
+    with the Accept-Encoding response header (RFC 7694).
+    """
+    response.headers['Accept-Encoding'] = ', '.join(compression.codec_names())
+    return response
+
+
 def update_passwordmeter_terms(terms_file):
     """
     Added costume terms list into passwordmeter from words file
@@ -143,6 +442,22 @@ def _read_file(filename):
     return content
 
 
+def _iter_file_range(fp, start, length, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Generate the <length> bytes of the file <fp> starting from <start>, in chunks, closing the file at the end.
+    """
+    try:
+        fp.seek(start)
+        while length > 0:
+            chunk = fp.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        fp.close()
+
+
 def check_path(path, username):
     """
     Check that a path don't fall in other user directories or upper.
@@ -199,6 +514,109 @@ def _encrypt_password(password):
     return sha256_crypt.encrypt(password)
 
 
+class CredentialsCache(object):
+    """
+    Bounded cache of recently verified credentials, with a time to live.
+
+    For each user, only a keyed digest (HMAC with a random per-process secret) of username, password and
+    stored encrypted password is kept, so the plain password is never stored, and a password changed
+    elsewhere makes the cached entry useless without needing an explicit invalidation.
+    """
+    def __init__(self, maxsize=CREDENTIALS_CACHE_SIZE, ttl=CREDENTIALS_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._secret = os.urandom(32)
+        self._entries = OrderedDict()  # {<username>: (<digest>, <expiration time>)}, least recently used first
+        self._lock = threading.Lock()
+
+    def _digest(self, username, password, stored_pw):
+        message = '\0'.join(value.encode('utf-8') if isinstance(value, unicode) else value
+                            for value in (username, password, stored_pw))
+        return hmac.new(self._secret, message, hashlib.sha256).digest()
+
+    def check(self, username, password, stored_pw):
+        """
+        Return True if the credentials have been verified less than <ttl> seconds ago.
+        :return: bool
+        """
+        digest = self._digest(username, password, stored_pw)
+        with self._lock:
+            entry = self._entries.pop(username, None)
+            if entry and entry[1] > time.time() and hmac.compare_digest(entry[0], digest):
+                # Reinsert the entry as the most recently used.
+                self._entries[username] = entry
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, username, password, stored_pw):
+        """
+        Cache the verified credentials, evicting the least recently used entry if the cache is full.
+        """
+        digest = self._digest(username, password, stored_pw)
+        with self._lock:
+            self._entries.pop(username, None)
+            if len(self._entries) >= self.maxsize:
+                self._entries.popitem(last=False)
+            self._entries[username] = (digest, time.time() + self.ttl)
+
+    def invalidate(self, username):
+        """
+        Forget the cached credentials of <username> (e.g. when its password changes or it is removed).
+        """
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+credentials_cache = CredentialsCache()
+
+
+def _session_token_signature(username, stored_pw, expiration):
+    message = '\0'.join(value.encode('utf-8') if isinstance(value, unicode) else value
+                        for value in (username, str(expiration), stored_pw))
+    return hmac.new(app.config['SECRET_KEY'], message, hashlib.sha256).hexdigest()
+
+
+def create_session_token(username, stored_pw, ttl=SESSION_TOKEN_TTL):
+    """
+    Return a session token of <username> valid for <ttl> seconds, in the form
+    <SESSION_TOKEN_PREFIX><expiration time>.<signature>
+
+    The signature covers the stored encrypted password too, so changing the password revokes all the user tokens.
+    :return: str
+    """
+    expiration = int(time.time()) + ttl
+    return '{}{}.{}'.format(SESSION_TOKEN_PREFIX, expiration,
+                            _session_token_signature(username, stored_pw, expiration))
+
+
+def check_session_token(username, token, stored_pw):
+    """
+    Return True if <token> is a valid and not expired session token of <username>.
+    Just an HMAC is computed, so it's much cheaper than verifying the password.
+    :return: bool
+    """
+    if not token.startswith(SESSION_TOKEN_PREFIX):
+        return False
+    try:
+        expiration, signature = token[len(SESSION_TOKEN_PREFIX):].split('.')
+        expiration = int(expiration)
+    except ValueError:
+        return False
+    if expiration < time.time():
+        return False
+    if isinstance(signature, unicode):
+        signature = signature.encode('utf-8')
+    return hmac.compare_digest(_session_token_signature(username, stored_pw, expiration), signature)
+
+
 def init_root_structure():
     """
     Create the file root directory if needed.
@@ -239,83 +657,96 @@ def init_user_directory(username, default_dirs=DEFAULT_USER_DIRS):
     return compute_dir_state(dirpath)
 
 
-def load_userdata():
+def load_userdata(filename=USERDATA_FILENAME):
+    """
+    Load and return an old-style json user data file, or an empty dict if it does not exist.
+    :param filename: str
+    :return: dict
+    """
     data = {}
     try:
-        with open(USERDATA_FILENAME, 'rb') as fp:
+        with open(filename, 'rb') as fp:
             data = json.load(fp, 'utf-8')
     except IOError:
         # If the user data file does not exists, don't raise an exception.
-        # (the file will be created with the first user creation)
         pass
     logger.debug('Registered user(s): {}'.format(', '.join(data.keys())))
     logger.info('{:,} registered user(s) found'.format(len(data)))
     return data
 
 
-def save_userdata():
+def import_userdata(filename=USERDATA_FILENAME):
     """
-    Save module level <userdata> dict to disk as json.
-    :return: None
+    Migrate the users of an old-style json user data file to the metadata store.
+    Return the number of imported users.
+    :param filename: str
+    :return: int
     """
-    with open(USERDATA_FILENAME, 'wb') as fp:
-        json.dump(userdata, fp, 'utf-8', indent=4)
-    logger.info('Saved {:,} users'.format(len(userdata)))
+    imported = metadata.import_userdata(load_userdata(filename))
+    logger.info('Imported {:,} user(s) from "{}"'.format(imported, filename))
+    return imported
 
 
 def reset_userdata():
     """
-    Clear userdata and pending_users dictionaries.
+    Clear the metadata store (users and pending users) and the cached credentials.
     """
-    userdata.clear()
-    pending_users.clear()
+    metadata.clear()
+    credentials_cache.clear()
 
 
 @auth.verify_password
 def verify_password(username, password):
     """
     We redefine this function to check password with the encrypted one.
+    A session token (see the Sessions resource) is accepted in place of the password.
     """
     if not username:
         # Warning/info?
         return False
-    single_user_data = userdata.get(username)
-    if single_user_data:
-        stored_pw = single_user_data.get(PWD)
+    user = metadata.get_user(username)
+    if user:
+        stored_pw = user.password
         assert stored_pw is not None, 'Server error: user data must contain a password!'
-        res = sha256_crypt.verify(password, stored_pw)
+        if password and check_session_token(username, password, stored_pw):
+            res = True
+        elif credentials_cache.check(username, password, stored_pw):
+            res = True
+        else:
+            res = sha256_crypt.verify(password, stored_pw)
+            if res:
+                credentials_cache.add(username, password, stored_pw)
     else:
         logger.info('User "{}" does not exist'.format(username))
         res = False
+    if res and has_request_context():
+        # From now on the uploaded files are written in the user directory (see UploadRequest)
+        request.authenticated_username = username
     return res
 
 
-def create_user(username, password):
+def create_user(username, password, encrypted=False):
     """
     Handle the creation of a new user.
+    If <encrypted> is True, <password> is already encrypted (see _encrypt_password).
     """
     # Example of creation using requests:
     # requests.post('http://127.0.0.1:5000/API/V1/signup',
     # data={'username': 'Pippo', 'password': 'ciao'})
     logger.debug('Creating user...')
     if username and password:
-        if username in userdata:
-            # user already exists!
-            response = 'Error: username "{}" already exists!\n'.format(username), HTTP_CONFLICT
-        else:
-            enc_pass = _encrypt_password(password)
-
-            temp = init_user_directory(username)
-            last_server_timestamp, dir_snapshot = temp[LAST_SERVER_TIMESTAMP], temp[SNAPSHOT]
-
-            single_user_data = {USER_CREATION_TIME: now_timestamp(),
-                                PWD: enc_pass,
-                                LAST_SERVER_TIMESTAMP: last_server_timestamp,
-                                SNAPSHOT: dir_snapshot,
-                                }
-            userdata[username] = single_user_data
-            save_userdata()
-            response = 'User "{}" created.\n'.format(username), HTTP_CREATED
+        with user_lock(username):
+            if username in metadata:
+                # user already exists!
+                response = 'Error: username "{}" already exists!\n'.format(username), HTTP_CONFLICT
+            else:
+                enc_pass = password if encrypted else _encrypt_password(password)
+
+                temp = init_user_directory(username)
+                last_server_timestamp, dir_snapshot = temp[LAST_SERVER_TIMESTAMP], temp[SNAPSHOT]
+
+                metadata.create_user(username, enc_pass, now_timestamp(), last_server_timestamp, dir_snapshot)
+                response = 'User "{}" created.\n'.format(username), HTTP_CREATED
     else:
         response = 'Error: username or password is missing.\n', HTTP_BAD_REQUEST
     logger.debug(response)
@@ -368,11 +799,7 @@ class Users(Resource):
         and return a list of them.
         :return: list
         """
-        # Remove expired pending users.
-        to_remove = [username for (username, data) in pending_users.iteritems()
-                     if now_timestamp() - data['timestamp'] > USER_ACTIVATION_TIMEOUT]
-        [pending_users.pop(username) for username in to_remove]
-        return to_remove
+        return metadata.expire_pending_users(now_timestamp() - USER_ACTIVATION_TIMEOUT)
 
     @auth.login_required
     def get(self, username):
@@ -381,8 +808,7 @@ class Users(Resource):
         """
         logged = auth.username()
         if username == logged:
-            user_data = userdata[username]
-            creation_timestamp = user_data.get(USER_CREATION_TIME)
+            creation_timestamp = metadata.get_user(username).creation_timestamp
             if creation_timestamp:
                 time_str = time.strftime('%Y-%m-%d at %H:%M:%S', time.localtime(creation_timestamp/10000.0))
             else:
@@ -395,21 +821,23 @@ class Users(Resource):
                 if username == '__all__':
                     # Easter egg to see a list of registered and pending users.
                     logger.warn('WARNING: showing the list of all users (debug mode)!!!')
-                    if userdata:
-                        reg_users_listr = ', '.join(userdata.keys())
+                    registered_users = metadata.usernames()
+                    if registered_users:
+                        reg_users_listr = ', '.join(registered_users)
                     else:
                         reg_users_listr = 'no registered users'
-                    if pending_users:
-                        pending_users_listr = ', '.join(pending_users.keys())
+                    pending_usernames = metadata.pending_usernames()
+                    if pending_usernames:
+                        pending_users_listr = ', '.join(pending_usernames)
                     else:
                         pending_users_listr = 'no pending users'
                     response = 'Registered users: {}. Pending users: {}'.format(reg_users_listr, pending_users_listr), \
                                HTTP_OK
                 else:
                     logger.warn('WARNING: showing {}\'s info (debug mode)!!!'.format(username))
-                    if username in userdata:
-                        user_data = userdata[username]
-                        creation_timestamp = user_data.get(USER_CREATION_TIME)
+                    user = metadata.get_user(username)
+                    if user:
+                        creation_timestamp = user.creation_timestamp
                         if creation_timestamp:
                             time_str = time.strftime('%Y-%m-%d at %H:%M:%S', time.localtime(creation_timestamp))
                         else:
@@ -426,7 +854,7 @@ class Users(Resource):
         A not-logged user is asking to register himself.
         NB: username must be a valid email address.
         """
-        if username in userdata:
+        if username in metadata:
             abort(HTTP_CONFLICT)
 
         password = request.form['password']
@@ -448,26 +876,24 @@ class Users(Resource):
 
         send_email(subject, sender, recipients, text_body)
 
-        pending_users[username] = {
-            'timestamp': now_timestamp(),
-            'activation_code': activation_code,
-            PWD: password,
-        }
+        # The password is kept encrypted until the activation.
+        metadata.set_pending_user(username, activation_code, now_timestamp(), _encrypt_password(password))
         return 'User activation email sent to {}'.format(username), HTTP_OK
 
     def put(self, username):
         """
         Create user using activation code sent by email, or reset its password.
         """
-        logger.debug('Pending users: {}'.format(pending_users.keys()))
+        logger.debug('Pending users: {}'.format(metadata.pending_usernames()))
 
         # Pending users cleanup
         expired_pending_users = self._clean_pending_users()
         logging.info('Expired pending users: {}'.format(expired_pending_users))
 
-        if username in userdata:
+        user = metadata.get_user(username)
+        if user:
             # The user is already active, so it should be a request of password resetting.
-            if username in pending_users:
+            if metadata.get_pending_user(username):
                 raise ServerInternalError('User {} must\'n t be both pending and active'.format(username))
             try:
                 new_password = request.form[PWD]
@@ -475,31 +901,28 @@ class Users(Resource):
                 abort(HTTP_BAD_REQUEST)
             else:
                 request_recoverpass_code = request.form['recoverpass_code']
-                recoverpass_stuff = userdata[username].get('recoverpass_data')
-                if recoverpass_stuff:
-                    recoverpass_code, recoverpass_ctime = recoverpass_stuff
+                recoverpass_code, recoverpass_ctime = user.recoverpass_code, user.recoverpass_timestamp
+                if recoverpass_code:
                     if request_recoverpass_code == recoverpass_code and \
                             (now_timestamp() - recoverpass_ctime < USER_RECOVERPASS_TIMEOUT):
-                        userdata[PWD] = new_password
-                        #print('Updating password with "{}"'.format(new_password))
                         enc_pass = _encrypt_password(new_password)
-                        userdata[username][PWD] = enc_pass
-                        userdata[username].pop('recoverpass_data')
+                        metadata.update_user(username, password=enc_pass,
+                                             recoverpass_code=None, recoverpass_timestamp=None)
+                        credentials_cache.invalidate(username)
                         return 'Password changed succesfully', HTTP_OK
-            # NB: old generated tokens are refused, but, currently, they are not removed from userdata.
+            # NB: old generated tokens are refused, but, currently, they are not removed from metadata.
             return 'Invalid code', HTTP_NOT_FOUND
         else:
             activation_code = request.form['activation_code']
             logger.debug('Got activation code: {}'.format(activation_code))
-            logger.debug('no {} in userdata.keys() = {}'.format(username, userdata.keys()))
-            pending_user_data = pending_users.get(username)
-            if pending_user_data:
+            logger.debug('no {} in registered users'.format(username))
+            pending_user = metadata.get_pending_user(username)
+            if pending_user:
                 logger.debug('Activating user {}'.format(username))
-                if activation_code == pending_user_data['activation_code']:
+                # The pending user could be activated at the same time by another request.
+                if activation_code == pending_user.activation_code and metadata.delete_pending_user(username):
                     # Actually create user
-                    password = pending_user_data[PWD]
-                    pending_users.pop(username)
-                    return create_user(username, password)
+                    return create_user(username, pending_user.password, encrypted=True)
                 else:
                     abort(HTTP_NOT_FOUND)
             else:
@@ -527,9 +950,15 @@ class Users(Resource):
             # I mustn't delete other users!
             abort(HTTP_FORBIDDEN)
 
-        userdata.pop(username)
-        # TODO: add save_userdata()
-        shutil.rmtree(userpath2serverpath(username))
+        with user_lock(username):
+            for upload_id in metadata.user_uploads(username):
+                remove_upload_session(upload_id)
+            snapshot = metadata.get_snapshot(username)
+            metadata.delete_user(username)
+            credentials_cache.invalidate(username)
+            shutil.rmtree(userpath2serverpath(username))
+        for timestamp, md5 in snapshot.itervalues():
+            blobs.release(md5)
         return 'User "{}" removed.\n'.format(username), HTTP_OK
 
 
@@ -548,7 +977,8 @@ class UsersRecoverPassword(Resource):
         recoverpass_code = os.urandom(16).encode('hex')
 
         # The password reset must be called from an active or inactive user
-        if not(username in userdata or username in pending_users):
+        pending_user = metadata.get_pending_user(username)
+        if not(username in metadata or pending_user):
             abort(HTTP_NOT_FOUND)
 
         # Composing email
@@ -564,44 +994,111 @@ class UsersRecoverPassword(Resource):
 
         send_email(subject, sender, recipients, text_body)
 
-        if username in userdata:
-            # create or update 'recoverpass_data' key.
-            userdata[username]['recoverpass_data'] = (recoverpass_code, now_timestamp())
-        elif username in pending_users:
-            pending_users[username] = {'timestamp': now_timestamp(),
-                                       'activation_code': recoverpass_code}
+        if username in metadata:
+            # create or update the recoverpass data.
+            metadata.update_user(username, recoverpass_code=recoverpass_code, recoverpass_timestamp=now_timestamp())
+        elif pending_user:
+            metadata.set_pending_user(username, recoverpass_code, now_timestamp(), pending_user.password)
         # the else case is already covered in the first if
 
         return 'Reset email sent to {}'.format(username), HTTP_ACCEPTED
 
 
+class Sessions(Resource):
+    """
+    Exchange the user credentials for a session token, to be used instead of the password
+    in the basic authentication of next requests.
+    """
+    @auth.login_required
+    def post(self):
+        """
+        Return the new session token and its time to live in seconds in a json.
+        json format: {'token': str, 'expires_in': int}
+        """
+        username = auth.username()
+        if request.authorization.password.startswith(SESSION_TOKEN_PREFIX):
+            # A session token can't be renewed by itself: the real password is required.
+            abort(HTTP_FORBIDDEN)
+        token = create_session_token(username, metadata.get_user(username).password)
+        resp = jsonify({'token': token, 'expires_in': SESSION_TOKEN_TTL})
+        resp.status_code = HTTP_CREATED
+        return resp
+
+
 class Actions(Resource):
+    # Form fields (or keys of a batch action) of the arguments of every action
+    ARGS = {'delete': ('filepath',),
+            'copy': ('src', 'dst'),
+            'move': ('src', 'dst'),
+            }
+
     @auth.login_required
     def post(self, cmd):
+        """
+        Make the action <cmd> (delete, copy or move), and return the current server timestamp in a json.
+        json format: {LAST_SERVER_TIMESTAMP: int}
+        The batch action makes many actions at once (see _batch).
+        """
         username = auth.username()
-        methods = {'delete': self._delete,
-                   'copy': self._copy,
-                   'move': self._move,
-                   }
-        try:
-            resp = methods[cmd](username)
-        except KeyError:
+        if cmd == 'batch':
+            return self._batch(username)
+        if cmd not in self.ARGS:
             abort(HTTP_NOT_FOUND)
-        else:
-            save_userdata()
-            return resp
+        args = [request.form[arg] for arg in self.ARGS[cmd]]
+        with user_lock(username):
+            last_server_timestamp = getattr(self, '_' + cmd)(username, *args)
+        return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
 
-    def _delete(self, username):
+    def _batch(self, username):
         """
-        Delete a file for a given <filepath>, and return the current server timestamp in a json.
-        json format: {LAST_SERVER_TIMESTAMP: int}
+        Make in order the actions of the list in the form field 'actions' (json), at most BATCH_MAX_ACTIONS,
+        holding the user lock for the whole batch. Every action is a dict with the 'cmd' key and the form fields
+        of the action, e.g. {'cmd': 'move', 'src': <path>, 'dst': <path>}.
+        Return the HTTP status code of every action, and the final server timestamp in a json.
+        json format: {'results': list, LAST_SERVER_TIMESTAMP: int}
         """
-        filepath = request.form['filepath']
+        try:
+            actions = json.loads(request.form['actions'])
+        except ValueError:
+            abort(HTTP_BAD_REQUEST)
+        if not isinstance(actions, list):
+            abort(HTTP_BAD_REQUEST)
+        if len(actions) > BATCH_MAX_ACTIONS:
+            abort(HTTP_REQUEST_ENTITY_TOO_LARGE)
+        results = []
+        # The metadata of the whole batch is committed at once. The database stays locked while the files are
+        # changed, at most for BATCH_MAX_ACTIONS actions.
+        with user_lock(username), metadata.transaction():
+            for action in actions:
+                try:
+                    cmd = action['cmd']
+                    args = [action[arg] for arg in self.ARGS[cmd]]
+                    if not all(isinstance(arg, basestring) for arg in args):
+                        raise TypeError
+                except (KeyError, TypeError):
+                    results.append(HTTP_BAD_REQUEST)
+                    continue
+                try:
+                    getattr(self, '_' + cmd)(username, *args)
+                except HTTPException as e:
+                    results.append(e.code)
+                else:
+                    results.append(HTTP_OK)
+            last_server_timestamp = metadata.get_user(username).server_timestamp
+        # The actions notified their changes before the commit: the waiters must check the user data again.
+        notifier.notify(username)
+        return jsonify({'results': results, LAST_SERVER_TIMESTAMP: last_server_timestamp})
 
+    def _delete(self, username, filepath):
+        """
+        Delete a file for a given <filepath>, and return the current server timestamp.
+        :return: int
+        """
         if not check_path(filepath, username):
             abort(HTTP_FORBIDDEN)
 
         abspath = os.path.abspath(join(FILE_ROOT, username, filepath))
+        entry = metadata.get_file(username, normpath(filepath))
 
         try:
             os.remove(abspath)
@@ -609,23 +1106,20 @@ class Actions(Resource):
             # This error raises when the file is missing
             abort(HTTP_NOT_FOUND)
         self._clear_dirs(os.path.dirname(abspath), username)
+        if entry:
+            blobs.release(entry[1])
 
         # file deleted, last_server_timestamp is set to current timestamp
         last_server_timestamp = now_timestamp()
-        userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
-        userdata[username]['files'].pop(normpath(filepath))
-        save_userdata()
-        return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
+        metadata.delete_file(username, normpath(filepath), server_timestamp=last_server_timestamp)
+        notifier.notify(username)
+        return last_server_timestamp
 
-    def _copy(self, username):
+    def _copy(self, username, src, dst):
         """
-        Copy a file from a given source path to a destination path and return the current server timestamp
-        in a json file.jso
-        userdata[username]n format: {LAST_SERVER_TIMESTAMP: int}
+        Copy a file from a given source path to a destination path and return the current server timestamp.
+        :return: int
         """
-
-        src = request.form['src']
-        dst = request.form['dst']
         server_src = userpath2serverpath(username, src)
         server_dst = userpath2serverpath(username, dst)
 
@@ -635,25 +1129,38 @@ class Actions(Resource):
         if os.path.isfile(server_src):
             if not os.path.exists(os.path.dirname(server_dst)):
                 os.makedirs(os.path.dirname(server_dst))
-            shutil.copy(server_src, server_dst)
+            src_entry = metadata.get_file(username, normpath(src))
+            dst_entry = metadata.get_file(username, normpath(dst))
+            # The copy is just a new link to the content blob, if possible.
+            if not (src_entry and blobs.store(server_src, src_entry[1]) and blobs.link(src_entry[1], server_dst)):
+                # The old destination file may be linked to a blob: it must be replaced, not written in place.
+                with tempfile.NamedTemporaryFile(dir=os.path.dirname(server_dst), prefix=UPLOAD_TEMPFILE_PREFIX,
+                                                 delete=False) as fp:
+                    try:
+                        with open(server_src, 'rb') as src_fp:
+                            shutil.copyfileobj(src_fp, fp)
+                    except (IOError, OSError):
+                        os.remove(fp.name)
+                        raise
+                os.rename(fp.name, server_dst)
+            if dst_entry:
+                blobs.release(dst_entry[1])
         else:
             abort(HTTP_NOT_FOUND)
 
-        last_server_timestamp = file_timestamp(server_dst)
+        # NB: the modification time of the linked file is the one of the blob, so it can't be used.
+        last_server_timestamp = now_timestamp()
 
-        _, md5 = userdata[username]['files'][normpath(src)]
-        userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
-        userdata[username]['files'][normpath(dst)] = [last_server_timestamp, md5]
-        save_userdata()
-        return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
+        metadata.copy_file(username, normpath(src), normpath(dst), last_server_timestamp,
+                           server_timestamp=last_server_timestamp)
+        notifier.notify(username)
+        return last_server_timestamp
 
-    def _move(self, username):
+    def _move(self, username, src, dst):
         """
-        Move a file from a given source path to a destination path, and return the current server timestamp in a json.
-        json format: {LAST_SERVER_TIMESTAMP: int}
+        Move a file from a given source path to a destination path, and return the current server timestamp.
+        :return: int
         """
-        src = request.form['src']
-        dst = request.form['dst']
         server_src = userpath2serverpath(username, src)
         server_dst = userpath2serverpath(username, dst)
 
@@ -663,19 +1170,20 @@ class Actions(Resource):
         if os.path.isfile(server_src):
             if not os.path.exists(os.path.dirname(server_dst)):
                 os.makedirs(os.path.dirname(server_dst))
+            dst_entry = metadata.get_file(username, normpath(dst))
             shutil.move(server_src, server_dst)
+            if dst_entry:
+                blobs.release(dst_entry[1])
         else:
             abort(HTTP_NOT_FOUND)
         self._clear_dirs(os.path.dirname(server_src), username)
 
         last_server_timestamp = now_timestamp()
 
-        _, md5 = userdata[username]['files'][normpath(src)]
-        userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
-        userdata[username]['files'].pop(normpath(src))
-        userdata[username]['files'][normpath(dst)] = [last_server_timestamp, md5]
-        save_userdata()
-        return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
+        metadata.move_file(username, normpath(src), normpath(dst), last_server_timestamp,
+                           server_timestamp=last_server_timestamp)
+        notifier.notify(username)
+        return last_server_timestamp
 
     def _clear_dirs(self, path, root):
         """
@@ -716,29 +1224,101 @@ def compute_dir_state(root_path):  # TODO: make function accepting just an usern
     """
     Walk on root_path returning the directory snapshot in a dict (dict keys are identified by this 2 constants:
     LAST_SERVER_TIMESTAMP and SNAPSHOT)
+    The files are hashed in parallel (see the indexer module).
 
     :param root_path: str
     :return: dict.
     """
-    snapshot = {}
     last_timestamp = now_timestamp()
-    for dirpath, dirs, files in os.walk(root_path):
-        for filename in files:
-            filepath = join(dirpath, filename)
-
-            # Open file and calculate md5.
-            try:
-                with open(filepath, 'rb') as fp:
-                    md5 = calculate_file_md5(fp)
-            except OSError as err:
-                logging.warn('calculate_file_md5("{}") --> {}'.format(filepath, err))
-            else:
-                snapshot[filepath[len(root_path) + 1:]] = [last_timestamp, md5]
+    index = indexer.index_tree(root_path, exclude_prefixes=(UPLOAD_TEMPFILE_PREFIX,))
+    snapshot = {path: [last_timestamp, md5] for path, (size, mtime, md5) in index.iteritems()}
     state = {LAST_SERVER_TIMESTAMP: last_timestamp,
              SNAPSHOT: snapshot}
     return state
 
 
+def reindex_user(username, processes=None, progress=None):
+    """
+    Rebuild the metadata of the user files from the file storage, hashing the files in parallel (see the indexer
+    module): only the ones changed since the last reindex are hashed again. The differences with the metadata
+    store are recorded as changes. Return the number of files added, modified and removed.
+    :param processes: int (the number of hashing processes, the number of cores by default)
+    :param progress: function (see indexer.index_tree)
+    :return: tuple
+    """
+    root_path = userpath2serverpath(username)
+    if isinstance(root_path, str):
+        # So the found paths are unicode, like the ones in the metadata store
+        root_path = root_path.decode('utf-8')
+    index = indexer.index_tree(root_path, metadata.get_file_stats(username), processes,
+                               (UPLOAD_TEMPFILE_PREFIX,), progress)
+    added = modified = removed = 0
+    with user_lock(username), metadata.transaction():
+        snapshot = metadata.get_snapshot(username)
+        last_server_timestamp = now_timestamp()
+        for path in set(snapshot).difference(index):
+            metadata.delete_file(username, path, server_timestamp=last_server_timestamp)
+            removed += 1
+        for path, (size, mtime, md5) in index.iteritems():
+            entry = snapshot.get(path)
+            if entry is None or entry[1] != md5:
+                metadata.set_file(username, path, long(mtime * 10000), md5, server_timestamp=last_server_timestamp)
+                if entry is None:
+                    added += 1
+                else:
+                    modified += 1
+        metadata.set_file_stats(username, index)
+    if added or modified or removed:
+        notifier.notify(username)
+    return added, modified, removed
+
+
+def print_progress(done, total, done_bytes, total_bytes):
+    """
+    Print the progress of a reindex (see indexer.index_tree) on the console.
+    """
+    if done == total or done % 100 == 0:
+        sys.stderr.write('\r{:,}/{:,} files hashed ({:.0%} of {:,} bytes)'.format(
+            done, total, float(done_bytes) / total_bytes if total_bytes else 1, total_bytes))
+        if done == total:
+            sys.stderr.write('\n')
+
+
+def user_has_content(username, md5):
+    """
+    Return True if a file of the user has the content with the given <md5>.
+    :return: bool
+    """
+    return bool(metadata.paths_by_md5(username, md5))
+
+
+def update_user_path(username, path, md5=None, timestamp=None):
+    """
+    Make all needed updates to the metadata store after a file upload (a post, a put or an upload session commit).
+    Return the last modification int timestamp of written file (or the given <timestamp>).
+    :param username: str
+    :param path: str
+    :param md5: str (the md5 of the file, if already known, otherwise it's calculated)
+    :param timestamp: int
+    :return: int
+    """
+    filepath = userpath2serverpath(username, path)
+    last_server_timestamp = file_timestamp(filepath) if timestamp is None else timestamp
+    if md5 is None:
+        with open(filepath, 'rb') as fp:
+            md5 = calculate_file_md5(fp)
+    with user_lock(username):
+        old_entry = metadata.get_file(username, normpath(path))
+        # Store the content in the blob store (or just link the file to it, if it's already there).
+        blobs.store(filepath, md5)
+        metadata.set_file(username, normpath(path), last_server_timestamp, md5,
+                          server_timestamp=last_server_timestamp)
+        if old_entry:
+            blobs.release(old_entry[1])
+    notifier.notify(username)
+    return last_server_timestamp
+
+
 class Files(Resource):
     """
     Class that handle files as web resources.
@@ -748,7 +1328,9 @@ class Files(Resource):
     def get(self, path=''):
         """
         Download an authenticated user file from server, if <path> is not empty,
-        otherwise get a server snapshot of user directory.
+        otherwise get a server snapshot of user directory, with the cursor of its last change.
+        If the 'since' parameter is given (the cursor of a previous response), only the changes after it
+        are returned instead of the whole snapshot (see _changes_response).
         <path> is the path relative to the user local directory.
         :param path: str
         """
@@ -768,22 +1350,171 @@ class Files(Resource):
             s_filename = secure_filename(os.path.split(path)[-1])
 
             try:
-                response = make_response(_read_file(join(FILE_ROOT, username, path)))
+                fp = open(join(FILE_ROOT, username, path), 'rb')
             except IOError:
                 response = 'Error: file {} not found.\n'.format(path), HTTP_NOT_FOUND
             else:
+                response = self._file_response(username, path, fp)
                 response.headers['Content-Disposition'] = 'attachment; filename=%s' % s_filename
+        elif 'since' in request.args:
+            response = self._changes_response(username, request.args.get('since', type=int))
         else:
             # If path is not given, return the snapshot of user directory.
-            logger.debug('launch snapshot of {}...'.format(repr(user_rootpath)))
-            snapshot = userdata[username][SNAPSHOT]
-            logger.info('snapshot returned {:,} files'.format(len(snapshot)))
-            last_server_timestamp = userdata[username][LAST_SERVER_TIMESTAMP]
-            response = jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp,
-                                SNAPSHOT: snapshot})
+            response = self._snapshot_response(username)
         logging.debug(response)
         return response
 
+    def _snapshot_response(self, username):
+        """
+        Return the response with the snapshot of the user directory.
+        The snapshot changes only along with the user LAST_SERVER_TIMESTAMP and last change, so they make its
+        strong ETag: if the client already has it (If-None-Match header), an empty 304 response is returned
+        without even reading the snapshot.
+        """
+        with metadata.transaction(write=False):
+            last_server_timestamp = metadata.get_user(username).server_timestamp
+            cursor = metadata.last_change(username)
+            etag = '{}-{}'.format(last_server_timestamp, cursor)
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=HTTP_NOT_MODIFIED)
+                response.set_etag(etag)
+                return response
+            logger.debug('launch snapshot of {}...'.format(repr(username)))
+            snapshot = metadata.get_snapshot(username)
+        logger.info('snapshot returned {:,} files'.format(len(snapshot)))
+        response = jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp,
+                            SNAPSHOT: snapshot,
+                            CHANGES_CURSOR: cursor})
+        response.set_etag(etag)
+        return response
+
+    def _changes_response(self, username, since):
+        """
+        Return the response with the user changes after the cursor <since>, at most CHANGES_PAGE_SIZE:
+        json format: {LAST_SERVER_TIMESTAMP: int, CHANGES: list, CHANGES_CURSOR: int, CHANGES_HAS_MORE: bool}
+        Every change is a dict with keys 'seq', 'op' (create, modify, delete, copy or move), 'path',
+        'src' (for copy and move), 'timestamp', 'md5'.
+        If the changes after <since> are not available anymore, the client must get the whole snapshot again:
+        json format: {LAST_SERVER_TIMESTAMP: int, CHANGES_RESYNC: True}
+        :param since: int
+        """
+        if since is None:
+            abort(HTTP_BAD_REQUEST)
+        with metadata.transaction(write=False):
+            changes = metadata.get_changes(username, since, CHANGES_PAGE_SIZE + 1)
+            last_server_timestamp = metadata.get_user(username).server_timestamp
+        if changes is None:
+            return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp, CHANGES_RESYNC: True})
+        has_more = len(changes) > CHANGES_PAGE_SIZE
+        changes = changes[:CHANGES_PAGE_SIZE]
+        return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp,
+                        CHANGES: changes,
+                        CHANGES_CURSOR: changes[-1]['seq'] if changes else since,
+                        CHANGES_HAS_MORE: has_more})
+
+    def _file_response(self, username, path, fp):
+        """
+        Return the response to download the user file <path>, open in <fp>, without reading it in memory:
+        the file is streamed in chunks, or just its location is given to the front server if configured.
+        Last-Modified and ETag (the md5 of the file) headers are taken from the user snapshot.
+        :param fp: file
+        :return: Response
+        """
+        size = os.fstat(fp.fileno()).st_size
+        if app.config['X_ACCEL_REDIRECT_PREFIX']:
+            fp.close()
+            response = app.response_class()
+            location = '/'.join([app.config['X_ACCEL_REDIRECT_PREFIX'].rstrip('/'), username, normpath(path)])
+            response.headers['X-Accel-Redirect'] = urllib.quote(location.encode('utf-8'))
+        elif app.use_x_sendfile:
+            fp.close()
+            response = app.response_class()
+            response.headers['X-Sendfile'] = userpath2serverpath(username, path)
+        else:
+            response = app.response_class(direct_passthrough=True)
+        response.mimetype = 'application/octet-stream'
+        response.content_length = size
+        response.headers['Accept-Ranges'] = 'bytes'
+        codec = None
+        if not fp.closed:
+            response.vary.add('Accept-Encoding')
+            codec = self._response_codec(fp, size, path)
+
+        entry = metadata.get_file(username, normpath(path))
+        if entry:
+            last_modified, md5 = entry
+            response.last_modified = last_modified / 10000.0
+            # The md5 is of the file content: the ETag of its compressed encoding is weak.
+            response.set_etag(md5, weak=codec is not None)
+        else:
+            response.last_modified = file_timestamp(userpath2serverpath(username, path)) / 10000.0
+        # Answer 304 (Not Modified) to conditional requests (If-None-Match, If-Modified-Since) if possible.
+        response.make_conditional(request)
+
+        if fp.closed:
+            # The front server handles the file and its ranges.
+            return response
+        if response.status_code != HTTP_OK:
+            fp.close()
+            return response
+        byte_range = self._requested_range(size, response)
+        if byte_range is None and codec is not None:
+            response.response = compression.iter_compressed(fp, codec, DOWNLOAD_CHUNK_SIZE)
+            response.content_length = None
+            response.headers['Content-Encoding'] = codec.name
+        elif byte_range is None:
+            response.response = wrap_file(request.environ, fp, DOWNLOAD_CHUNK_SIZE)
+        elif byte_range:
+            start, stop = byte_range
+            response.response = _iter_file_range(fp, start, stop - start)
+            response.status_code = HTTP_PARTIAL_CONTENT
+            response.content_length = stop - start
+            response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+        else:
+            fp.close()
+            response.status_code = HTTP_REQUESTED_RANGE_NOT_SATISFIABLE
+            response.content_length = 0
+            response.headers['Content-Range'] = 'bytes */{}'.format(size)
+        return response
+
+    def _response_codec(self, fp, size, path):
+        """
+        Return the codec to compress the downloaded file <path>, open in <fp>, or None to send it as it is:
+        the file is compressed if the client accepts a registered content coding, and the file is worth it
+        (see compression.should_compress). Ranges are always sent uncompressed.
+        :param fp: file
+        :param size: int
+        :return: compression.Codec
+        """
+        if request.range is not None:
+            return None
+        name = request.accept_encodings.best_match(compression.codec_names())
+        if name is None or not compression.should_compress(fp, size, path):
+            return None
+        return compression.get_codec(name)
+
+    def _requested_range(self, size, response):
+        """
+        Return the (start, stop) byte range of the file to send, according to the Range and If-Range headers,
+        or None to send the whole file, or False if the requested range can't be satisfied.
+        :param size: int
+        :param response: Response (with ETag and Last-Modified headers already set)
+        """
+        byte_range = request.range
+        # Multiple ranges are not supported: the whole file is sent (as allowed by RFC 7233).
+        if byte_range is None or len(byte_range.ranges) != 1:
+            return None
+        if_range = request.if_range
+        if if_range.etag is not None:
+            etag = response.get_etag()[0]
+            if not etag or if_range.etag != etag:
+                # The file has changed since the partial download started.
+                return None
+        elif if_range.date is not None:
+            if response.last_modified is None or if_range.date != response.last_modified:
+                return None
+        return byte_range.range_for_length(size) or False
+
     def _get_dirname_filename(self, path):
         """
         Return dirname(directory name) and filename(file name) for a given path to complete
@@ -799,20 +1530,74 @@ class Files(Resource):
 
         return dirname, filename
 
-    def _update_user_path(self, username, path):
+    def _upload_tempfile(self, username):
         """
-        Make all needed updates to <userdata> (dict and disk) after a post or a put.
-        Return the last modification int timestamp of written file.
-        :param username: str
-        :param path: str
+        Return a new temporary file in the user directory, hashing the data written in it, that is removed at
+        the end of the request unless it's moved to the user files (like the uploaded files, see UploadRequest).
+        :return: HashingFile
+        """
+        return request.upload_tempfile(userpath2serverpath(username))
+
+    def _decode_upload(self, username, upload_file):
+        """
+        Return the uploaded file decompressed, if it's compressed with the content coding given in the
+        'content_encoding' form field. Abort with HTTP_UNSUPPORTED_MEDIA_TYPE if the coding is unknown,
+        or HTTP_BAD_REQUEST if the data is corrupted.
+        :param upload_file: werkzeug.datastructures.FileStorage (or None)
+        :return: werkzeug.datastructures.FileStorage (or None)
+        """
+        content_encoding = request.form.get('content_encoding')
+        if upload_file is None or not content_encoding:
+            return upload_file
+        codec = compression.get_codec(content_encoding)
+        if codec is None:
+            abort(HTTP_UNSUPPORTED_MEDIA_TYPE)
+        decoded = self._upload_tempfile(username)
+        upload_file.stream.seek(0)
+        try:
+            compression.decompress_file(upload_file.stream, decoded, codec)
+        except ValueError as e:
+            logger.info('Files: invalid upload: {}'.format(e))
+            abort(HTTP_BAD_REQUEST)
+        upload_file.stream.close()
+        return FileStorage(stream=decoded)
+
+    def _check_upload(self, username, upload_file, md5):
+        """
+        Abort with HTTP_CONFLICT if the uploaded file content doesn't match <md5>.
+        If no file is uploaded, the file is created by linking the already stored content with the given <md5>
+        (and the optional 'size' form field): abort with HTTP_PRECONDITION_FAILED if it's not stored, or if no
+        file of the user has that content (the md5 of a content is not a proof of having it).
+        :param upload_file: werkzeug.datastructures.FileStorage (or None)
+        :param md5: str
+        """
+        if upload_file is None:
+            size = request.form.get('size', type=int)
+            if not (user_has_content(username, md5) and blobs.exists(md5)) or \
+                    (size is not None and os.path.getsize(blobs.blob_path(md5)) != size):
+                abort(HTTP_PRECONDITION_FAILED)
+        elif upload_file.stream.hexdigest() != md5:
+            abort(HTTP_CONFLICT)
+
+    def _save_upload(self, username, path, upload_file, md5):
+        """
+        Move the uploaded file (or link the stored content with the given <md5>, if no file is uploaded)
+        to the user <path>, replacing the existing one if any, and update the metadata store.
+        The upload has been already written in a temporary file in the user directory, and hashed, while
+        receiving it (see UploadRequest), so it's just renamed, atomically.
+        Return the last server timestamp.
+        :param upload_file: werkzeug.datastructures.FileStorage (or None)
         :return: int
         """
         filepath = userpath2serverpath(username, path)
-        last_server_timestamp = file_timestamp(filepath)
-        userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
-        userdata[username]['files'][normpath(path)] = [last_server_timestamp, calculate_file_md5(open(filepath, 'rb'))]
-        save_userdata()
-        return last_server_timestamp
+        if upload_file is None:
+            if not blobs.link(md5, filepath):
+                abort(HTTP_PRECONDITION_FAILED)
+            # The modification time of the linked file is the one of the stored content.
+            return update_user_path(username, path, md5, now_timestamp())
+        upload_file.stream.close()
+        shutil.move(upload_file.stream.name, filepath)
+        return update_user_path(username, path, md5)
 
     @auth.login_required
     def post(self, path):
@@ -820,72 +1605,680 @@ class Files(Resource):
         Upload an authenticated user file to the server, given the path relative to the user directory.
         Return the file timestamp of the file created in the server.
         The file must not exist in the server, otherwise only return an http forbidden code.
+        If the file content is already stored in the server, the file can be sent by reference, giving
+        its md5 (and size) only, without the file (see _check_upload).
+        The file can be sent compressed (see _decode_upload).
         :param path: str
         """
         username = auth.username()
 
-        upload_file = request.files['file']
+        upload_file = self._decode_upload(username, request.files.get('file'))
         md5 = request.form['md5']
         dirname, filename = self._get_dirname_filename(path)
 
-        if calculate_file_md5(upload_file) != md5:
-            abort(HTTP_CONFLICT)
-
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        else:
-            if os.path.isfile(join(dirname, filename)):
-                abort(HTTP_FORBIDDEN)
+        self._check_upload(username, upload_file, md5)
 
-        filepath = join(dirname, filename)
-        upload_file.save(filepath)
+        with user_lock(username):
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            else:
+                if os.path.isfile(join(dirname, filename)):
+                    abort(HTTP_FORBIDDEN)
 
-        # Update and save <userdata>, and return the last server timestamp.
-        last_server_timestamp = self._update_user_path(username, path)
+            # Update the metadata store, and return the last server timestamp.
+            last_server_timestamp = self._save_upload(username, path, upload_file, md5)
 
         resp = jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
         resp.status_code = HTTP_CREATED
         return resp
 
+    def _apply_delta(self, username, filepath, delta_file):
+        """
+        Rebuild the new version of the user file <filepath> from its current version and the uploaded delta
+        (see the delta module), in a temporary file in the user directory, hashing it while writing.
+        Abort with HTTP_BAD_REQUEST if the delta is malformed.
+        Return the rebuilt file, like an uploaded file (see UploadRequest).
+        :param delta_file: werkzeug.datastructures.FileStorage
+        :return: werkzeug.datastructures.FileStorage
+        """
+        rebuilt = self._upload_tempfile(username)
+        delta_file.stream.seek(0)
+        try:
+            with open(filepath, 'rb') as basis:
+                delta.apply_delta(basis, delta_file.stream, rebuilt)
+        except ValueError as e:
+            logger.info('Files.put: invalid delta for {}: {}'.format(repr(filepath), e))
+            abort(HTTP_BAD_REQUEST)
+        return FileStorage(stream=rebuilt)
+
     @auth.login_required
     def put(self, path):
         """
         Modify an authenticated user file in the server (uploading and overwriting it)
         given the path relative to the user directory. The file must exist in the server.
         Return the file timestamp of the file updated in the server.
+        Like in post, the file can be sent by reference or compressed.
+        Instead of the file, a delta from the server file (form field 'delta', see the delta module and the
+        Signatures resource) can be sent: the file is rebuilt and verified against <md5> before replacing it.
         :param path: str
         """
         username = auth.username()
-        upload_file = request.files['file']
+        upload_file = self._decode_upload(username, request.files.get('file'))
+        delta_file = request.files.get('delta')
         md5 = request.form['md5']
         dirname, filename = self._get_dirname_filename(path)
 
-        if calculate_file_md5(upload_file) != md5:
-            abort(HTTP_CONFLICT)
-
         filepath = join(dirname, filename)
-        if os.path.isfile(filepath):
-            upload_file.save(filepath)
-        else:
+        if not os.path.isfile(filepath):
             abort(HTTP_NOT_FOUND)
 
-        # Update and save <userdata>, and return the last server timestamp.
-        last_server_timestamp = self._update_user_path(username, path)
+        if upload_file is None and delta_file is not None:
+            upload_file = self._apply_delta(username, filepath, delta_file)
+        self._check_upload(username, upload_file, md5)
+
+        with user_lock(username):
+            if not os.path.isfile(filepath):
+                # Removed meanwhile
+                abort(HTTP_NOT_FOUND)
+            # Update the metadata store, and return the last server timestamp.
+            last_server_timestamp = self._save_upload(username, path, upload_file, md5)
 
         resp = jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
         resp.status_code = HTTP_CREATED
         return resp
 
 
+def get_user_filepath(path):
+    """
+    Return the server path of the existing file <path> of the authenticated user,
+    or abort with HTTP_FORBIDDEN or HTTP_NOT_FOUND.
+    :param path: str
+    :return: str
+    """
+    username = auth.username()
+    if not check_path(path, username):
+        abort(HTTP_FORBIDDEN)
+    filepath = userpath2serverpath(username, path)
+    if not os.path.isfile(filepath):
+        abort(HTTP_NOT_FOUND)
+    return filepath
+
+
+class Signatures(Resource):
+    """
+    Block signatures of the user files, to upload their modifications as deltas (see the delta module).
+    """
+    @auth.login_required
+    def get(self, path):
+        """
+        Return the signature of the user file <path>, with the block size given by the 'block_size' parameter
+        or chosen by the file size. The ETag is the md5 of the file.
+        json format: {'block_size': int, 'blocks': [[weak checksum, strong hash], ...]}
+        """
+        filepath = get_user_filepath(path)
+        block_size = request.args.get('block_size', type=int) or delta.block_size_for(os.path.getsize(filepath))
+        block_size = min(max(block_size, delta.MIN_BLOCK_SIZE), delta.MAX_BLOCK_SIZE)
+        with open(filepath, 'rb') as fp:
+            response = jsonify(delta.signature(fp, block_size))
+        entry = metadata.get_file(auth.username(), normpath(path))
+        if entry:
+            response.set_etag(entry[1])
+        return response
+
+
+class Deltas(Resource):
+    """
+    Deltas to download the new version of a user file, given the signature of the version the client has.
+    """
+    @auth.login_required
+    def post(self, path):
+        """
+        Return the delta (see the delta module) to rebuild the user file <path> from the client file with the
+        given signature (form field 'signature', json). The ETag is the md5 of the rebuilt file.
+        Abort with HTTP_PRECONDITION_FAILED if most of the file would be sent anyway: the whole file must
+        be downloaded instead.
+        """
+        filepath = get_user_filepath(path)
+        try:
+            sig = json.loads(request.form['signature'])
+            block_size = int(sig['block_size'])
+            if not delta.MIN_BLOCK_SIZE <= block_size <= delta.MAX_BLOCK_SIZE:
+                raise ValueError('Invalid block size')
+            sig = {'block_size': block_size,
+                   'blocks': [(int(weak), str(strong)) for weak, strong in sig['blocks']]}
+        except (KeyError, TypeError, ValueError):
+            abort(HTTP_BAD_REQUEST)
+
+        out = tempfile.TemporaryFile()
+        with open(filepath, 'rb') as fp:
+            max_literal_length = int(os.fstat(fp.fileno()).st_size * DELTA_MAX_LITERAL_RATIO)
+            complete = delta.write_delta(sig, fp, out, max_literal_length)
+        if not complete:
+            out.close()
+            abort(HTTP_PRECONDITION_FAILED)
+        response = app.response_class(direct_passthrough=True)
+        response.mimetype = 'application/octet-stream'
+        response.content_length = out.tell()
+        out.seek(0)
+        response.response = wrap_file(request.environ, out, DOWNLOAD_CHUNK_SIZE)
+        entry = metadata.get_file(auth.username(), normpath(path))
+        if entry:
+            response.set_etag(entry[1])
+        return response
+
+
+class Blobs(Resource):
+    """
+    Stored file contents (see blob_store), shared by all users.
+    """
+    @auth.login_required
+    def post(self, cmd):
+        """
+        exists: given a list of md5 (form field 'md5', repeated), return the ones whose content is already
+        stored in the server for a file of the user, so the files with those contents can be uploaded by reference
+        (see Files.post). The contents of the other users are never disclosed.
+        json format: {'existing': list}
+        """
+        if cmd != 'exists':
+            abort(HTTP_NOT_FOUND)
+        username = auth.username()
+        return jsonify({'existing': [md5 for md5 in request.form.getlist('md5')
+                                     if user_has_content(username, md5) and blobs.exists(md5)]})
+
+
+def iter_bundle(username, entries):
+    """
+    Yield the tar archive of the user files <entries> (a list of (path, [timestamp, md5])), generated while it's
+    sent: every file is read in chunks after its header, which has the file md5 in the BUNDLE_MD5_HEADER PAX header.
+    The files that can't be opened are skipped.
+    """
+    for path, (timestamp, md5) in entries:
+        try:
+            fp = open(userpath2serverpath(username, path), 'rb')
+        except IOError:
+            continue
+        with fp:
+            # The user files are never modified in place (see blob_store), so the open file can't change.
+            info = tarfile.TarInfo(path)
+            info.size = os.fstat(fp.fileno()).st_size
+            info.mtime = timestamp // 10000
+            info.mode = 0644
+            info.pax_headers = {BUNDLE_MD5_HEADER: md5}
+            yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8')
+            for chunk in iter(lambda: fp.read(BUNDLE_CHUNK_SIZE), ''):
+                yield chunk
+            yield tarfile.NUL * (-info.size % tarfile.BLOCKSIZE)
+    # End of archive
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+class Bundles(Resource):
+    """
+    Upload and download of many (small) files at once, in a tar archive.
+    """
+    @auth.login_required
+    def post(self, cmd=None):
+        """
+        Upload a bundle of files (see _upload) or, with cmd 'download', download one (see _download).
+        """
+        username = auth.username()
+        if cmd is None:
+            return self._upload(username)
+        if cmd == 'download':
+            return self._download(username)
+        abort(HTTP_NOT_FOUND)
+
+    def _download(self, username):
+        """
+        Return a tar archive of the user files with the paths in the form field 'path' (repeated) and of the ones
+        in the directory in the form field 'prefix' (all the files if empty), streamed while it's generated
+        (see iter_bundle). The paths not found are skipped.
+        """
+        paths = request.form.getlist('path')
+        prefix = request.form.get('prefix')
+        if prefix is not None and not check_path(prefix, username):
+            abort(HTTP_FORBIDDEN)
+        snapshot = metadata.get_snapshot(username)
+        entries = OrderedDict()
+        for path in paths:
+            path = normpath(path)
+            if path in snapshot:
+                entries[path] = snapshot[path]
+        if prefix is not None:
+            prefix = normpath(prefix) + '/' if prefix.strip('/.') else ''
+            for path in sorted(snapshot):
+                if path.startswith(prefix):
+                    entries[path] = snapshot[path]
+        logger.info('Bundles: sending {:,} files'.format(len(entries)))
+        return app.response_class(iter_bundle(username, entries.items()), mimetype='application/x-tar',
+                                  direct_passthrough=True)
+
+    def _upload(self, username):
+        """
+        Create or modify the user files in the tar archive sent as request body (content type application/x-tar,
+        optionally gzip or bzip2 compressed), that is read while it's received. Every file must have its md5
+        in the BUNDLE_MD5_HEADER PAX header: the files are verified, then all written with a single commit of
+        the metadata.
+        Return the HTTP status code of every path (HTTP_CREATED, HTTP_OK if modified, HTTP_BAD_REQUEST if not a
+        regular file or without md5, HTTP_FORBIDDEN, HTTP_CONFLICT if the md5 doesn't match) and the final
+        server timestamp in a json.
+        json format: {'results': {<path>: int}, LAST_SERVER_TIMESTAMP: int}
+        """
+        if request.mimetype != 'application/x-tar':
+            abort(HTTP_UNSUPPORTED_MEDIA_TYPE)
+        results = {}
+        received = []
+        try:
+            bundle = tarfile.open(fileobj=request.stream, mode='r|*')
+            for member in bundle:
+                path = member.name
+                md5 = member.pax_headers.get(BUNDLE_MD5_HEADER)
+                if not member.isfile() or not md5:
+                    results[path] = HTTP_BAD_REQUEST
+                    continue
+                if not check_path(path, username):
+                    results[path] = HTTP_FORBIDDEN
+                    continue
+                upload_file = request.upload_tempfile(userpath2serverpath(username))
+                fp = bundle.extractfile(member)
+                for chunk in iter(lambda: fp.read(BUNDLE_CHUNK_SIZE), ''):
+                    upload_file.write(chunk)
+                upload_file.close()
+                if upload_file.hexdigest() != md5:
+                    results[path] = HTTP_CONFLICT
+                    continue
+                received.append((path, upload_file.name, md5))
+        except (tarfile.TarError, EOFError, IOError) as e:
+            logger.info('Bundles.post: invalid bundle: {}'.format(e))
+            abort(HTTP_BAD_REQUEST)
+
+        with user_lock(username):
+            # The files are moved in place first, then their metadata is written in a single short commit
+            stored = OrderedDict()
+            released = []
+            # NB: the modification time of a file linked to an existing blob is the one of the blob, so it can't
+            # be used.
+            timestamp = now_timestamp()
+            for path, upload_filepath, md5 in received:
+                filepath = userpath2serverpath(username, path)
+                existing = os.path.isfile(filepath)
+                if os.path.isdir(filepath):
+                    results[path] = HTTP_CONFLICT
+                    continue
+                try:
+                    if not os.path.isdir(os.path.dirname(filepath)):
+                        os.makedirs(os.path.dirname(filepath))
+                    shutil.move(upload_filepath, filepath)
+                except (IOError, OSError):
+                    # e.g. a directory in the path is a file
+                    results[path] = HTTP_CONFLICT
+                    continue
+                old_entry = metadata.get_file(username, normpath(path))
+                if old_entry:
+                    released.append(old_entry[1])
+                if path in stored:
+                    # Sent twice in the bundle
+                    released.append(stored.pop(path))
+                blobs.store(filepath, md5)
+                stored[path] = md5
+                results[path] = HTTP_OK if existing else HTTP_CREATED
+            with metadata.transaction():
+                last_server_timestamp = metadata.get_user(username).server_timestamp
+                if stored:
+                    # The server timestamp never goes back
+                    last_server_timestamp = max(last_server_timestamp, timestamp)
+                for path, md5 in stored.iteritems():
+                    metadata.set_file(username, normpath(path), timestamp, md5,
+                                      server_timestamp=last_server_timestamp)
+            for md5 in released:
+                blobs.release(md5)
+        if stored:
+            notifier.notify(username)
+        return jsonify({'results': results, LAST_SERVER_TIMESTAMP: last_server_timestamp})
+
+
+class Events(Resource):
+    """
+    Notification of the changes of the user data, by long-poll.
+    """
+    @auth.login_required
+    def get(self):
+        """
+        Wait until the user data changes after the change cursor 'since' (see Files.get), at most 'timeout'
+        seconds (EVENTS_TIMEOUT by default, and at most), then return the current cursor: if it's not 'since',
+        the client must get the changes.
+        json format: {LAST_SERVER_TIMESTAMP: int, CHANGES_CURSOR: int}
+        """
+        username = auth.username()
+        since = request.args.get('since', type=int)
+        if since is None:
+            abort(HTTP_BAD_REQUEST)
+        timeout = min(max(request.args.get('timeout', EVENTS_TIMEOUT, type=float), 0), EVENTS_TIMEOUT)
+        deadline = time.time() + timeout
+        while True:
+            version = notifier.version(username)
+            remaining = deadline - time.time()
+            if metadata.last_change(username) != since or remaining <= 0:
+                break
+            # The changes made by the other server processes are not notified: the change log is checked again
+            # every EVENTS_CHECK_INTERVAL seconds.
+            notifier.wait(username, version, min(remaining, EVENTS_CHECK_INTERVAL))
+        with metadata.transaction(write=False):
+            cursor = metadata.last_change(username)
+            last_server_timestamp = metadata.get_user(username).server_timestamp
+        return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp, CHANGES_CURSOR: cursor})
+
+
+def upload_session_filepath(upload_id):
+    """
+    Return the path of the server file where the chunks of the upload session are written.
+    :param upload_id: str
+    :return: str
+    """
+    return join(UPLOADS_ROOT, upload_id)
+
+
+class UploadSessionLock(object):
+    """
+    Lock of an upload session, taken on its open partial file <fp>: shared while a chunk is written, so the chunks
+    are still received in parallel, and exclusive while the session is committed.
+    Without fcntl, a single lock of the process is used for all the sessions.
+    """
+    _process_lock = threading.Lock()
+
+    def __init__(self, fp, exclusive=False):
+        self.fp = fp
+        self.exclusive = exclusive
+
+    def __enter__(self):
+        if fcntl is None:
+            self._process_lock.acquire()
+        else:
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl is None:
+            self._process_lock.release()
+        else:
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+
+
+def remove_upload_session(upload_id):
+    """
+    Remove the upload session and its partial file.
+    :param upload_id: str
+    """
+    metadata.delete_upload(upload_id)
+    try:
+        os.remove(upload_session_filepath(upload_id))
+    except OSError:
+        pass
+
+
+class UploadSessions(Resource):
+    """
+    Upload of big files in chunks.
+
+    An upload session is opened with a POST giving the user file path, its total size and md5, and if it replaces
+    an existing file. The chunks are sent with PUT /uploads/<upload_id>/<index>, in any order and even in parallel,
+    GET /uploads/<upload_id> tells the received chunks, and POST /uploads/<upload_id> commits the upload.
+    """
+    def _clean_expired_sessions(self):
+        """
+        Remove the upload sessions not committed within UPLOAD_SESSION_TIMEOUT.
+        """
+        for upload_id in metadata.expired_uploads(now_timestamp() - UPLOAD_SESSION_TIMEOUT):
+            remove_upload_session(upload_id)
+
+    @auth.login_required
+    def post(self):
+        """
+        Open an upload session, and return its id and chunk size in a json.
+        json format: {'upload_id': str, 'chunk_size': int, 'chunks': int}
+        """
+        username = auth.username()
+        path = request.form['path']
+        md5 = request.form['md5']
+        try:
+            size = int(request.form['size'])
+        except ValueError:
+            abort(HTTP_BAD_REQUEST)
+        if size < 0:
+            abort(HTTP_BAD_REQUEST)
+        replace = request.form.get('replace', '').lower() in ('1', 'true')
+
+        if not check_path(path, username):
+            abort(HTTP_FORBIDDEN)
+        if os.path.isfile(userpath2serverpath(username, path)) != replace:
+            # Like Files.post and Files.put: a new file must not exist, a replaced file must exist.
+            abort((HTTP_FORBIDDEN, HTTP_NOT_FOUND)[replace])
+
+        self._clean_expired_sessions()
+        upload_id = os.urandom(16).encode('hex')
+        if not os.path.isdir(UPLOADS_ROOT):
+            os.makedirs(UPLOADS_ROOT)
+        with open(upload_session_filepath(upload_id), 'wb') as fp:
+            fp.truncate(size)
+        metadata.create_upload(upload_id, username, normpath(path), size, md5, UPLOAD_CHUNK_SIZE, replace,
+                               now_timestamp())
+        resp = jsonify({'upload_id': upload_id,
+                        'chunk_size': UPLOAD_CHUNK_SIZE,
+                        'chunks': -(-size // UPLOAD_CHUNK_SIZE)})
+        resp.status_code = HTTP_CREATED
+        return resp
+
+
+def get_user_upload(upload_id):
+    """
+    Return the Upload data of the upload session <upload_id> of the logged user,
+    aborting with HTTP_NOT_FOUND if it does not exist.
+    :param upload_id: str
+    :return: Upload
+    """
+    upload = metadata.get_upload(upload_id)
+    if upload is None or upload.username != auth.username():
+        abort(HTTP_NOT_FOUND)
+    return upload
+
+
+class UploadSession(Resource):
+    """
+    Status, commit and removal of an upload session (see UploadSessions).
+    """
+
+    @auth.login_required
+    def get(self, upload_id):
+        """
+        Return the upload session data and the indexes of the chunks already received in a json.
+        json format: {'path': str, 'size': int, 'md5': str, 'chunk_size': int, 'chunks': int, 'received': list}
+        """
+        upload = get_user_upload(upload_id)
+        return jsonify({'path': upload.path,
+                        'size': upload.size,
+                        'md5': upload.md5,
+                        'chunk_size': upload.chunk_size,
+                        'chunks': -(-upload.size // upload.chunk_size),
+                        'received': metadata.upload_chunks(upload_id)})
+
+    @auth.login_required
+    def post(self, upload_id):
+        """
+        Commit the upload session: the received file is verified and moved to its path, and the user snapshot
+        is updated. Return the last server timestamp in a json, like Files.post and Files.put.
+        json format: {LAST_SERVER_TIMESTAMP: int}
+        """
+        username = auth.username()
+        upload = get_user_upload(upload_id)
+        upload_filepath = upload_session_filepath(upload_id)
+        try:
+            fp = open(upload_filepath, 'rb')
+        except IOError:
+            # The session has just been removed
+            abort(HTTP_NOT_FOUND)
+        with fp, UploadSessionLock(fp, exclusive=True):
+            # The chunks being written are waited for, and the session is checked again, since a concurrent commit
+            # may have closed it in the meantime.
+            if metadata.get_upload(upload_id) is None:
+                abort(HTTP_NOT_FOUND)
+            if len(metadata.upload_chunks(upload_id)) != -(-upload.size // upload.chunk_size):
+                # Some chunks are missing
+                abort(HTTP_PRECONDITION_FAILED)
+            md5 = calculate_file_md5(fp)
+            if md5 != upload.md5:
+                remove_upload_session(upload_id)
+                abort(HTTP_CONFLICT)
+            # The session is closed: no chunk is written anymore in the file to move.
+            metadata.delete_upload(upload_id)
+
+        filepath = userpath2serverpath(username, upload.path)
+        with user_lock(username):
+            if os.path.isfile(filepath) != upload.replace:
+                # The file has been created or removed since the opening of the session.
+                remove_upload_session(upload_id)
+                abort((HTTP_FORBIDDEN, HTTP_NOT_FOUND)[upload.replace])
+            if not os.path.isdir(os.path.dirname(filepath)):
+                os.makedirs(os.path.dirname(filepath))
+            shutil.move(upload_filepath, filepath)
+
+            last_server_timestamp = update_user_path(username, upload.path, md5)
+        resp = jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
+        resp.status_code = HTTP_CREATED
+        return resp
+
+    @auth.login_required
+    def delete(self, upload_id):
+        """
+        Abort the upload session.
+        """
+        get_user_upload(upload_id)
+        remove_upload_session(upload_id)
+        return 'Upload session removed.\n', HTTP_OK
+
+
+class UploadSessionChunks(Resource):
+    """
+    Chunks of an upload session (see UploadSessions).
+    """
+    @auth.login_required
+    def put(self, upload_id, index):
+        """
+        Receive the chunk <index> of the upload session as the raw request body.
+        A chunk is <chunk_size> bytes long, except the last one.
+        """
+        upload = get_user_upload(upload_id)
+        offset = index * upload.chunk_size
+        length = min(upload.chunk_size, upload.size - offset)
+        if length <= 0:
+            abort(HTTP_NOT_FOUND)
+        if request.content_length != length:
+            abort(HTTP_BAD_REQUEST)
+
+        # Every chunk is written in place with its own file object, so chunks can be received in parallel.
+        try:
+            fp = open(upload_session_filepath(upload_id), 'r+b')
+        except IOError:
+            # The session has just been removed
+            abort(HTTP_NOT_FOUND)
+        with fp, UploadSessionLock(fp):
+            # The file may have been opened just before the session was committed and moved to the user path.
+            if metadata.get_upload(upload_id) is None:
+                abort(HTTP_NOT_FOUND)
+            fp.seek(offset)
+            while length > 0:
+                data = request.stream.read(min(DOWNLOAD_CHUNK_SIZE, length))
+                if not data:
+                    abort(HTTP_BAD_REQUEST)
+                fp.write(data)
+                length -= len(data)
+            metadata.add_upload_chunk(upload_id, index)
+        return jsonify({'received': index})
+
+
 api.add_resource(Files, '{}/files/<path:path>'.format(URL_PREFIX), '{}/files/'.format(URL_PREFIX))
 api.add_resource(Actions, '{}/actions/<string:cmd>'.format(URL_PREFIX))
 api.add_resource(Users, '{}/users/<string:username>'.format(URL_PREFIX))
 api.add_resource(UsersRecoverPassword, '{}/users/<string:username>/reset'.format(URL_PREFIX))
+api.add_resource(Sessions, '{}/sessions'.format(URL_PREFIX))
+api.add_resource(Blobs, '{}/blobs/<string:cmd>'.format(URL_PREFIX))
+api.add_resource(Bundles, '{}/bundles/'.format(URL_PREFIX), '{}/bundles/<string:cmd>'.format(URL_PREFIX))
+api.add_resource(Events, '{}/events'.format(URL_PREFIX))
+api.add_resource(Signatures, '{}/signatures/<path:path>'.format(URL_PREFIX))
+api.add_resource(Deltas, '{}/deltas/<path:path>'.format(URL_PREFIX))
+api.add_resource(UploadSessions, '{}/uploads/'.format(URL_PREFIX))
+api.add_resource(UploadSession, '{}/uploads/<string:upload_id>'.format(URL_PREFIX))
+api.add_resource(UploadSessionChunks, '{}/uploads/<string:upload_id>/<int:index>'.format(URL_PREFIX))
 
 # Set the flask.ext.mail.Mail instance
 mail = configure_email()
 
 
+def load_secret_key(filename=SECRET_KEY_FILENAME):
+    """
+    Return the secret key stored in <filename>, generating it if the file does not exist yet.
+    The file is created atomically, so all the server processes started at the same time get the same key.
+    :return: str
+    """
+    if not os.path.isfile(filename):
+        key_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(abspath(filename)), prefix='.secret_key-',
+                                               delete=False)
+        with key_file:
+            key_file.write(os.urandom(32).encode('hex'))
+        try:
+            # Unlike a rename, a link never replaces the key written by another process.
+            os.link(key_file.name, filename)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        finally:
+            os.remove(key_file.name)
+    with open(filename, 'rb') as fp:
+        return fp.read().strip()
+
+
+def create_app(metadata_filename=METADATA_FILENAME, secret_key=None, email_settings=None,
+               x_sendfile=False, x_accel_redirect=None, send_emails=True):
+    """
+    Configure the server application for production, and return it (the WSGI application, see the wsgi module).
+    Any number of server processes, each with any number of threads, can serve the same users: they share
+    the metadata database, the user locks (in LOCKS_ROOT) and the key signing the session tokens (<secret_key>,
+    or the one in SECRET_KEY_FILENAME by default). So every server process must call create_app after its start,
+    and not before forking.
+    :param metadata_filename: str
+    :param secret_key: str
+    :param email_settings: str (the email settings file, email_settings.ini in the server directory by default)
+    :param x_sendfile: bool (see main)
+    :param x_accel_redirect: str (see main)
+    :param send_emails: bool (False for the administration commands, which don't need the email settings)
+    :return: Flask
+    """
+    global EMAIL_SETTINGS_FILEPATH, mail
+    if send_emails:
+        EMAIL_SETTINGS_FILEPATH = email_settings or join(SERVER_DIRECTORY, 'email_settings.ini')
+        if not os.path.exists(EMAIL_SETTINGS_FILEPATH):
+            # ConfigParser.ConfigParser.read doesn't tell anything if the email configuration file is not found.
+            raise ServerConfigurationError('Email configuration file "{}" not found!'.format(EMAIL_SETTINGS_FILEPATH))
+        mail = configure_email()
+    app.testing = False
+
+    app.use_x_sendfile = x_sendfile
+    app.config['X_ACCEL_REDIRECT_PREFIX'] = x_accel_redirect
+    app.config['SECRET_KEY'] = secret_key or load_secret_key()
+
+    metadata.connect(metadata_filename)
+    init_root_structure()
+    if not os.path.isdir(LOCKS_ROOT):
+        try:
+            os.mkdir(LOCKS_ROOT)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    user_locks.directory = LOCKS_ROOT
+    update_passwordmeter_terms(UNWANTED_PASS)
+    logger.info('{:,} registered user(s) found'.format(len(metadata)))
+    return app
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--debug', default=False, action='store_true',
@@ -898,6 +2291,25 @@ def main():
                         [default: %(default)s]. Ignored if --verbose or --debug option is set.')
     parser.add_argument('-H', '--host', default='0.0.0.0',
                         help='set host address to run the server. [default: %(default)s].')
+    parser.add_argument('--metadata', default=METADATA_FILENAME,
+                        help='set the metadata database file. [default: %(default)s].')
+    parser.add_argument('--import-userdata', nargs='?', const=USERDATA_FILENAME, metavar='USERDATA_FILE',
+                        help='import the users of an old-style json user data file in the metadata database, \
+                        and exit. [default file: %(const)s].')
+    parser.add_argument('--x-sendfile', default=False, action='store_true',
+                        help='let the front server send the downloaded files, using the X-Sendfile header \
+                        (e.g. Apache with mod_xsendfile, lighttpd). [default: %(default)s].')
+    parser.add_argument('--x-accel-redirect', metavar='PREFIX',
+                        help='let nginx send the downloaded files, using the X-Accel-Redirect header. \
+                        PREFIX is the nginx internal location that serves the server file root directory.')
+    parser.add_argument('--migrate-storage', default=False, action='store_true',
+                        help='convert the files of the file storage root directory to links to the content blobs, \
+                        and exit.')
+    parser.add_argument('--collect-garbage', default=False, action='store_true',
+                        help='remove the content blobs not referenced by any user file, and exit.')
+    parser.add_argument('--reindex', nargs='?', const='', metavar='USERNAME',
+                        help='rebuild the metadata of the files of USERNAME (of all the users, if not given) from \
+                        the file storage, hashing the changed files with a process per core, and exit.')
     args = parser.parse_args()
 
     if args.debug:
@@ -912,15 +2324,34 @@ def main():
 
     logger.debug('File logging level: {}'.format(file_handler.level))
 
-    if not os.path.exists(EMAIL_SETTINGS_FILEPATH):
-        # ConfigParser.ConfigParser.read doesn't tell anything if the email configuration file is not found.
-        raise ServerConfigurationError('Email configuration file "{}" not found!'.format(EMAIL_SETTINGS_FILEPATH))
-
-    update_passwordmeter_terms(UNWANTED_PASS)
-
-    userdata.update(load_userdata())
-    init_root_structure()
-    app.run(host=args.host, debug=args.debug)
+    # The administration commands exit without running the server.
+    run_server = not (args.import_userdata or args.migrate_storage or args.collect_garbage or args.reindex is not None)
+    create_app(args.metadata, x_sendfile=args.x_sendfile, x_accel_redirect=args.x_accel_redirect,
+               send_emails=run_server)
+    if args.import_userdata:
+        print '{:,} user(s) imported in "{}"'.format(import_userdata(args.import_userdata), args.metadata)
+        return
+
+    if args.migrate_storage:
+        print '{:,} file(s) migrated to "{}"'.format(blobs.migrate(FILE_ROOT), BLOB_ROOT)
+        return
+    if args.collect_garbage:
+        print '{:,} unreferenced blob(s) removed'.format(blobs.collect_garbage())
+        return
+    if args.reindex is not None:
+        usernames = [args.reindex.decode('utf-8')] if args.reindex else metadata.usernames()
+        for username in usernames:
+            if username not in metadata:
+                print 'User "{}" not found'.format(username)
+                continue
+            print 'Reindexing "{}"...'.format(username)
+            print '{:,} file(s) added, {:,} modified, {:,} removed'.format(*reindex_user(username,
+                                                                                          progress=print_progress))
+        return
+
+    # Development server, in a single process: threaded, so the long-polls of the events don't block the other
+    # requests. In production, use a WSGI server with many processes (see the wsgi module).
+    app.run(host=args.host, debug=args.debug, threaded=True)
 
 if __name__ == '__main__':
     main()
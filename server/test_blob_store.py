@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+blob_store test module
+"""
+import unittest
+import os
+import shutil
+import hashlib
+import tempfile
+
+import blob_store
+from blob_store import BlobStore
+
+CONTENT = 'some content'
+MD5 = hashlib.md5(CONTENT).hexdigest()
+
+
+class TestBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.store = BlobStore(os.path.join(self.test_dir, 'blobs'))
+        self.file_root = os.path.join(self.test_dir, 'files')
+        os.mkdir(self.file_root)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _create_file(self, filename, content=CONTENT):
+        filepath = os.path.join(self.file_root, filename)
+        with open(filepath, 'wb') as fp:
+            fp.write(content)
+        return filepath
+
+    def test_store(self):
+        first = self._create_file('first')
+        second = self._create_file('second')
+        self.assertFalse(self.store.exists(MD5))
+        self.assertTrue(self.store.store(first, MD5))
+        self.assertTrue(self.store.exists(MD5))
+        self.assertEqual(self.store.refcount(MD5), 1)
+
+        # The same content is stored once
+        self.assertTrue(self.store.store(second, MD5))
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertTrue(os.path.samefile(first, self.store.blob_path(MD5)))
+        self.assertEqual(self.store.refcount(MD5), 2)
+        # Storing again an already stored file changes nothing
+        self.assertTrue(self.store.store(second, MD5))
+        self.assertEqual(self.store.refcount(MD5), 2)
+
+    def test_invalid_md5(self):
+        self.assertRaises(ValueError, self.store.blob_path, '../../etc/passwd')
+        self.assertFalse(self.store.exists('../../etc/passwd'))
+        self.assertFalse(self.store.link('../' + MD5[3:], os.path.join(self.file_root, 'copy')))
+
+    def test_link(self):
+        self.assertFalse(self.store.link(MD5, os.path.join(self.file_root, 'copy')))
+        self.store.store(self._create_file('first'), MD5)
+        # The destination is replaced, if it exists
+        copy = self._create_file('copy', 'other content')
+        self.assertTrue(self.store.link(MD5, copy))
+        with open(copy, 'rb') as fp:
+            self.assertEqual(fp.read(), CONTENT)
+        self.assertEqual(self.store.refcount(MD5), 2)
+        # No temporary link is left
+        self.assertEqual(sorted(os.listdir(self.file_root)), ['copy', 'first'])
+
+    def test_release_and_garbage_collection(self):
+        first = self._create_file('first')
+        self.store.store(first, MD5)
+        self.assertFalse(self.store.release(MD5))
+        os.remove(first)
+        self.assertTrue(self.store.release(MD5))
+        self.assertFalse(self.store.exists(MD5))
+
+        other_md5 = hashlib.md5('other').hexdigest()
+        self.store.store(self._create_file('first'), MD5)
+        self.store.store(self._create_file('other', 'other'), other_md5)
+        os.remove(os.path.join(self.file_root, 'other'))
+        self.assertEqual(self.store.collect_garbage(), 1)
+        self.assertTrue(self.store.exists(MD5))
+        self.assertFalse(self.store.exists(other_md5))
+
+    def test_release_of_a_blob_linked_meanwhile(self):
+        first = self._create_file('first')
+        self.store.store(first, MD5)
+        os.remove(first)
+        copy = os.path.join(self.file_root, 'copy')
+        mktemp = tempfile.mktemp
+
+        def link_and_mktemp(*args, **kwargs):
+            # Another process links the blob right after its links have been counted
+            blob_store.tempfile.mktemp = mktemp
+            self.store.link(MD5, copy)
+            return mktemp(*args, **kwargs)
+        blob_store.tempfile.mktemp = link_and_mktemp
+        try:
+            self.assertFalse(self.store.release(MD5))
+        finally:
+            blob_store.tempfile.mktemp = mktemp
+        self.assertTrue(os.path.samefile(copy, self.store.blob_path(MD5)))
+        self.assertEqual(os.listdir(os.path.dirname(self.store.blob_path(MD5))), [MD5])
+
+    def test_migrate(self):
+        self._create_file('first')
+        self._create_file('second')
+        self._create_file('other', 'other')
+        self.assertEqual(self.store.migrate(self.file_root), 3)
+        self.assertEqual(self.store.refcount(MD5), 2)
+        self.assertEqual(self.store.refcount(hashlib.md5('other').hexdigest()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
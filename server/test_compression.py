@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+compression test module
+"""
+import unittest
+import os
+import io
+import gzip
+import zlib
+
+import compression
+
+TEXT = ''.join('{},"some text",{}\n'.format(i, i * 2) for i in range(5000))
+
+
+class TestCompression(unittest.TestCase):
+    def test_codecs(self):
+        self.assertEqual(compression.codec_names()[:2], ['gzip', 'deflate'])
+        self.assertEqual(compression.get_codec(' GZIP').name, 'gzip')
+        self.assertIsNone(compression.get_codec('br'))
+
+    def test_register_codec(self):
+        class IdentityCodec(compression.Codec):
+            name = 'x-identity'
+
+        codec = IdentityCodec()
+        compression.register_codec(codec)
+        try:
+            self.assertIs(compression.get_codec('x-identity'), codec)
+            self.assertEqual(compression.codec_names()[-1], 'x-identity')
+        finally:
+            del compression._codecs['x-identity']
+
+    def test_compress_and_decompress(self):
+        for name in compression.codec_names():
+            codec = compression.get_codec(name)
+            compressed = ''.join(compression.iter_compressed(io.BytesIO(TEXT), codec, chunk_size=1000))
+            self.assertLess(len(compressed), len(TEXT) / 2)
+            out = io.BytesIO()
+            compression.compress_file(io.BytesIO(TEXT), out, codec)
+            self.assertEqual(out.getvalue(), compressed)
+            out = io.BytesIO()
+            compression.decompress_file(io.BytesIO(compressed), out, codec)
+            self.assertEqual(out.getvalue(), TEXT)
+
+    def test_standard_formats(self):
+        compressed = ''.join(compression.iter_compressed(io.BytesIO(TEXT), compression.get_codec('gzip')))
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(compressed)).read(), TEXT)
+        compressed = ''.join(compression.iter_compressed(io.BytesIO(TEXT), compression.get_codec('deflate')))
+        self.assertEqual(zlib.decompress(compressed), TEXT)
+
+    def test_corrupted_data(self):
+        self.assertRaises(ValueError, compression.decompress_file, io.BytesIO('not gzip data'), io.BytesIO(),
+                          compression.get_codec('gzip'))
+
+    def test_should_compress(self):
+        fp = io.BytesIO(TEXT)
+        fp.seek(10)
+        self.assertTrue(compression.should_compress(fp, len(TEXT), 'data.csv'))
+        # The file position is kept
+        self.assertEqual(fp.tell(), 10)
+        # Already compressed files
+        self.assertFalse(compression.should_compress(io.BytesIO(TEXT), len(TEXT), 'data.ZIP'))
+        random_data = os.urandom(compression.PROBE_SIZE)
+        self.assertFalse(compression.should_compress(io.BytesIO(random_data), len(random_data), 'data.bin'))
+        # Small files
+        self.assertFalse(compression.should_compress(io.BytesIO('small'), 5, 'data.txt'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+delta test module
+"""
+import unittest
+import os
+import io
+import random
+import time
+
+import delta
+
+BLOCK_SIZE = delta.MIN_BLOCK_SIZE
+
+
+def _delta(old, new, max_literal_length=None):
+    sig = delta.signature(io.BytesIO(old), BLOCK_SIZE)
+    out = io.BytesIO()
+    complete = delta.write_delta(sig, io.BytesIO(new), out, max_literal_length)
+    return complete, out.getvalue()
+
+
+def _patch(old, delta_data):
+    out = io.BytesIO()
+    delta.apply_delta(io.BytesIO(old), io.BytesIO(delta_data), out)
+    return out.getvalue()
+
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        random.seed(0)
+        self.old = os.urandom(BLOCK_SIZE * 20 + 100)
+
+    def test_roll(self):
+        data = os.urandom(BLOCK_SIZE + 1)
+        checksum = delta.weak_checksum(data[:BLOCK_SIZE])
+        self.assertEqual(delta.roll(checksum, ord(data[0]), ord(data[BLOCK_SIZE]), BLOCK_SIZE),
+                         delta.weak_checksum(data[1:]))
+
+    def test_block_size_for(self):
+        self.assertEqual(delta.block_size_for(0), delta.MIN_BLOCK_SIZE)
+        self.assertEqual(delta.block_size_for(2 ** 30), 2 ** 15)
+        self.assertEqual(delta.block_size_for(2 ** 40), delta.MAX_BLOCK_SIZE)
+
+    def test_modifications(self):
+        old = self.old
+        for new in (old,
+                    old + 'appended',
+                    'prepended' + old,
+                    old[:5000] + 'inserted' + old[5000:],
+                    old[:5000] + old[9000:],
+                    old[BLOCK_SIZE * 10:] + old[:BLOCK_SIZE * 10],
+                    old[:-50],
+                    '',
+                    os.urandom(1000)):
+            complete, delta_data = _delta(old, new)
+            self.assertTrue(complete)
+            self.assertEqual(_patch(old, delta_data), new)
+
+    def test_only_changes_are_sent(self):
+        new = self.old[:5000] + 'inserted' + self.old[5000:] + 'appended'
+        delta_data = _delta(self.old, new)[1]
+        # The block with the insertion, and the data appended after the short last block
+        self.assertLess(len(delta_data), BLOCK_SIZE + 200 + 100)
+
+    def test_max_literal_length(self):
+        self.assertFalse(_delta(self.old, os.urandom(delta.MAX_LITERAL_LENGTH * 2), 1000)[0])
+        self.assertTrue(_delta(self.old, self.old + 'appended', 1000)[0])
+
+    def test_mostly_new_file_is_bounded(self):
+        # The literal data checked byte by byte is bounded whatever the file size, so is the time
+        new = os.urandom(delta.MAX_SCANNED_LITERAL_LENGTH * 4)
+        start = time.time()
+        self.assertFalse(_delta(self.old, new)[0])
+        self.assertLess(time.time() - start, 15)
+
+    def test_forged_signature_is_bounded(self):
+        # Every window has the weak checksum of a block of the signature, but not its strong hash
+        new = '\0' * (delta.MAX_MISSED_HASH_LENGTH // BLOCK_SIZE * 2)
+        sig = {'block_size': BLOCK_SIZE, 'blocks': [[delta.weak_checksum('\0' * BLOCK_SIZE), 'forged']]}
+        start = time.time()
+        self.assertFalse(delta.write_delta(sig, io.BytesIO(new), io.BytesIO()))
+        self.assertLess(time.time() - start, 15)
+
+    def test_invalid_delta(self):
+        delta_data = _delta(self.old, 'prepended' + self.old)[1]
+        self.assertRaises(ValueError, _patch, self.old, 'not a delta')
+        self.assertRaises(ValueError, _patch, self.old, delta_data[:-3])
+        # The basis is shorter than the one of the signature
+        self.assertRaises(ValueError, _patch, self.old[:BLOCK_SIZE * 5], delta_data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+indexer test module
+"""
+import unittest
+import os
+import shutil
+import hashlib
+import tempfile
+
+import indexer
+
+
+class TestIndexer(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.files = {'a.txt': 'a content', 'dir/b.txt': 'b content', 'dir/sub/c.txt': 'c content',
+                      'dir/sub/empty': ''}
+        for path, content in self.files.items():
+            self._create_file(path, content)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _create_file(self, path, content):
+        filepath = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, 'wb') as fp:
+            fp.write(content)
+
+    def _md5s(self, index):
+        return {path: md5 for path, (size, mtime, md5) in index.items()}
+
+    def test_scan_tree(self):
+        self._create_file('.tmp-upload', 'temporary')
+        os.symlink(os.path.join(self.root, 'a.txt'), os.path.join(self.root, 'link'))
+        scanned = {path: size for path, size, mtime in indexer.scan_tree(self.root, exclude_prefixes=('.tmp-',))}
+        self.assertEqual(scanned, {path: len(content) for path, content in self.files.items()})
+
+    def test_index_tree(self):
+        expected = {path: hashlib.md5(content).hexdigest() for path, content in self.files.items()}
+        progress = []
+        index = indexer.index_tree(self.root, progress=lambda *args: progress.append(args))
+        self.assertEqual(self._md5s(index), expected)
+        self.assertEqual(progress[-1], (4, 4, 27, 27))
+
+        # With the process pool
+        old_min_parallel_files, indexer.MIN_PARALLEL_FILES = indexer.MIN_PARALLEL_FILES, 0
+        try:
+            self.assertEqual(self._md5s(indexer.index_tree(self.root, processes=2)), expected)
+        finally:
+            indexer.MIN_PARALLEL_FILES = old_min_parallel_files
+
+    def test_known_files_are_not_hashed(self):
+        index = indexer.index_tree(self.root)
+        # A known md5 is reused if size and mtime are the same
+        size, mtime, md5 = index['a.txt']
+        index['a.txt'] = (size, mtime, 'known md5')
+        self._create_file('dir/b.txt', 'modified')
+        progress = []
+        new_index = indexer.index_tree(self.root, known=index, progress=lambda *args: progress.append(args))
+        self.assertEqual(new_index['a.txt'][2], 'known md5')
+        self.assertEqual(new_index['dir/b.txt'][2], hashlib.md5('modified').hexdigest())
+        self.assertEqual(len(progress), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
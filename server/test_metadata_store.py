@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+metadata_store test module
+"""
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+
+import metadata_store
+from metadata_store import MetadataStore, MetadataStoreError
+
+USR, PW = 'user@mail.com', 'encrypted_password'
+
+
+class TestMetadataStore(unittest.TestCase):
+    def setUp(self):
+        self.store = MetadataStore()
+        self.snapshot = {'spamfile': [10, 'e09f6a7593f8ae3994ea57e1117f67ec'],
+                         'subdir/foofile.txt': [20, 'acbd18db4cc2f85cedef654fccc4a4d8'],
+                         'subdir/foocopy.txt': [30, 'acbd18db4cc2f85cedef654fccc4a4d8'],
+                         }
+        self.store.create_user(USR, PW, 1, 30, self.snapshot)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_create_user(self):
+        self.assertIn(USR, self.store)
+        self.assertEqual(len(self.store), 1)
+        user = self.store.get_user(USR)
+        self.assertEqual((user.password, user.creation_timestamp, user.server_timestamp), (PW, 1, 30))
+        self.assertIsNone(user.recoverpass_code)
+        self.assertEqual(self.store.get_snapshot(USR), self.snapshot)
+
+    def test_create_existing_user(self):
+        self.assertRaises(MetadataStoreError, self.store.create_user, USR, 'other', 2, 2)
+        self.assertEqual(self.store.get_user(USR).password, PW)
+
+    def test_update_and_delete_user(self):
+        self.assertTrue(self.store.update_user(USR, password='new', recoverpass_code='code'))
+        user = self.store.get_user(USR)
+        self.assertEqual((user.password, user.recoverpass_code), ('new', 'code'))
+        self.assertFalse(self.store.update_user('unknown', password='new'))
+        self.assertRaises(MetadataStoreError, self.store.update_user, USR, files={})
+
+        self.assertTrue(self.store.delete_user(USR))
+        self.assertNotIn(USR, self.store)
+        self.assertIsNone(self.store.get_user(USR))
+        self.assertEqual(self.store.get_snapshot(USR), {})
+        self.assertFalse(self.store.delete_user(USR))
+
+    def test_file_operations(self):
+        self.store.set_file(USR, 'new.txt', 40, 'newmd5', server_timestamp=40)
+        self.assertEqual(self.store.get_file(USR, 'new.txt'), [40, 'newmd5'])
+        self.assertEqual(self.store.get_user(USR).server_timestamp, 40)
+
+        self.assertTrue(self.store.copy_file(USR, 'new.txt', 'copy.txt', 50, server_timestamp=50))
+        self.assertEqual(self.store.get_file(USR, 'copy.txt'), [50, 'newmd5'])
+
+        self.assertTrue(self.store.move_file(USR, 'copy.txt', 'moved.txt', 60, server_timestamp=60))
+        self.assertIsNone(self.store.get_file(USR, 'copy.txt'))
+        self.assertEqual(self.store.get_file(USR, 'moved.txt'), [60, 'newmd5'])
+        self.assertFalse(self.store.move_file(USR, 'copy.txt', 'other.txt', 70))
+
+        self.assertTrue(self.store.delete_file(USR, 'moved.txt', server_timestamp=80))
+        self.assertFalse(self.store.delete_file(USR, 'moved.txt'))
+        self.assertEqual(self.store.get_user(USR).server_timestamp, 80)
+
+    def test_paths_by_md5(self):
+        self.assertEqual(sorted(self.store.paths_by_md5(USR, 'acbd18db4cc2f85cedef654fccc4a4d8')),
+                         ['subdir/foocopy.txt', 'subdir/foofile.txt'])
+        self.assertEqual(self.store.paths_by_md5(USR, 'unknown'), [])
+
+    def test_transaction_rollback(self):
+        try:
+            with self.store.transaction():
+                self.store.delete_file(USR, 'spamfile')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertIsNotNone(self.store.get_file(USR, 'spamfile'))
+
+    def test_change_log(self):
+        self.assertEqual(self.store.last_change(USR), 0)
+        self.assertEqual(self.store.get_changes(USR, 0), [])
+        self.store.set_file(USR, 'a.txt', 10, 'md5a')
+        self.store.set_file(USR, 'a.txt', 11, 'md5b')
+        self.store.copy_file(USR, 'a.txt', 'b.txt', 12)
+        self.store.move_file(USR, 'b.txt', 'c.txt', 13)
+        self.store.delete_file(USR, 'a.txt', server_timestamp=14)
+        # Deleting a missing file changes nothing
+        self.store.delete_file(USR, 'a.txt', server_timestamp=15)
+        self.assertEqual(self.store.last_change(USR), 5)
+        self.assertEqual([(c['seq'], c['op'], c['path'], c['src'], c['timestamp'], c['md5'])
+                          for c in self.store.get_changes(USR, 0)],
+                         [(1, 'create', 'a.txt', None, 10, 'md5a'),
+                          (2, 'modify', 'a.txt', None, 11, 'md5b'),
+                          (3, 'copy', 'b.txt', 'a.txt', 12, 'md5b'),
+                          (4, 'move', 'c.txt', 'b.txt', 13, 'md5b'),
+                          (5, 'delete', 'a.txt', None, 14, None)])
+        self.assertEqual([c['seq'] for c in self.store.get_changes(USR, 2, limit=2)], [3, 4])
+        self.assertEqual(self.store.get_changes(USR, 5), [])
+        # Unknown cursor
+        self.assertIsNone(self.store.get_changes(USR, 6))
+
+    def test_change_log_compaction(self):
+        self.store.change_log_size = 10
+        for i in range(metadata_store.CHANGE_LOG_COMPACTION_INTERVAL):
+            self.store.set_file(USR, 'a.txt', i, 'md5')
+        last = metadata_store.CHANGE_LOG_COMPACTION_INTERVAL
+        self.assertEqual(len(self.store.get_changes(USR, last - 10)), 10)
+        # The changes before are not available anymore
+        self.assertIsNone(self.store.get_changes(USR, last - 11))
+        self.store.delete_user(USR)
+        self.assertEqual(self.store.last_change(USR), 0)
+
+    def test_file_stats(self):
+        self.assertEqual(self.store.get_file_stats(USR), {})
+        stats = {'spamfile': (4, 1.5, 'e09f6a7593f8ae3994ea57e1117f67ec'),
+                 'subdir/foofile.txt': (3, 2.0, 'acbd18db4cc2f85cedef654fccc4a4d8')}
+        self.store.set_file_stats(USR, stats)
+        self.assertEqual(self.store.get_file_stats(USR), stats)
+        del stats['spamfile']
+        self.store.set_file_stats(USR, stats)
+        self.assertEqual(self.store.get_file_stats(USR), stats)
+        self.store.delete_user(USR)
+        self.assertEqual(self.store.get_file_stats(USR), {})
+
+    def test_pending_users(self):
+        self.assertIsNone(self.store.get_pending_user('pending'))
+        self.store.set_pending_user('pending', 'code', 10, 'encrypted')
+        self.store.set_pending_user('other', 'other code', 20)
+        self.assertEqual(self.store.pending_usernames(), ['other', 'pending'])
+        self.assertEqual(self.store.get_pending_user('pending'),
+                         metadata_store.PendingUser('pending', 'code', 'encrypted', 10))
+        # Pending users are not registered users
+        self.assertNotIn('pending', self.store)
+
+        self.store.set_pending_user('pending', 'new code', 30)
+        self.assertEqual(self.store.get_pending_user('pending').activation_code, 'new code')
+        self.assertEqual(self.store.expire_pending_users(25), ['other'])
+        self.assertTrue(self.store.delete_pending_user('pending'))
+        self.assertFalse(self.store.delete_pending_user('pending'))
+        self.assertEqual(self.store.pending_usernames(), [])
+
+    def test_shared_database(self):
+        """
+        Stores opened on the same database (e.g. by several server processes) see each other changes.
+        """
+        test_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(test_dir, 'metadata.db')
+            first, second = MetadataStore(path), MetadataStore(path)
+            with first.transaction():
+                first.create_user(USR, PW, 1, 30, self.snapshot)
+                first.set_pending_user('pending', 'code', 10)
+            self.assertEqual(second.get_snapshot(USR), self.snapshot)
+            self.assertEqual(second.pending_usernames(), ['pending'])
+            second.delete_file(USR, 'spamfile', server_timestamp=40)
+            self.assertEqual(first.get_user(USR).server_timestamp, 40)
+            self.assertEqual(first.last_change(USR), 1)
+            first.close()
+            second.close()
+        finally:
+            shutil.rmtree(test_dir)
+
+    def test_threads_connections(self):
+        """
+        Every thread has its own connection to the database file: a write transaction does not block the readers.
+        """
+        test_dir = tempfile.mkdtemp()
+        try:
+            store = MetadataStore(os.path.join(test_dir, 'metadata.db'))
+            store.create_user(USR, PW, 1, 30, self.snapshot)
+            cursor = store.last_change(USR)
+            read = []
+            reader = threading.Thread(target=lambda: read.extend((store.get_snapshot(USR),
+                                                                  store.get_changes(USR, cursor))))
+            with store.transaction():
+                store.delete_file(USR, 'spamfile', server_timestamp=40)
+                reader.start()
+                reader.join(5)
+                # The reader sees the last committed snapshot and changes
+                self.assertFalse(reader.is_alive())
+                self.assertEqual(read, [self.snapshot, []])
+            self.assertNotIn('spamfile', store.get_snapshot(USR))
+            store.close()
+        finally:
+            shutil.rmtree(test_dir)
+
+    def test_read_transaction(self):
+        """
+        A read transaction sees the same state until its end, even if another thread commits meanwhile.
+        """
+        test_dir = tempfile.mkdtemp()
+        try:
+            store = MetadataStore(os.path.join(test_dir, 'metadata.db'))
+            store.create_user(USR, PW, 1, 30, self.snapshot)
+            writer = threading.Thread(target=store.delete_file, args=(USR, 'spamfile', 40))
+            with store.transaction(write=False):
+                self.assertEqual(store.get_user(USR).server_timestamp, 30)
+                writer.start()
+                writer.join(5)
+                self.assertFalse(writer.is_alive())
+                self.assertEqual(store.get_snapshot(USR), self.snapshot)
+                self.assertEqual(store.get_user(USR).server_timestamp, 30)
+            self.assertEqual(store.get_user(USR).server_timestamp, 40)
+            store.close()
+        finally:
+            shutil.rmtree(test_dir)
+
+    def test_upload_sessions(self):
+        self.store.create_upload('id1', USR, 'big.bin', 10, 'md5', 4, False, 100)
+        upload = self.store.get_upload('id1')
+        self.assertEqual((upload.path, upload.size, upload.chunk_size, upload.replace), ('big.bin', 10, 4, False))
+        self.assertIsNone(self.store.get_upload('id2'))
+
+        self.store.add_upload_chunk('id1', 2)
+        self.store.add_upload_chunk('id1', 0)
+        self.store.add_upload_chunk('id1', 2)
+        self.assertEqual(self.store.upload_chunks('id1'), [0, 2])
+
+        self.assertEqual(self.store.expired_uploads(100), [])
+        self.assertEqual(self.store.expired_uploads(101), ['id1'])
+        self.assertTrue(self.store.delete_upload('id1'))
+        self.assertIsNone(self.store.get_upload('id1'))
+        self.assertEqual(self.store.upload_chunks('id1'), [])
+
+        # The sessions of a removed user are removed too
+        self.store.create_upload('id3', USR, 'big.bin', 10, 'md5', 4, True, 100)
+        self.assertEqual(self.store.user_uploads(USR), ['id3'])
+        self.store.delete_user(USR)
+        self.assertIsNone(self.store.get_upload('id3'))
+
+    def test_import_userdata(self):
+        userdata = {'pippo': {'password': 'pw',
+                              'creation_timestamp': 5,
+                              'server_timestamp': 6,
+                              'recoverpass_data': ['code', 7],
+                              'files': {'a.txt': [6, 'md5']}},
+                    }
+        self.assertEqual(self.store.import_userdata(userdata), 1)
+        user = self.store.get_user('pippo')
+        self.assertEqual(user[1:], ('pw', 5, 6, 'code', 7))
+        self.assertEqual(self.store.get_snapshot('pippo'), {'a.txt': [6, 'md5']})
+        # Users not in the imported data are kept
+        self.assertEqual(self.store.usernames(), ['pippo', USR])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,8 +17,14 @@ import hashlib
 import tempfile
 import random
 import string
+import datetime
+import io
+import gzip
+import threading
+import tarfile
 
 import server
+import delta
 from server import userpath2serverpath
 
 HTTP_OK = 200
@@ -68,7 +74,7 @@ def make_basicauth_headers(user, pwd):
     return {'Authorization': 'Basic ' + base64.b64encode('{}:{}'.format(user, pwd))}
 
 
-def _create_file(username, user_relpath, content, update_userdata=True):
+def _create_file(username, user_relpath, content, update_metadata=True):
     """
     Create an user file with path <user_relpath> and content <content>
     and return it's last modification time (== creation time).
@@ -84,9 +90,8 @@ def _create_file(username, user_relpath, content, update_userdata=True):
     with open(filepath, 'wb') as fp:
         fp.write(content)
     mtime = server.now_timestamp()
-    if update_userdata:
-        server.userdata[username][server.SNAPSHOT][user_relpath] = [mtime,
-                                                                    server.calculate_file_md5(open(filepath, 'rb'))]
+    if update_metadata:
+        server.metadata.set_file(username, user_relpath, mtime, server.calculate_file_md5(open(filepath, 'rb')))
     return mtime
 
 
@@ -130,7 +135,7 @@ def build_tstuser_dir(username):
 
 def _manually_create_user(username, pw):
     """
-    Create an user, its server directory, and return its userdata dictionary.
+    Create an user, its server directory, and return its user data dictionary.
     :param username: str
     :param pw: str
     :return: dict
@@ -141,18 +146,18 @@ def _manually_create_user(username, pw):
     single_user_data = user_dir_state
     single_user_data[server.PWD] = enc_pass
     single_user_data[server.USER_CREATION_TIME] = server.now_timestamp()
-    server.userdata[username] = single_user_data
+    server.metadata.create_user(username, enc_pass, single_user_data[server.USER_CREATION_TIME],
+                                single_user_data[server.LAST_SERVER_TIMESTAMP], single_user_data[server.SNAPSHOT])
     return single_user_data
 
 
 def _manually_remove_user(username):  # TODO: make this from server module?
     """
-    Remove user dictionary from server <userdata>, if exist,
+    Remove user from server <metadata>, if exist,
     and remove its directory from disk, if exist.
     :param username: str
     """
-    if USR in server.userdata:
-        server.userdata.pop(username)
+    server.metadata.delete_user(username)
     # Remove user directory if exists!
     user_dirpath = userpath2serverpath(USR)
     if os.path.exists(user_dirpath):
@@ -193,6 +198,16 @@ def _make_temp_file():
     return temp_file, test_md5
 
 
+def _upload_tempfiles(username):
+    """
+    Return the list of the temporary upload files left in the user directory.
+    :param username: str
+    :return: list
+    """
+    return [filename for filename in os.listdir(userpath2serverpath(username))
+            if filename.startswith(server.UPLOAD_TEMPFILE_PREFIX)]
+
+
 class TestRequests(unittest.TestCase):
     def setUp(self):
         """
@@ -247,8 +262,13 @@ class TestRequests(unittest.TestCase):
             test_file.close()
         self.assertEqual(test.status_code, server.HTTP_CREATED)
         self.assertTrue(os.path.isfile(uploaded_filepath))
+        with open(uploaded_filepath, 'rb') as fp:
+            self.assertEqual(fp.read(), 'this is a test')
         # check that uploaded path exists in username files dict
-        self.assertIn(user_relative_upload_filepath, server.userdata[USR][server.SNAPSHOT])
+        self.assertIn(user_relative_upload_filepath, server.metadata.get_snapshot(USR))
+        self.assertEqual(server.metadata.get_snapshot(USR)[user_relative_upload_filepath][1], test_md5)
+        # The upload has been received in a temporary file and moved
+        self.assertEqual(_upload_tempfiles(USR), [])
         os.remove(uploaded_filepath)
         logging.info('"{}" removed'.format(uploaded_filepath))
 
@@ -270,7 +290,7 @@ class TestRequests(unittest.TestCase):
         self.assertEqual(test.status_code, server.HTTP_FORBIDDEN)
         self.assertFalse(os.path.isfile(userpath2serverpath(USR, user_filepath)))
         # check that uploaded path NOT exists in username files dict
-        self.assertNotIn(user_filepath, server.userdata[USR][server.SNAPSHOT])
+        self.assertNotIn(user_filepath, server.metadata.get_snapshot(USR))
 
     def test_files_post_with_existent_path(self):
         """
@@ -280,7 +300,7 @@ class TestRequests(unittest.TestCase):
         _create_file(USR, path, 'I already exist! Don\'t erase me!')
         to_created_filepath = userpath2serverpath(USR, path)
         old_content = open(to_created_filepath).read()
-        old_md5 = server.userdata[USR][server.SNAPSHOT][path][1]
+        old_md5 = server.metadata.get_snapshot(USR)[path][1]
 
         url = SERVER_FILES_API + path
 
@@ -296,7 +316,7 @@ class TestRequests(unittest.TestCase):
         self.assertEqual(test.status_code, server.HTTP_FORBIDDEN)
         new_content = open(to_created_filepath).read()
         self.assertEqual(old_content, new_content)
-        new_md5 = server.userdata[USR][server.SNAPSHOT][path][1]
+        new_md5 = server.metadata.get_snapshot(USR)[path][1]
         self.assertEqual(old_md5, new_md5)
 
     def test_files_post_with_bad_md5(self):
@@ -321,9 +341,30 @@ class TestRequests(unittest.TestCase):
             test_file.close()
         self.assertEqual(test.status_code, server.HTTP_CONFLICT)
         self.assertFalse(os.path.isfile(userpath2serverpath(USR, user_relative_upload_filepath)))
+        self.assertEqual(_upload_tempfiles(USR), [])
 
         # check that uploaded path NOT exists in username files dict
-        self.assertNotIn(user_relative_upload_filepath, server.userdata[USR][server.SNAPSHOT])
+        self.assertNotIn(user_relative_upload_filepath, server.metadata.get_snapshot(USR))
+
+    def test_upload_tempfile_directory(self):
+        """
+        The uploaded files are written in the user directory only once the user is authenticated.
+        """
+        user_dir = os.path.realpath(userpath2serverpath(USR))
+        with server.app.test_request_context(headers=make_basicauth_headers(USR, 'wrong password')):
+            fp = server.request._get_file_stream(10, 'text/plain')
+            fp.close()
+            self.assertNotEqual(os.path.dirname(os.path.realpath(fp.name)), user_dir)
+            self.assertFalse(server.verify_password(USR, 'wrong password'))
+            fp = server.request._get_file_stream(10, 'text/plain')
+            fp.close()
+            self.assertNotEqual(os.path.dirname(os.path.realpath(fp.name)), user_dir)
+            self.assertTrue(server.verify_password(USR, PW))
+            fp = server.request._get_file_stream(10, 'text/plain')
+            fp.close()
+            self.assertEqual(os.path.dirname(os.path.realpath(fp.name)), user_dir)
+            server.request.close()
+        self.assertEqual(_upload_tempfiles(USR), [])
 
     def test_files_put_with_auth(self):
         """
@@ -333,7 +374,7 @@ class TestRequests(unittest.TestCase):
         _create_file(USR, path, 'I will change')
         to_modify_filepath = userpath2serverpath(USR, path)
         old_content = open(to_modify_filepath).read()
-        old_md5 = server.userdata[USR][server.SNAPSHOT][path][1]
+        old_md5 = server.metadata.get_snapshot(USR)[path][1]
 
         url = SERVER_FILES_API + path
         # Create temporary file for test
@@ -350,7 +391,7 @@ class TestRequests(unittest.TestCase):
             test_file.close()
         new_content = open(to_modify_filepath).read()
         self.assertEqual(old_content, new_content)
-        new_md5 = server.userdata[USR][server.SNAPSHOT][path][1]
+        new_md5 = server.metadata.get_snapshot(USR)[path][1]
         self.assertEqual(old_md5, new_md5)
         self.assertEqual(test.status_code, server.HTTP_CONFLICT)
 
@@ -373,7 +414,7 @@ class TestRequests(unittest.TestCase):
             test_file.close()
 
         self.assertEqual(test.status_code, server.HTTP_NOT_FOUND)
-        self.assertNotIn(to_modify_filepath, server.userdata[USR][server.SNAPSHOT])
+        self.assertNotIn(to_modify_filepath, server.metadata.get_snapshot(USR))
 
     def test_files_put_with_bad_md5(self):
         """
@@ -383,7 +424,7 @@ class TestRequests(unittest.TestCase):
         _create_file(USR, path, 'I will NOT change')
         to_modify_filepath = userpath2serverpath(USR, path)
         old_content = open(to_modify_filepath).read()
-        old_md5 = server.userdata[USR][server.SNAPSHOT][path][1]
+        old_md5 = server.metadata.get_snapshot(USR)[path][1]
 
         url = SERVER_FILES_API + path
         # Create temporary file for test
@@ -397,7 +438,7 @@ class TestRequests(unittest.TestCase):
             test_file.close()
         new_content = open(to_modify_filepath).read()
         self.assertNotEqual(old_content, new_content)
-        new_md5 = server.userdata[USR][server.SNAPSHOT][path][1]
+        new_md5 = server.metadata.get_snapshot(USR)[path][1]
         self.assertNotEqual(old_md5, new_md5)
         self.assertEqual(test.status_code, server.HTTP_CREATED)  # 200 or 201 (OK or created)?
 
@@ -418,7 +459,7 @@ class TestRequests(unittest.TestCase):
 
         self.assertEqual(test.status_code, server.HTTP_OK)
         self.assertFalse(os.path.isfile(to_delete_filepath))
-        self.assertNotIn(delete_test_file_path, server.userdata[USR][server.SNAPSHOT])
+        self.assertNotIn(delete_test_file_path, server.metadata.get_snapshot(USR))
 
     def test_delete_file_path_with_tricky_filepath(self):
         """
@@ -584,6 +625,52 @@ class TestRequests(unittest.TestCase):
 
         self.assertEqual(test.status_code, HTTP_NOT_FOUND)
 
+    def test_batch_actions(self):
+        """
+        Test that the actions of a batch are made in order, with a result for every action.
+        """
+        batch_test_url = SERVER_ACTIONS_API + 'batch'
+        for path in ('batch/a.txt', 'batch/b.txt'):
+            _create_file(USR, path, 'batch file')
+        cursor = server.metadata.last_change(USR)
+        actions = [{'cmd': 'copy', 'src': 'batch/a.txt', 'dst': 'batch/c.txt'},
+                   {'cmd': 'move', 'src': 'batch/c.txt', 'dst': 'batch/d.txt'},
+                   {'cmd': 'delete', 'filepath': 'batch/a.txt'},
+                   {'cmd': 'delete', 'filepath': 'batch/a.txt'},
+                   {'cmd': 'delete', 'filepath': '../../a.txt'},
+                   {'cmd': 'delete'},
+                   {'cmd': 'unknown'},
+                   'delete']
+
+        test = self.app.post(batch_test_url,
+                             headers=make_basicauth_headers(USR, PW),
+                             data={'actions': json.dumps(actions)})
+
+        self.assertEqual(test.status_code, server.HTTP_OK)
+        obj = json.loads(test.data)
+        self.assertEqual(obj['results'], [server.HTTP_OK, server.HTTP_OK, server.HTTP_OK, HTTP_NOT_FOUND,
+                                          server.HTTP_FORBIDDEN, server.HTTP_BAD_REQUEST, server.HTTP_BAD_REQUEST,
+                                          server.HTTP_BAD_REQUEST])
+        self.assertEqual(obj[server.LAST_SERVER_TIMESTAMP], server.metadata.get_user(USR).server_timestamp)
+        snapshot = server.metadata.get_snapshot(USR)
+        self.assertNotIn('batch/a.txt', snapshot)
+        self.assertNotIn('batch/c.txt', snapshot)
+        self.assertIn('batch/b.txt', snapshot)
+        self.assertIn('batch/d.txt', snapshot)
+        self.assertTrue(os.path.isfile(userpath2serverpath(USR, 'batch/d.txt')))
+        self.assertEqual([change['op'] for change in server.metadata.get_changes(USR, cursor)],
+                         ['copy', 'move', 'delete'])
+
+    def test_batch_actions_invalid(self):
+        batch_test_url = SERVER_ACTIONS_API + 'batch'
+        for data in ({}, {'actions': 'not json'}, {'actions': json.dumps({'cmd': 'delete'})}):
+            test = self.app.post(batch_test_url, headers=make_basicauth_headers(USR, PW), data=data)
+            self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+        actions = [{'cmd': 'delete', 'filepath': 'missing.txt'}] * (server.BATCH_MAX_ACTIONS + 1)
+        test = self.app.post(batch_test_url, headers=make_basicauth_headers(USR, PW),
+                             data={'actions': json.dumps(actions)})
+        self.assertEqual(test.status_code, server.HTTP_REQUEST_ENTITY_TOO_LARGE)
+
 
 class TestGetRequests(unittest.TestCase):
     """
@@ -621,6 +708,108 @@ class TestGetRequests(unittest.TestCase):
                             headers=make_basicauth_headers(USR, PW))
         self.assertEqual(test.status_code, server.HTTP_OK)
 
+    def test_files_get_streamed_file(self):
+        """
+        Test that the downloaded file is streamed, with headers taken from the user snapshot.
+        """
+        timestamp, md5 = server.metadata.get_file(USR, self.USER_RELATIVE_DOWNLOAD_FILEPATH)
+        test = self.app.get(self.DOWNLOAD_TEST_URL,
+                            headers=make_basicauth_headers(USR, PW))
+        self.assertTrue(test.is_streamed)
+        self.assertEqual(test.data, 'some text')
+        self.assertEqual(test.content_length, len('some text'))
+        self.assertEqual(test.headers['ETag'], '"{}"'.format(md5))
+        self.assertEqual(test.last_modified, datetime.datetime.utcfromtimestamp(timestamp // 10000))
+
+        # Conditional download of an unchanged file
+        test = self.app.get(self.DOWNLOAD_TEST_URL,
+                            headers=dict(make_basicauth_headers(USR, PW), **{'If-None-Match': '"{}"'.format(md5)}))
+        self.assertEqual(test.status_code, 304)
+        self.assertEqual(test.data, '')
+
+    def test_files_get_range(self):
+        """
+        Test the download of a part of the file (HTTP Range requests).
+        """
+        md5 = server.metadata.get_file(USR, self.USER_RELATIVE_DOWNLOAD_FILEPATH)[1]
+        headers = make_basicauth_headers(USR, PW)
+        test = self.app.get(self.DOWNLOAD_TEST_URL, headers=dict(headers, Range='bytes=5-'))
+        self.assertEqual(test.status_code, 206)
+        self.assertEqual(test.data, 'text')
+        self.assertEqual(test.headers['Content-Range'], 'bytes 5-8/9')
+        self.assertEqual(test.content_length, 4)
+
+        test = self.app.get(self.DOWNLOAD_TEST_URL, headers=dict(headers, Range='bytes=0-3'))
+        self.assertEqual(test.status_code, 206)
+        self.assertEqual(test.data, 'some')
+
+        # The range is sent only if the file is not changed
+        test = self.app.get(self.DOWNLOAD_TEST_URL,
+                            headers=dict(headers, Range='bytes=5-', **{'If-Range': '"{}"'.format(md5)}))
+        self.assertEqual(test.status_code, 206)
+        self.assertEqual(test.data, 'text')
+        test = self.app.get(self.DOWNLOAD_TEST_URL,
+                            headers=dict(headers, Range='bytes=5-', **{'If-Range': '"oldmd5"'}))
+        self.assertEqual(test.status_code, server.HTTP_OK)
+        self.assertEqual(test.data, 'some text')
+
+        # Unsatisfiable range
+        test = self.app.get(self.DOWNLOAD_TEST_URL, headers=dict(headers, Range='bytes=9-'))
+        self.assertEqual(test.status_code, 416)
+        self.assertEqual(test.headers['Content-Range'], 'bytes */9')
+
+    def test_files_get_with_front_server(self):
+        """
+        Test that the download is handed to the front server, if configured.
+        """
+        server.app.use_x_sendfile = True
+        try:
+            test = self.app.get(self.DOWNLOAD_TEST_URL,
+                                headers=make_basicauth_headers(USR, PW))
+        finally:
+            server.app.use_x_sendfile = False
+        self.assertEqual(test.status_code, server.HTTP_OK)
+        self.assertEqual(test.headers['X-Sendfile'], userpath2serverpath(USR, self.USER_RELATIVE_DOWNLOAD_FILEPATH))
+        self.assertEqual(test.content_length, len('some text'))
+
+        server.app.config['X_ACCEL_REDIRECT_PREFIX'] = '/protected/'
+        try:
+            test = self.app.get(self.DOWNLOAD_TEST_URL,
+                                headers=make_basicauth_headers(USR, PW))
+        finally:
+            server.app.config['X_ACCEL_REDIRECT_PREFIX'] = None
+        self.assertEqual(test.headers['X-Accel-Redirect'],
+                         '/protected/{}/{}'.format(USR, self.USER_RELATIVE_DOWNLOAD_FILEPATH).replace('@', '%40'))
+
+    def test_files_get_compressed(self):
+        """
+        Test that compressible files are sent compressed to the clients accepting it.
+        """
+        content = ''.join('{},"some text"\n'.format(i) for i in range(1000))
+        _create_file(USR, 'testdownload/data.csv', content)
+        url = SERVER_FILES_API + 'testdownload/data.csv'
+        md5 = hashlib.md5(content).hexdigest()
+        headers = make_basicauth_headers(USR, PW)
+        headers['Accept-Encoding'] = 'gzip, deflate'
+        test = self.app.get(url, headers=headers)
+        self.assertEqual(test.status_code, server.HTTP_OK)
+        self.assertEqual(test.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(test.headers['ETag'], 'W/"{}"'.format(md5))
+        self.assertIn('Accept-Encoding', test.headers['Vary'])
+        self.assertLess(len(test.data), len(content))
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(test.data)).read(), content)
+
+        # Ranges and small files are sent uncompressed
+        headers['Range'] = 'bytes=10-'
+        test = self.app.get(url, headers=headers)
+        self.assertEqual(test.status_code, server.HTTP_PARTIAL_CONTENT)
+        self.assertNotIn('Content-Encoding', test.headers)
+        self.assertEqual(test.data, content[10:])
+        del headers['Range']
+        test = self.app.get(self.DOWNLOAD_TEST_URL, headers=headers)
+        self.assertNotIn('Content-Encoding', test.headers)
+        self.assertEqual(test.data, 'some text')
+
     def test_files_get_existing_file_with_wrong_password(self):
         """
         Test that server return a HTTP_UNAUTHORIZED error if
@@ -655,7 +844,7 @@ class TestGetRequests(unittest.TestCase):
         the given user does not exist.
         """
         user = 'UnExIsTiNgUsEr'
-        assert user not in server.userdata
+        assert user not in server.metadata
         test = self.app.get(self.DOWNLOAD_TEST_URL,
                             headers=make_basicauth_headers(user, PW))
         self.assertEqual(test.status_code, server.HTTP_UNAUTHORIZED)
@@ -701,16 +890,186 @@ class TestGetRequests(unittest.TestCase):
         """
         # The test user is created in setUp
 
-        expected_timestamp = server.userdata[USR]['server_timestamp']
-        expected_snapshot = server.userdata[USR]['files']
+        expected_timestamp = server.metadata.get_user(USR).server_timestamp
+        expected_snapshot = server.metadata.get_snapshot(USR)
         target = {server.LAST_SERVER_TIMESTAMP: expected_timestamp,
-                  server.SNAPSHOT: expected_snapshot}
+                  server.SNAPSHOT: expected_snapshot,
+                  server.CHANGES_CURSOR: server.metadata.last_change(USR)}
         test = self.app.get(SERVER_FILES_API,
                             headers=make_basicauth_headers(USR, PW))
         self.assertEqual(test.status_code, server.HTTP_OK)
         obj = json.loads(test.data)
         self.assertEqual(obj, target)
 
+    def test_files_get_snapshot_not_modified(self):
+        """
+        Test that the snapshot is not sent again if the client already has it (If-None-Match header).
+        """
+        headers = make_basicauth_headers(USR, PW)
+        test = self.app.get(SERVER_FILES_API, headers=headers)
+        etag = test.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+
+        headers['If-None-Match'] = etag
+        test = self.app.get(SERVER_FILES_API, headers=headers)
+        self.assertEqual(test.status_code, server.HTTP_NOT_MODIFIED)
+        self.assertEqual(test.data, '')
+        self.assertEqual(test.headers['ETag'], etag)
+
+        # Any change makes a new snapshot
+        self.app.post(SERVER_ACTIONS_API + 'delete', headers=make_basicauth_headers(USR, PW),
+                      data={'filepath': self.USER_RELATIVE_DOWNLOAD_FILEPATH})
+        test = self.app.get(SERVER_FILES_API, headers=headers)
+        self.assertEqual(test.status_code, server.HTTP_OK)
+        self.assertNotEqual(test.headers['ETag'], etag)
+        self.assertNotIn(self.USER_RELATIVE_DOWNLOAD_FILEPATH, json.loads(test.data)[server.SNAPSHOT])
+
+    def test_events(self):
+        """
+        Test the long-poll of the events: the request returns as soon as the user data changes after the given
+        cursor, or at the timeout.
+        """
+        headers = make_basicauth_headers(USR, PW)
+        cursor = server.metadata.last_change(USR)
+        events_url = urlparse.urljoin(SERVER_API, 'events')
+        test = self.app.get(events_url + '?since={}&timeout=0'.format(cursor), headers=headers)
+        self.assertEqual(test.status_code, server.HTTP_OK)
+        self.assertEqual(json.loads(test.data)[server.CHANGES_CURSOR], cursor)
+        # An old cursor
+        test = self.app.get(events_url + '?since={}'.format(cursor - 1), headers=headers)
+        self.assertEqual(json.loads(test.data)[server.CHANGES_CURSOR], cursor)
+        self.assertEqual(self.app.get(events_url, headers=headers).status_code, server.HTTP_BAD_REQUEST)
+
+        # A change made by another client wakes the waiting request
+        other_client = server.app.test_client()
+        timer = threading.Timer(0.2, other_client.post, [SERVER_ACTIONS_API + 'delete'],
+                                {'headers': headers, 'data': {'filepath': self.USER_RELATIVE_DOWNLOAD_FILEPATH}})
+        timer.start()
+        test = self.app.get(events_url + '?since={}'.format(cursor), headers=headers)
+        timer.join()
+        self.assertEqual(json.loads(test.data)[server.CHANGES_CURSOR], server.metadata.last_change(USR))
+        self.assertNotEqual(server.metadata.last_change(USR), cursor)
+
+        # A change made by another server process is not notified, but it's found at the next check.
+        cursor = server.metadata.last_change(USR)
+        timer = threading.Timer(0.2, server.metadata.set_file, [USR, 'other_process.txt', 1, 'md5'])
+        timer.start()
+        test = self.app.get(events_url + '?since={}&timeout=10'.format(cursor), headers=headers)
+        timer.join()
+        self.assertEqual(json.loads(test.data)[server.CHANGES_CURSOR], cursor + 1)
+
+    def test_files_get_changes(self):
+        """
+        Test the change feed: only the changes after the given cursor are returned.
+        """
+        headers = make_basicauth_headers(USR, PW)
+        cursor = json.loads(self.app.get(SERVER_FILES_API, headers=headers).data)[server.CHANGES_CURSOR]
+        test = self.app.get(SERVER_FILES_API + '?since={}'.format(cursor), headers=headers)
+        self.assertEqual(json.loads(test.data)[server.CHANGES], [])
+
+        self.app.post(SERVER_ACTIONS_API + 'move', headers=headers,
+                      data={'src': self.USER_RELATIVE_DOWNLOAD_FILEPATH, 'dst': 'moved.txt'})
+        self.app.post(SERVER_ACTIONS_API + 'delete', headers=headers, data={'filepath': 'moved.txt'})
+        test = self.app.get(SERVER_FILES_API + '?since={}'.format(cursor), headers=headers)
+        self.assertEqual(test.status_code, server.HTTP_OK)
+        obj = json.loads(test.data)
+        self.assertEqual([(c['op'], c['path'], c['src']) for c in obj[server.CHANGES]],
+                         [('move', 'moved.txt', self.USER_RELATIVE_DOWNLOAD_FILEPATH), ('delete', 'moved.txt', None)])
+        self.assertEqual(obj[server.CHANGES_CURSOR], cursor + 2)
+        self.assertFalse(obj[server.CHANGES_HAS_MORE])
+        self.assertEqual(obj[server.LAST_SERVER_TIMESTAMP], server.metadata.get_user(USR).server_timestamp)
+
+        # Paging
+        page_size = server.CHANGES_PAGE_SIZE
+        server.CHANGES_PAGE_SIZE = 1
+        try:
+            obj = json.loads(self.app.get(SERVER_FILES_API + '?since={}'.format(cursor), headers=headers).data)
+        finally:
+            server.CHANGES_PAGE_SIZE = page_size
+        self.assertEqual(len(obj[server.CHANGES]), 1)
+        self.assertEqual(obj[server.CHANGES_CURSOR], cursor + 1)
+        self.assertTrue(obj[server.CHANGES_HAS_MORE])
+
+        # Unknown cursor: the whole snapshot must be got again
+        test = self.app.get(SERVER_FILES_API + '?since={}'.format(cursor + 100), headers=headers)
+        self.assertTrue(json.loads(test.data)[server.CHANGES_RESYNC])
+        test = self.app.get(SERVER_FILES_API + '?since=invalid', headers=headers)
+        self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+
+
+class TestChangeNotifier(unittest.TestCase):
+    def setUp(self):
+        self.notifier = server.ChangeNotifier()
+
+    def test_wait_timeout(self):
+        version = self.notifier.version(USR)
+        self.assertFalse(self.notifier.wait(USR, version, 0.01))
+        # A notification for another user doesn't wake the waiter
+        threading.Timer(0.01, self.notifier.notify, ['other']).start()
+        self.assertFalse(self.notifier.wait(USR, version, 0.1))
+        self.assertEqual(self.notifier._conditions, {})
+
+    def test_notify(self):
+        version = self.notifier.version(USR)
+        threading.Timer(0.01, self.notifier.notify, [USR]).start()
+        self.assertTrue(self.notifier.wait(USR, version, 10))
+        # A notification before the wait is not lost
+        version = self.notifier.version(USR)
+        self.notifier.notify(USR)
+        self.assertTrue(self.notifier.wait(USR, version, 0))
+
+
+class TestUserLocks(unittest.TestCase):
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.user_locks = server.UserLocks(self.lock_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.lock_dir)
+
+    def _locked_by_another_process(self, lock):
+        """
+        Return True if the lock file is locked (a flock of a new open file conflicts like in another process).
+        """
+        fd = os.open(lock.filepath, os.O_RDWR)
+        try:
+            server.fcntl.flock(fd, server.fcntl.LOCK_EX | server.fcntl.LOCK_NB)
+        except IOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    @unittest.skipIf(server.fcntl is None, 'no fcntl')
+    def test_lock_file(self):
+        lock = self.user_locks.get(USR)
+        self.assertIs(self.user_locks.get(USR), lock)
+        self.assertNotEqual(self.user_locks.get('other').filepath, lock.filepath)
+        with lock:
+            # Reentrant
+            with lock:
+                self.assertTrue(self._locked_by_another_process(lock))
+            self.assertTrue(self._locked_by_another_process(lock))
+        self.assertFalse(self._locked_by_another_process(lock))
+
+    def test_threads(self):
+        lock = self.user_locks.get(USR)
+        acquired = []
+        with lock:
+            thread = threading.Thread(target=lambda: acquired.append(lock.acquire()))
+            thread.start()
+            thread.join(0.05)
+            self.assertEqual(acquired, [])
+        thread.join()
+        self.assertEqual(acquired, [None])
+
+    def test_load_secret_key(self):
+        filename = os.path.join(self.lock_dir, 'secret_key')
+        key = server.load_secret_key(filename)
+        self.assertGreaterEqual(len(key), 32)
+        self.assertEqual(server.load_secret_key(filename), key)
+        self.assertEqual(os.listdir(self.lock_dir), ['secret_key'])
+
 
 class TestUsersPost(unittest.TestCase):
     def setUp(self):
@@ -737,7 +1096,7 @@ class TestUsersPost(unittest.TestCase):
                                  data={'password': self.password})
 
             # Test that user is added to <pending_users>
-            self.assertIn(self.username, server.pending_users.keys())
+            self.assertIn(self.username, server.metadata.pending_usernames())
             self.assertEqual(test.status_code, HTTP_OK)
 
     def test_user_creation_with_weak_password(self):
@@ -746,7 +1105,7 @@ class TestUsersPost(unittest.TestCase):
         test = self.app.post(urlparse.urljoin(SERVER_API, 'users/' + self.username), data={'password': 'weak_password'})
 
         # Test that user is not added to <pendint_users>
-        self.assertNotIn(self.username, server.pending_users.keys())
+        self.assertNotIn(self.username, server.metadata.pending_usernames())
         self.assertEqual(test.status_code, HTTP_FORBIDDEN)
         self.assertIsInstance(json.loads(test.get_data()), dict)
 
@@ -769,7 +1128,7 @@ class TestUsersPost(unittest.TestCase):
             self.app.post(urlparse.urljoin(SERVER_API, 'users/' + self.username),
                           data={'password': self.password})
         # Retrieve the generated activation code
-        activation_code = server.pending_users[self.username]['activation_code']
+        activation_code = server.metadata.get_pending_user(self.username).activation_code
 
         self.assertEqual(len(outbox), 1)
         body = outbox[0].body
@@ -788,7 +1147,7 @@ class TestUsersPut(unittest.TestCase):
         self.username = USR
         self.password = PW
         self.user_dirpath = userpath2serverpath(self.username)
-        assert self.username not in server.pending_users
+        assert server.metadata.get_pending_user(self.username) is None
         assert not os.path.exists(self.user_dirpath)
 
         # The Users.post (signup request) is repeatable
@@ -796,7 +1155,7 @@ class TestUsersPut(unittest.TestCase):
                              data={'password': self.password})
 
         # Retrieve the generated activation code
-        self.activation_code = server.pending_users[self.username]['activation_code']
+        self.activation_code = server.metadata.get_pending_user(self.username).activation_code
 
     def tearDown(self):
         tear_down_test_dir()
@@ -810,7 +1169,7 @@ class TestUsersPut(unittest.TestCase):
                             data={'activation_code': self.activation_code})
 
         self.assertEqual(test.status_code, HTTP_NOT_FOUND)
-        self.assertNotIn(unexisting_user, server.userdata.keys())
+        self.assertNotIn(unexisting_user, server.metadata.usernames())
         self.assertFalse(os.path.exists(userpath2serverpath(unexisting_user)))
 
     def test_wrong_activation_code(self):
@@ -820,7 +1179,7 @@ class TestUsersPut(unittest.TestCase):
         test = self.app.put(urlparse.urljoin(SERVER_API, 'users/' + self.username),
                             data={'activation_code': 'fake activation code'})
         self.assertEqual(test.status_code, HTTP_NOT_FOUND)
-        self.assertNotIn(self.username, server.userdata.keys())
+        self.assertNotIn(self.username, server.metadata.usernames())
         self.assertFalse(os.path.exists(self.user_dirpath))
 
     def test_ok(self):
@@ -831,10 +1190,12 @@ class TestUsersPut(unittest.TestCase):
         test = self.app.put(urlparse.urljoin(SERVER_API, 'users/' + self.username),
                             data={'activation_code': self.activation_code})
 
-        self.assertIn(self.username, server.userdata.keys())
+        self.assertIn(self.username, server.metadata.usernames())
         self.assertTrue(os.path.exists(self.user_dirpath))
-        self.assertNotIn(self.username, server.pending_users.keys())
+        self.assertNotIn(self.username, server.metadata.pending_usernames())
         self.assertEqual(test.status_code, HTTP_CREATED)
+        # The password kept by the pending user is the signup one
+        self.assertTrue(server.verify_password(self.username, self.password))
 
 
 class TestUsersDelete(unittest.TestCase):
@@ -856,7 +1217,7 @@ class TestUsersDelete(unittest.TestCase):
         _manually_create_user(USR, PW)
         user_dirpath = userpath2serverpath(USR)
         # Really created?
-        assert USR in server.userdata, 'Utente "{}" non risulta tra i dati'.format(USR)  # TODO: translate
+        assert USR in server.metadata, 'Utente "{}" non risulta tra i dati'.format(USR)  # TODO: translate
         assert os.path.exists(user_dirpath), 'Directory utente "{}" non trovata'.format(USR)  # TODO: translate
 
         # Test FORBIDDEN case (removing other users)
@@ -870,7 +1231,7 @@ class TestUsersDelete(unittest.TestCase):
         test = self.app.delete(url,
                                headers=make_basicauth_headers(USR, PW))
 
-        self.assertNotIn(USR, server.userdata)
+        self.assertNotIn(USR, server.metadata)
         self.assertEqual(test.status_code, server.HTTP_OK)
         self.assertFalse(os.path.exists(user_dirpath))
 
@@ -914,8 +1275,7 @@ class TestUsersRecoverPassword(unittest.TestCase):
         self.active_user_pw = pick_rand_pw(8)
         _manually_create_user(self.active_user, self.active_user_pw)
         self.pending_user = 'Pending'
-        server.pending_users[self.pending_user] = {'timestamp': server.now_timestamp(),
-                                                   'activation_code': 'fake-activation-code'}
+        server.metadata.set_pending_user(self.pending_user, 'fake-activation-code', server.now_timestamp())
 
     def test_active_user(self):
         url = SERVER_API + 'users/{}/reset'.format(self.active_user)
@@ -923,20 +1283,18 @@ class TestUsersRecoverPassword(unittest.TestCase):
         test = self.app.post(url,
                              data={'password': new_password})
         self.assertEqual(test.status_code, HTTP_ACCEPTED)
-        self.assertIsNotNone(server.userdata[self.active_user].get('recoverpass_data'))
+        self.assertIsNotNone(server.metadata.get_user(self.active_user).recoverpass_code)
 
     def test_pending_user(self):
         url = SERVER_API + 'users/{}/reset'.format(self.pending_user)
         new_password = pick_rand_pw(10)
-        previous_pending_activation = server.pending_users[self.pending_user]['activation_code']
-        previous_pending_timestamp = server.pending_users[self.pending_user]['timestamp']
+        previous_pending = server.metadata.get_pending_user(self.pending_user)
         test = self.app.post(url,
                              data={'password': new_password})
         self.assertEqual(test.status_code, HTTP_ACCEPTED)
-        self.assertNotEqual(previous_pending_activation,
-                            server.pending_users[self.pending_user]['activation_code'])
-        self.assertLess(previous_pending_timestamp,
-                        server.pending_users[self.pending_user]['timestamp'])
+        pending = server.metadata.get_pending_user(self.pending_user)
+        self.assertNotEqual(previous_pending.activation_code, pending.activation_code)
+        self.assertLess(previous_pending.timestamp, pending.timestamp)
 
     def test_unknown_user(self):
         url = SERVER_API + 'users/{}/reset'.format('unknown@pippo.it')
@@ -945,16 +1303,16 @@ class TestUsersRecoverPassword(unittest.TestCase):
         self.assertEqual(test.status_code, HTTP_NOT_FOUND)
 
     def test_put_ok(self):
-        old_password = server.userdata[self.active_user]['password']
+        old_password = server.metadata.get_user(self.active_user).password
         # first request a new password with post
         self.app.post(SERVER_API + 'users/{}/reset'.format(self.active_user))
-        recoverpass_code = server.userdata[self.active_user]['recoverpass_data'][0]
+        recoverpass_code = server.metadata.get_user(self.active_user).recoverpass_code
         # then, put with given code and new password
         test = self.app.put(SERVER_API + 'users/{}'.format(self.active_user),
                             data={'recoverpass_code': recoverpass_code,
                                   'password': pick_rand_pw(10)})
         self.assertEqual(test.status_code, HTTP_OK)
-        self.assertNotEqual(old_password, server.userdata[self.active_user]['password'])
+        self.assertNotEqual(old_password, server.metadata.get_user(self.active_user).password)
 
     def test_put_recoverpass_code_timeout(self):
         """
@@ -965,7 +1323,8 @@ class TestUsersRecoverPassword(unittest.TestCase):
         # and this must return a success.
         # NB: This is possible due to the fact that (TODO?) expired tokens are currently keep.
         recoverpass_creation_time = 100  # 1970, less than a second after the midnight of 31 dec 1969 :p
-        server.userdata[self.active_user]['recoverpass_data'] = ('ok_code', recoverpass_creation_time)
+        server.metadata.update_user(self.active_user,
+                                    recoverpass_code='ok_code', recoverpass_timestamp=recoverpass_creation_time)
         recoverpass_expiration_time = recoverpass_creation_time + server.USER_RECOVERPASS_TIMEOUT
         just_in_time = recoverpass_expiration_time - 1
         too_late = recoverpass_expiration_time + 1
@@ -984,7 +1343,7 @@ class TestUsersRecoverPassword(unittest.TestCase):
         with server.mail.record_messages() as outbox:
             self.app.post(urlparse.urljoin(SERVER_API, 'users/{}/reset'.format(self.active_user)))
         # Retrieve the generated activation code
-        recoverpass_code, recoverpass_ctime10000 = server.userdata[self.active_user]['recoverpass_data']
+        recoverpass_code = server.metadata.get_user(self.active_user).recoverpass_code
         self.assertEqual(len(outbox), 1)
         body = outbox[0].body
         recipients = outbox[0].recipients
@@ -997,35 +1356,700 @@ class TestUsersRecoverPassword(unittest.TestCase):
         self.assertTrue('change' in body and 'password' in body)
 
 
+class TestCredentialsCache(unittest.TestCase):
+    """
+    Test the cache of verified credentials.
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        _manually_create_user(USR, PW)
+
+    def tearDown(self):
+        _manually_remove_user(USR)
+        tear_down_test_dir()
+
+    def test_cache(self):
+        cache = server.CredentialsCache(maxsize=2, ttl=60)
+        self.assertFalse(cache.check('pippo', 'pw', 'stored'))
+        cache.add('pippo', 'pw', 'stored')
+        self.assertTrue(cache.check('pippo', 'pw', 'stored'))
+        # Wrong password or changed stored password
+        self.assertFalse(cache.check('pippo', 'wrong', 'stored'))
+        self.assertFalse(cache.check('pippo', 'pw', 'changed'))
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+        # The least recently used entry is evicted
+        cache.add('pippo', 'pw', 'stored')
+        cache.add('pluto', 'pw', 'stored')
+        cache.check('pippo', 'pw', 'stored')
+        cache.add('paperino', 'pw', 'stored')
+        self.assertTrue(cache.check('pippo', 'pw', 'stored'))
+        self.assertFalse(cache.check('pluto', 'pw', 'stored'))
+
+        cache.invalidate('pippo')
+        self.assertFalse(cache.check('pippo', 'pw', 'stored'))
+
+    def test_cache_expiration(self):
+        cache = server.CredentialsCache(ttl=-1)
+        cache.add('pippo', 'pw', 'stored')
+        self.assertFalse(cache.check('pippo', 'pw', 'stored'))
+
+    def test_authenticated_requests_hit_the_cache(self):
+        hits = server.credentials_cache.hits
+        for _ in range(3):
+            test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, PW))
+            self.assertEqual(test.status_code, HTTP_OK)
+        self.assertEqual(server.credentials_cache.hits, hits + 2)
+
+        # A wrong password is never accepted
+        test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, PW + 'a'))
+        self.assertEqual(test.status_code, server.HTTP_UNAUTHORIZED)
+
+    def test_password_change_invalidates_the_cache(self):
+        self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, PW))
+        self.app.post(SERVER_API + 'users/{}/reset'.format(USR))
+        recoverpass_code = server.metadata.get_user(USR).recoverpass_code
+        new_password = pick_rand_pw(10)
+        self.app.put(SERVER_API + 'users/{}'.format(USR),
+                     data={'recoverpass_code': recoverpass_code, 'password': new_password})
+
+        test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, PW))
+        self.assertEqual(test.status_code, server.HTTP_UNAUTHORIZED)
+        test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, new_password))
+        self.assertEqual(test.status_code, HTTP_OK)
+
+
+
+class TestSessions(unittest.TestCase):
+    """
+    Test the session tokens.
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        _manually_create_user(USR, PW)
+        self.url = SERVER_API + 'sessions'
+
+    def tearDown(self):
+        _manually_remove_user(USR)
+        tear_down_test_dir()
+
+    def _get_token(self):
+        test = self.app.post(self.url, headers=make_basicauth_headers(USR, PW))
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        data = json.loads(test.data)
+        self.assertEqual(data['expires_in'], server.SESSION_TOKEN_TTL)
+        return data['token']
+
+    def test_token_authentication(self):
+        token = self._get_token()
+        test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, token))
+        self.assertEqual(test.status_code, HTTP_OK)
+
+        # The token of an user is not valid for another one
+        other_user, other_pw = 'other@mail.com', pick_rand_pw(10)
+        _manually_create_user(other_user, other_pw)
+        try:
+            test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(other_user, token))
+            self.assertEqual(test.status_code, server.HTTP_UNAUTHORIZED)
+        finally:
+            _manually_remove_user(other_user)
+
+    def test_wrong_credentials(self):
+        test = self.app.post(self.url, headers=make_basicauth_headers(USR, PW + 'a'))
+        self.assertEqual(test.status_code, server.HTTP_UNAUTHORIZED)
+
+    def test_tampered_token(self):
+        token = self._get_token()
+        expiration, signature = token[len(server.SESSION_TOKEN_PREFIX):].split('.')
+        for bad_token in (token[:-1],
+                          '{}{}.{}'.format(server.SESSION_TOKEN_PREFIX, int(expiration) + 1000, signature),
+                          server.SESSION_TOKEN_PREFIX + 'garbage'):
+            test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, bad_token))
+            self.assertEqual(test.status_code, server.HTTP_UNAUTHORIZED)
+
+    def test_expired_token(self):
+        stored_pw = server.metadata.get_user(USR).password
+        token = server.create_session_token(USR, stored_pw, ttl=-1)
+        self.assertFalse(server.check_session_token(USR, token, stored_pw))
+        test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, token))
+        self.assertEqual(test.status_code, server.HTTP_UNAUTHORIZED)
+
+    def test_token_does_not_renew_itself(self):
+        token = self._get_token()
+        test = self.app.post(self.url, headers=make_basicauth_headers(USR, token))
+        self.assertEqual(test.status_code, HTTP_FORBIDDEN)
+
+    def test_password_change_revokes_tokens(self):
+        token = self._get_token()
+        server.metadata.update_user(USR, password=server._encrypt_password(pick_rand_pw(10)))
+        test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(USR, token))
+        self.assertEqual(test.status_code, server.HTTP_UNAUTHORIZED)
+
+
+class TestUploadSessions(unittest.TestCase):
+    """
+    Test the chunked upload sessions.
+    """
+    CONTENT = 'some big file content'
+
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        _manually_create_user(USR, PW)
+        self.headers = make_basicauth_headers(USR, PW)
+        self.url = SERVER_API + 'uploads/'
+        self.chunk_size = server.UPLOAD_CHUNK_SIZE
+        server.UPLOAD_CHUNK_SIZE = 5
+
+    def tearDown(self):
+        server.UPLOAD_CHUNK_SIZE = self.chunk_size
+        _manually_remove_user(USR)
+        tear_down_test_dir()
+
+    def _open_session(self, path, content=CONTENT, replace=False):
+        return self.app.post(self.url, headers=self.headers,
+                             data={'path': path, 'size': len(content), 'md5': hashlib.md5(content).hexdigest(),
+                                   'replace': replace})
+
+    def _send_chunk(self, upload_id, index, content=CONTENT):
+        return self.app.put('{}{}/{}'.format(self.url, upload_id, index), headers=self.headers,
+                            data=content[index * 5:(index + 1) * 5])
+
+    def test_upload(self):
+        test = self._open_session('subdir/bigfile.txt')
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        session = json.loads(test.data)
+        self.assertEqual((session['chunk_size'], session['chunks']), (5, 5))
+        upload_id = session['upload_id']
+
+        # Chunks are received in any order
+        for index in (4, 0, 2):
+            self.assertEqual(self._send_chunk(upload_id, index).status_code, HTTP_OK)
+        test = self.app.get(self.url + upload_id, headers=self.headers)
+        self.assertEqual(json.loads(test.data)['received'], [0, 2, 4])
+
+        # The commit fails until all the chunks are received
+        test = self.app.post(self.url + upload_id, headers=self.headers)
+        self.assertEqual(test.status_code, server.HTTP_PRECONDITION_FAILED)
+        for index in (1, 3):
+            self._send_chunk(upload_id, index)
+
+        test = self.app.post(self.url + upload_id, headers=self.headers)
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        timestamp = json.loads(test.data)[server.LAST_SERVER_TIMESTAMP]
+        with open(userpath2serverpath(USR, 'subdir/bigfile.txt'), 'rb') as fp:
+            self.assertEqual(fp.read(), self.CONTENT)
+        self.assertEqual(server.metadata.get_file(USR, 'subdir/bigfile.txt'),
+                         [timestamp, hashlib.md5(self.CONTENT).hexdigest()])
+        self.assertEqual(server.metadata.get_user(USR).server_timestamp, timestamp)
+        # The session is closed
+        test = self.app.get(self.url + upload_id, headers=self.headers)
+        self.assertEqual(test.status_code, HTTP_NOT_FOUND)
+
+    def test_late_chunk_after_commit(self):
+        upload_id = json.loads(self._open_session('bigfile.txt').data)['upload_id']
+        for index in range(5):
+            self._send_chunk(upload_id, index)
+        # The partial file is still reachable by a chunk request that opens it while the session is committed.
+        late_filepath = server.upload_session_filepath(upload_id) + '.late'
+        os.link(server.upload_session_filepath(upload_id), late_filepath)
+        original_upload_session_filepath = server.upload_session_filepath
+
+        def commit_then_open(upload_id):
+            server.upload_session_filepath = original_upload_session_filepath
+            test = self.app.post(self.url + upload_id, headers=self.headers)
+            self.assertEqual(test.status_code, HTTP_CREATED)
+            return late_filepath
+
+        server.upload_session_filepath = commit_then_open
+        try:
+            test = self._send_chunk(upload_id, 0, self.CONTENT.upper())
+        finally:
+            server.upload_session_filepath = original_upload_session_filepath
+        self.assertEqual(test.status_code, HTTP_NOT_FOUND)
+        with open(userpath2serverpath(USR, 'bigfile.txt'), 'rb') as fp:
+            self.assertEqual(fp.read(), self.CONTENT)
+
+    def test_upload_with_bad_md5(self):
+        upload_id = json.loads(self._open_session('bigfile.txt').data)['upload_id']
+        corrupted_content = self.CONTENT.upper()
+        for index in range(5):
+            self._send_chunk(upload_id, index, corrupted_content)
+        test = self.app.post(self.url + upload_id, headers=self.headers)
+        self.assertEqual(test.status_code, HTTP_CONFLICT)
+        self.assertFalse(os.path.exists(userpath2serverpath(USR, 'bigfile.txt')))
+        self.assertIsNone(server.metadata.get_upload(upload_id))
+
+    def test_bad_chunks(self):
+        upload_id = json.loads(self._open_session('bigfile.txt').data)['upload_id']
+        # Wrong length
+        test = self.app.put('{}{}/0'.format(self.url, upload_id), headers=self.headers, data='abc')
+        self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+        # Out of file
+        test = self._send_chunk(upload_id, 5)
+        self.assertEqual(test.status_code, HTTP_NOT_FOUND)
+
+    def test_replace(self):
+        # The file to replace must exist, the new file must not.
+        test = self._open_session('Misc/Misc.txt')
+        self.assertEqual(test.status_code, HTTP_FORBIDDEN)
+        test = self._open_session('unexisting.txt', replace=True)
+        self.assertEqual(test.status_code, HTTP_NOT_FOUND)
+
+        upload_id = json.loads(self._open_session('Misc/Misc.txt', replace=True).data)['upload_id']
+        for index in range(5):
+            self._send_chunk(upload_id, index)
+        test = self.app.post(self.url + upload_id, headers=self.headers)
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        with open(userpath2serverpath(USR, 'Misc/Misc.txt'), 'rb') as fp:
+            self.assertEqual(fp.read(), self.CONTENT)
+
+    def test_sessions_are_private(self):
+        upload_id = json.loads(self._open_session('bigfile.txt').data)['upload_id']
+        other_user, other_pw = 'other@mail.com', pick_rand_pw(10)
+        _manually_create_user(other_user, other_pw)
+        try:
+            test = self.app.get(self.url + upload_id, headers=make_basicauth_headers(other_user, other_pw))
+            self.assertEqual(test.status_code, HTTP_NOT_FOUND)
+        finally:
+            _manually_remove_user(other_user)
+
+    def test_abort_and_expiration(self):
+        upload_id = json.loads(self._open_session('bigfile.txt').data)['upload_id']
+        test = self.app.delete(self.url + upload_id, headers=self.headers)
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertFalse(os.path.exists(server.upload_session_filepath(upload_id)))
+
+        upload_id = json.loads(self._open_session('bigfile.txt').data)['upload_id']
+        server.metadata._execute('UPDATE uploads SET timestamp = 0')
+        self._open_session('otherfile.txt')
+        self.assertIsNone(server.metadata.get_upload(upload_id))
+        self.assertFalse(os.path.exists(server.upload_session_filepath(upload_id)))
+
+
+class TestBlobStorage(unittest.TestCase):
+    """
+    Test the deduplication of the user files contents.
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        self.other_user, self.other_pw = 'other@mail.com', pick_rand_pw(10)
+        _manually_create_user(USR, PW)
+        _manually_create_user(self.other_user, self.other_pw)
+
+    def tearDown(self):
+        _manually_remove_user(self.other_user)
+        _manually_remove_user(USR)
+        tear_down_test_dir()
+
+    def _upload(self, username, pw, path):
+        test_file, test_md5 = _make_temp_file()
+        try:
+            test = self.app.post(SERVER_FILES_API + path, headers=make_basicauth_headers(username, pw),
+                                 data={'file': test_file, 'md5': test_md5})
+        finally:
+            test_file.close()
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        return test_md5
+
+    def test_same_content_is_stored_once(self):
+        md5 = self._upload(USR, PW, 'file.txt')
+        self._upload(self.other_user, self.other_pw, 'other/file.txt')
+        self.assertTrue(os.path.samefile(userpath2serverpath(USR, 'file.txt'),
+                                         userpath2serverpath(self.other_user, 'other/file.txt')))
+        self.assertEqual(server.blobs.refcount(md5), 2)
+
+    def test_copy_is_a_link(self):
+        md5 = self._upload(USR, PW, 'file.txt')
+        test = self.app.post(SERVER_ACTIONS_API + 'copy', headers=make_basicauth_headers(USR, PW),
+                             data={'src': 'file.txt', 'dst': 'copy/file.txt'})
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertTrue(os.path.samefile(userpath2serverpath(USR, 'file.txt'),
+                                         userpath2serverpath(USR, 'copy/file.txt')))
+        self.assertEqual(server.metadata.get_file(USR, 'copy/file.txt')[1], md5)
+        self.assertEqual(server.blobs.refcount(md5), 2)
+
+    def test_copy_does_not_change_the_blobs(self):
+        md5 = self._upload(USR, PW, 'file.txt')
+        self._upload(self.other_user, self.other_pw, 'file.txt')
+        # A source file unknown to the metadata store is copied, replacing the linked destination
+        _create_file(USR, 'new.txt', 'new content', update_metadata=False)
+        test = self.app.post(SERVER_ACTIONS_API + 'copy', headers=make_basicauth_headers(USR, PW),
+                             data={'src': 'new.txt', 'dst': 'file.txt'})
+        self.assertEqual(test.status_code, HTTP_OK)
+        with open(userpath2serverpath(USR, 'file.txt'), 'rb') as fp:
+            self.assertEqual(fp.read(), 'new content')
+        with open(userpath2serverpath(self.other_user, 'file.txt'), 'rb') as fp:
+            self.assertEqual(fp.read(), 'this is a test')
+        self.assertEqual(server.blobs.refcount(md5), 1)
+
+    def test_blobs_exist(self):
+        md5 = self._upload(USR, PW, 'file.txt')
+        unknown_md5 = hashlib.md5('unknown').hexdigest()
+        test = self.app.post(SERVER_API + 'blobs/exists', headers=make_basicauth_headers(USR, PW),
+                             data={'md5': [md5, unknown_md5, 'invalid']})
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertEqual(json.loads(test.data), {'existing': [md5]})
+        # The contents of other users are not disclosed
+        test = self.app.post(SERVER_API + 'blobs/exists',
+                             headers=make_basicauth_headers(self.other_user, self.other_pw),
+                             data={'md5': [md5]})
+        self.assertEqual(json.loads(test.data), {'existing': []})
+
+    def test_upload_by_reference(self):
+        md5 = self._upload(USR, PW, 'file.txt')
+        headers = make_basicauth_headers(USR, PW)
+        test = self.app.post(SERVER_FILES_API + 'linked.txt', headers=headers,
+                             data={'md5': md5, 'size': len('this is a test')})
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        timestamp = json.loads(test.data)[server.LAST_SERVER_TIMESTAMP]
+        self.assertTrue(os.path.samefile(userpath2serverpath(USR, 'file.txt'),
+                                         userpath2serverpath(USR, 'linked.txt')))
+        self.assertEqual(server.metadata.get_file(USR, 'linked.txt'), [timestamp, md5])
+
+        # Modify by reference
+        test = self.app.put(SERVER_FILES_API + 'Misc/Misc.txt', headers=headers, data={'md5': md5})
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        with open(userpath2serverpath(USR, 'Misc/Misc.txt'), 'rb') as fp:
+            self.assertEqual(fp.read(), 'this is a test')
+
+    def test_upload_by_reference_of_other_user_content(self):
+        """
+        Knowing the md5 and the size of a file of another user is not enough to get it.
+        """
+        md5 = self._upload(USR, PW, 'file.txt')
+        test = self.app.post(SERVER_FILES_API + 'stolen.txt',
+                             headers=make_basicauth_headers(self.other_user, self.other_pw),
+                             data={'md5': md5, 'size': len('this is a test')})
+        self.assertEqual(test.status_code, server.HTTP_PRECONDITION_FAILED)
+        self.assertFalse(os.path.exists(userpath2serverpath(self.other_user, 'stolen.txt')))
+
+    def test_upload_by_reference_of_unknown_content(self):
+        headers = make_basicauth_headers(USR, PW)
+        test = self.app.post(SERVER_FILES_API + 'linked.txt', headers=headers,
+                             data={'md5': hashlib.md5('unknown').hexdigest()})
+        self.assertEqual(test.status_code, server.HTTP_PRECONDITION_FAILED)
+        self.assertFalse(os.path.exists(userpath2serverpath(USR, 'linked.txt')))
+
+        # Wrong size
+        md5 = self._upload(USR, PW, 'file.txt')
+        test = self.app.post(SERVER_FILES_API + 'linked.txt', headers=headers, data={'md5': md5, 'size': 1})
+        self.assertEqual(test.status_code, server.HTTP_PRECONDITION_FAILED)
+
+    def test_unreferenced_blobs_are_removed(self):
+        md5 = self._upload(USR, PW, 'file.txt')
+        self._upload(self.other_user, self.other_pw, 'file.txt')
+        self.app.post(SERVER_ACTIONS_API + 'delete', headers=make_basicauth_headers(USR, PW),
+                      data={'filepath': 'file.txt'})
+        self.assertEqual(server.blobs.refcount(md5), 1)
+        self.app.delete(SERVER_API + 'users/{}'.format(self.other_user),
+                        headers=make_basicauth_headers(self.other_user, self.other_pw))
+        self.assertFalse(server.blobs.exists(md5))
+
 def get_dic_dir_states():
     """
-    Return a tuple with dictionary state and directory state of all users.
-    NB: Passwords are removed from the dictionary states.
+    Return a tuple with metadata state and directory state of all users,
+    i.e. the {<path>: <md5>} dictionaries of the metadata store and of the files actually on disk.
     :return: tuple
     """
     dic_state = {}
     dir_state = {}
-    for username in server.userdata:
-        single_user_data = server.userdata[username].copy()
-        single_user_data.pop(server.PWD)  # not very beautiful
-        single_user_data.pop(server.USER_CREATION_TIME)  # not very beautiful
-        dic_state[username] = single_user_data
-        dir_state = json.load(open('userdata.json', "rb"))
-        dir_state[username].pop(server.PWD)  # not very beatiful cit. ibidem
-        dir_state[username].pop(server.USER_CREATION_TIME)  # not very beatiful cit. ibidem
+    for username in server.metadata.usernames():
+        dic_state[username] = {path: md5 for path, (timestamp, md5)
+                               in server.metadata.get_snapshot(username).iteritems()}
+        dir_snapshot = server.compute_dir_state(userpath2serverpath(username))[server.SNAPSHOT]
+        dir_state[username] = {path: md5 for path, (timestamp, md5) in dir_snapshot.iteritems()}
     return dic_state, dir_state
 
 
+class TestBundles(unittest.TestCase):
+    """
+    Test the upload of many files in a tar archive.
+    """
+    BUNDLES_API = urlparse.urljoin(SERVER_API, 'bundles/')
+
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        _manually_create_user(USR, PW)
+        self.headers = make_basicauth_headers(USR, PW)
+
+    def tearDown(self):
+        _manually_remove_user(USR)
+        tear_down_test_dir()
+
+    def _bundle(self, files, mode='w'):
+        """
+        Return a tar archive of <files>, a list of (path, content, md5).
+        """
+        data = io.BytesIO()
+        bundle = tarfile.open(fileobj=data, mode=mode, format=tarfile.PAX_FORMAT)
+        for path, content, md5 in files:
+            info = tarfile.TarInfo(path)
+            info.size = len(content)
+            if md5:
+                info.pax_headers = {server.BUNDLE_MD5_HEADER: md5}
+            bundle.addfile(info, io.BytesIO(content))
+        bundle.close()
+        return data.getvalue()
+
+    def _post(self, data):
+        return self.app.post(self.BUNDLES_API, headers=self.headers, data=data, content_type='application/x-tar')
+
+    def test_bundle_upload(self):
+        _create_file(USR, 'existing.txt', 'old content')
+        _create_file(USR, 'dir/file.txt', 'a file')
+        files = [('new.txt', 'new content', hashlib.md5('new content').hexdigest()),
+                 ('sub/dir/new.txt', 'other content', hashlib.md5('other content').hexdigest()),
+                 ('existing.txt', 'new content', hashlib.md5('new content').hexdigest()),
+                 ('wrong_md5.txt', 'content', hashlib.md5('other').hexdigest()),
+                 ('no_md5.txt', 'content', None),
+                 ('../../outside.txt', 'content', hashlib.md5('content').hexdigest()),
+                 ('dir', 'content', hashlib.md5('content').hexdigest())]
+        cursor = server.metadata.last_change(USR)
+
+        test = self._post(self._bundle(files))
+
+        self.assertEqual(test.status_code, server.HTTP_OK)
+        obj = json.loads(test.data)
+        self.assertEqual(obj['results'], {'new.txt': server.HTTP_CREATED,
+                                          'sub/dir/new.txt': server.HTTP_CREATED,
+                                          'existing.txt': server.HTTP_OK,
+                                          'wrong_md5.txt': server.HTTP_CONFLICT,
+                                          'no_md5.txt': server.HTTP_BAD_REQUEST,
+                                          '../../outside.txt': server.HTTP_FORBIDDEN,
+                                          'dir': server.HTTP_CONFLICT})
+        self.assertEqual(obj[server.LAST_SERVER_TIMESTAMP], server.metadata.get_user(USR).server_timestamp)
+        for path, content, md5 in files[:3]:
+            with open(userpath2serverpath(USR, path)) as fp:
+                self.assertEqual(fp.read(), content)
+            self.assertEqual(server.metadata.get_file(USR, path)[1], md5)
+        self.assertIsNone(server.metadata.get_file(USR, 'wrong_md5.txt'))
+        self.assertEqual([change['op'] for change in server.metadata.get_changes(USR, cursor)],
+                         ['create', 'create', 'modify'])
+        # No temporary file is left
+        self.assertEqual([filename for filename in os.listdir(userpath2serverpath(USR))
+                          if filename.startswith(server.UPLOAD_TEMPFILE_PREFIX)], [])
+
+    def test_bundle_upload_of_stored_content(self):
+        """
+        A content already stored is linked to the old blob: the server timestamp still advances.
+        """
+        _create_file(USR, 'old.txt', 'old content')
+        os.utime(userpath2serverpath(USR, 'old.txt'), (1, 1))
+        server.blobs.store(userpath2serverpath(USR, 'old.txt'), hashlib.md5('old content').hexdigest())
+        last_server_timestamp = server.metadata.get_user(USR).server_timestamp
+
+        test = self._post(self._bundle([('copy.txt', 'old content', hashlib.md5('old content').hexdigest())]))
+        self.assertEqual(json.loads(test.data)['results'], {'copy.txt': server.HTTP_CREATED})
+        timestamp = json.loads(test.data)[server.LAST_SERVER_TIMESTAMP]
+        self.assertGreater(timestamp, last_server_timestamp)
+        self.assertEqual(server.metadata.get_file(USR, 'copy.txt')[0], timestamp)
+
+    def test_compressed_bundle_upload(self):
+        test = self._post(self._bundle([('new.txt', 'new content', hashlib.md5('new content').hexdigest())],
+                                       mode='w:gz'))
+        self.assertEqual(json.loads(test.data)['results'], {'new.txt': server.HTTP_CREATED})
+
+    def test_bundle_download(self):
+        files = {'a.txt': 'a content', 'dir/b.txt': 'b content', 'dir/sub/c.txt': 'c' * 1000, 'dir2/d.txt': 'd'}
+        for path, content in files.items():
+            _create_file(USR, path, content)
+        url = urlparse.urljoin(self.BUNDLES_API, 'download')
+
+        test = self.app.post(url, headers=self.headers, data={'path': ['a.txt', 'missing.txt'], 'prefix': 'dir'})
+
+        self.assertEqual(test.status_code, server.HTTP_OK)
+        self.assertEqual(test.mimetype, 'application/x-tar')
+        self.assertTrue(test.is_streamed)
+        received = {}
+        for member in tarfile.open(fileobj=io.BytesIO(test.data), mode='r|'):
+            received[member.name] = member.pax_headers[server.BUNDLE_MD5_HEADER]
+        self.assertEqual(received, {path: hashlib.md5(files[path]).hexdigest()
+                                    for path in ('a.txt', 'dir/b.txt', 'dir/sub/c.txt')})
+        bundle = tarfile.open(fileobj=io.BytesIO(test.data))
+        self.assertEqual(bundle.extractfile('dir/sub/c.txt').read(), files['dir/sub/c.txt'])
+
+        # All the files
+        test = self.app.post(url, headers=self.headers, data={'prefix': ''})
+        self.assertEqual(sorted(tarfile.open(fileobj=io.BytesIO(test.data)).getnames()),
+                         sorted(server.metadata.get_snapshot(USR)))
+        test = self.app.post(url, headers=self.headers, data={'prefix': '../'})
+        self.assertEqual(test.status_code, server.HTTP_FORBIDDEN)
+
+    def test_invalid_bundle(self):
+        self.assertEqual(self._post('not a tar archive').status_code, server.HTTP_BAD_REQUEST)
+        test = self.app.post(self.BUNDLES_API, headers=self.headers, data={'file': (io.BytesIO('content'), 'f')})
+        self.assertEqual(test.status_code, server.HTTP_UNSUPPORTED_MEDIA_TYPE)
+
+
+class TestCompressedUploads(unittest.TestCase):
+    """
+    Test the upload of compressed files.
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        _manually_create_user(USR, PW)
+        self.headers = make_basicauth_headers(USR, PW)
+        self.content = ''.join('{},"some text"\n'.format(i) for i in range(1000))
+        self.md5 = hashlib.md5(self.content).hexdigest()
+
+    def tearDown(self):
+        _manually_remove_user(USR)
+        tear_down_test_dir()
+
+    def _compressed(self, codec_name):
+        return io.BytesIO(''.join(server.compression.iter_compressed(io.BytesIO(self.content),
+                                                                     server.compression.get_codec(codec_name))))
+
+    def test_accepted_encodings_are_advertised(self):
+        test = self.app.get(SERVER_FILES_API, headers=self.headers)
+        self.assertEqual(test.headers['Accept-Encoding'], 'gzip, deflate')
+
+    def test_compressed_upload(self):
+        test = self.app.post(SERVER_FILES_API + 'data.csv', headers=self.headers,
+                             data={'file': (self._compressed('gzip'), 'data.csv'), 'md5': self.md5,
+                                   'content_encoding': 'gzip'})
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        test = self.app.put(SERVER_FILES_API + 'data.csv', headers=self.headers,
+                            data={'file': (self._compressed('deflate'), 'data.csv'), 'md5': self.md5,
+                                  'content_encoding': 'deflate'})
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        with open(userpath2serverpath(USR, 'data.csv'), 'rb') as fp:
+            self.assertEqual(fp.read(), self.content)
+        self.assertEqual(server.metadata.get_file(USR, 'data.csv')[1], self.md5)
+        self.assertEqual(_upload_tempfiles(USR), [])
+
+    def test_invalid_compressed_upload(self):
+        test = self.app.post(SERVER_FILES_API + 'data.csv', headers=self.headers,
+                             data={'file': (self._compressed('gzip'), 'data.csv'), 'md5': self.md5,
+                                   'content_encoding': 'br'})
+        self.assertEqual(test.status_code, server.HTTP_UNSUPPORTED_MEDIA_TYPE)
+        test = self.app.post(SERVER_FILES_API + 'data.csv', headers=self.headers,
+                             data={'file': (io.BytesIO('not compressed'), 'data.csv'), 'md5': self.md5,
+                                   'content_encoding': 'gzip'})
+        self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+        self.assertFalse(os.path.exists(userpath2serverpath(USR, 'data.csv')))
+        self.assertEqual(_upload_tempfiles(USR), [])
+
+
+class TestDeltaTransfer(unittest.TestCase):
+    """
+    Test the upload and the download of file modifications as deltas.
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        _manually_create_user(USR, PW)
+        self.headers = make_basicauth_headers(USR, PW)
+        self.content = os.urandom(delta.MIN_BLOCK_SIZE * 10 + 10)
+        self.md5 = hashlib.md5(self.content).hexdigest()
+        test = self.app.post(SERVER_FILES_API + 'file.dat', headers=self.headers,
+                             data={'file': (io.BytesIO(self.content), 'file.dat'), 'md5': self.md5})
+        self.assertEqual(test.status_code, HTTP_CREATED)
+
+    def tearDown(self):
+        _manually_remove_user(USR)
+        tear_down_test_dir()
+
+    def _put_delta(self, new_content, md5=None):
+        test = self.app.get(SERVER_API + 'signatures/file.dat', headers=self.headers)
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertEqual(test.headers['ETag'], '"{}"'.format(self.md5))
+        delta_data = io.BytesIO()
+        delta.write_delta(json.loads(test.data), io.BytesIO(new_content), delta_data)
+        delta_data.seek(0)
+        return self.app.put(SERVER_FILES_API + 'file.dat', headers=self.headers,
+                            data={'delta': (delta_data, 'delta'),
+                                  'md5': md5 or hashlib.md5(new_content).hexdigest()})
+
+    def _server_content(self):
+        with open(userpath2serverpath(USR, 'file.dat'), 'rb') as fp:
+            return fp.read()
+
+    def test_signature(self):
+        test = self.app.get(SERVER_API + 'signatures/file.dat?block_size=4096', headers=self.headers)
+        sig = json.loads(test.data)
+        self.assertEqual(sig['block_size'], 4096)
+        self.assertEqual(len(sig['blocks']), 6)
+        test = self.app.get(SERVER_API + 'signatures/missing.dat', headers=self.headers)
+        self.assertEqual(test.status_code, HTTP_NOT_FOUND)
+
+    def test_upload_delta(self):
+        new_content = self.content[:100] + 'inserted' + self.content[100:]
+        test = self._put_delta(new_content)
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        self.assertEqual(self._server_content(), new_content)
+        self.assertEqual(server.metadata.get_file(USR, 'file.dat')[1], hashlib.md5(new_content).hexdigest())
+        self.assertEqual(_upload_tempfiles(USR), [])
+
+    def test_upload_delta_with_wrong_md5(self):
+        test = self._put_delta(self.content + 'appended', md5=hashlib.md5('other').hexdigest())
+        self.assertEqual(test.status_code, HTTP_CONFLICT)
+        self.assertEqual(self._server_content(), self.content)
+        self.assertEqual(_upload_tempfiles(USR), [])
+
+    def test_upload_invalid_delta(self):
+        test = self.app.put(SERVER_FILES_API + 'file.dat', headers=self.headers,
+                            data={'delta': (io.BytesIO('not a delta'), 'delta'), 'md5': self.md5})
+        self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+        self.assertEqual(self._server_content(), self.content)
+
+    def test_download_delta(self):
+        old_content = self.content[:-5000] + 'old'
+        sig = delta.signature(io.BytesIO(old_content), delta.MIN_BLOCK_SIZE)
+        test = self.app.post(SERVER_API + 'deltas/file.dat', headers=self.headers,
+                             data={'signature': json.dumps(sig)})
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertEqual(test.headers['ETag'], '"{}"'.format(self.md5))
+        self.assertLess(len(test.data), len(self.content) / 2)
+        rebuilt = io.BytesIO()
+        delta.apply_delta(io.BytesIO(old_content), io.BytesIO(test.data), rebuilt)
+        self.assertEqual(rebuilt.getvalue(), self.content)
+
+    def test_download_delta_of_different_file(self):
+        sig = delta.signature(io.BytesIO(os.urandom(len(self.content))), delta.MIN_BLOCK_SIZE)
+        test = self.app.post(SERVER_API + 'deltas/file.dat', headers=self.headers,
+                             data={'signature': json.dumps(sig)})
+        self.assertEqual(test.status_code, server.HTTP_PRECONDITION_FAILED)
+
+        test = self.app.post(SERVER_API + 'deltas/file.dat', headers=self.headers,
+                             data={'signature': json.dumps({'block_size': 1, 'blocks': []})})
+        self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+
+
 class TestUserdataConsistence(unittest.TestCase):
     """
-    Testing consistence between userdata dictionary and actual files.
+    Testing consistence between metadata store and actual files.
     """
 
     def setUp(self):
         setup_test_dir()
+        server.reset_userdata()
         self.app = server.app.test_client()
         self.app.testing = True
 
+    def tearDown(self):
+        tear_down_test_dir()
+
     def test_consistence_after_actions(self):
         """
         Complex test that do several actions and finally test the consistency.
@@ -1034,9 +2058,6 @@ class TestUserdataConsistence(unittest.TestCase):
         user = 'pippo'
         _manually_create_user(user, 'pass')
 
-        # i need to create the userdata.json to check consistency
-        server.save_userdata()
-
         # post
         _create_file(user, 'new_file', 'ciao!!!')
         url = SERVER_FILES_API + 'new_file'
@@ -1075,6 +2096,30 @@ class TestUserdataConsistence(unittest.TestCase):
         self.assertEqual(dic_state, dir_state)
         # WIP: Test not complete. TODO: Do more things! Put, ...?
 
+    def test_reindex_user(self):
+        """
+        Test that the reindex makes the metadata consistent with the files changed outside the server.
+        """
+        user = 'pippo'
+        _manually_create_user(user, 'pass')
+        _create_file(user, 'unchanged.txt', 'unchanged')
+        _create_file(user, 'modified.txt', 'old content')
+        _create_file(user, 'removed.txt', 'removed')
+        self.assertEqual(server.reindex_user(user), (0, 0, 0))
+
+        # Changes made outside the server
+        _create_file(user, 'modified.txt', 'new content', update_metadata=False)
+        _create_file(user, 'dir/added.txt', 'added', update_metadata=False)
+        os.remove(userpath2serverpath(user, 'removed.txt'))
+        cursor = server.metadata.last_change(user)
+
+        self.assertEqual(server.reindex_user(user, processes=1), (1, 1, 1))
+        dic_state, dir_state = get_dic_dir_states()
+        self.assertEqual(dic_state, dir_state)
+        self.assertEqual(sorted(change['op'] for change in server.metadata.get_changes(user, cursor)),
+                         ['create', 'delete', 'modify'])
+        self.assertEqual(server.reindex_user(user), (0, 0, 0))
+
 
 class TestLoggingConfiguration(unittest.TestCase):
     """
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+WSGI entry point of the server, to run it in production with a multi-process, multi-threaded WSGI server,
+from the server directory, e.g. with gunicorn:
+
+    $ gunicorn --workers 4 --threads 32 --timeout 60 wsgi:application
+
+Configuration environment variables:
+- PYBOX_METADATA: the metadata database file (server.METADATA_FILENAME by default);
+- PYBOX_SECRET_KEY: the key signing the session tokens (by default, it's generated and saved in
+  server.SECRET_KEY_FILENAME);
+- PYBOX_EMAIL_SETTINGS: the email settings file (email_settings.ini by default);
+- PYBOX_X_SENDFILE: if '1', the front server sends the downloaded files (see server.main);
+- PYBOX_X_ACCEL_REDIRECT: the nginx internal location of the file storage (see server.main).
+
+NB: the application must be created in every worker process, so don't preload it in the master process
+(e.g. gunicorn --preload).
+"""
+import os
+
+import server
+
+application = server.create_app(metadata_filename=os.environ.get('PYBOX_METADATA', server.METADATA_FILENAME),
+                                secret_key=os.environ.get('PYBOX_SECRET_KEY'),
+                                email_settings=os.environ.get('PYBOX_EMAIL_SETTINGS'),
+                                x_sendfile=os.environ.get('PYBOX_X_SENDFILE') == '1',
+                                x_accel_redirect=os.environ.get('PYBOX_X_ACCEL_REDIRECT'))